@@ -1,12 +1,43 @@
 import os
-from llama_cpp_wrapper.python_llama_cpp.inference_with_completion import do_inference
-from constrainers import JsonSchemaConstrainer, end_token
+from llama_cpp_wrapper.python_llama_cpp.inference_with_completion import do_inference, get_token_prefix_index
+from llama_cpp_wrapper.python_llama_cpp.batched_inference import do_batched_inference, do_n_best_inference
+from llama_cpp_wrapper.python_llama_cpp.speculative_inference import do_speculative_inference
+from llama_cpp_wrapper.python_llama_cpp.model_utils import get_model, get_context, get_context_pool, ContextPool
+from llama_cpp_wrapper.python_llama_cpp.prompt_cache import PromptCache
+from llama_cpp_wrapper.python_llama_cpp.generation_trace import GenerationTrace
+from llama_cpp_wrapper.python_llama_cpp.generation_stats import GenerationStats
+from llama_cpp_wrapper.python_llama_cpp.constraint_utils import to_byte_completions
+from constrainers import JsonSchemaConstrainer, CompiledJsonSchemaConstrainer, end_token
+from compiled_json_schema_constraint import get_compiled_json_schema_index
+from schema_registry import schema_registry, schema_hash
+from json_events import JsonEventParser
+from typing import Callable, Dict, List, Tuple
 import argparse
 import json
-from jsonschema import Draft7Validator
+import sys
 
 
-def run_inference_constrained_by_json_schema(model_path: str, json_schema: dict, prompt: str):
+def make_json_schema_completer(model_path: str, json_schema: dict, compiled_schema_cache_dir: str = None):
+    if not json_schema:
+        return None
+    prefix_index = get_token_prefix_index(get_model(model_path), model_path)
+    if compiled_schema_cache_dir:
+        compiled_index = get_compiled_json_schema_index(json_schema, prefix_index, compiled_schema_cache_dir)
+        return CompiledJsonSchemaConstrainer(json_schema, compiled_index, max_token_length=prefix_index.max_piece_length)
+    return JsonSchemaConstrainer(json_schema, prefix_index.max_piece_length)
+
+_literal_tokens_caches: Dict[tuple, dict] = {}
+
+def get_literal_tokens_cache(model_path: str, json_schema: dict) -> dict:
+    """
+    This function returns the cache of the tokenizations of the texts forced by a JSON schema (property names, braces...).
+    """
+    return _literal_tokens_caches.setdefault((model_path, schema_hash(json_schema)), {})
+
+def run_inference_constrained_by_json_schema(model_path: str, json_schema: dict, prompt: str, compiled_schema_cache_dir: str = None, prompt_cache: PromptCache = None, context_pool: ContextPool = None,
+                                            trace: GenerationTrace = None, stats: GenerationStats = None,
+                                            stats_callback: Callable[[GenerationStats], None] = None, native_grammar: bool = False, max_tokens: int = 200,
+                                            pipelined: bool = False, draft_model_path: str = None, n_draft: int = 4):
     """
     This function runs inference on a given model, constrained by a JSON schema.
 
@@ -14,43 +45,238 @@ def run_inference_constrained_by_json_schema(model_path: str, json_schema: dict,
     model_path (str): The path to the LLM model in gguf format.
     json_schema (dict): The JSON schema to enforce.
     prompt (str): The input prompt.
+    compiled_schema_cache_dir (str): If set, the JSON schema is compiled for the vocabulary of the model
+        (or loaded from this directory if it was already compiled), and the allowed tokens are looked up in it at each step.
+    prompt_cache (PromptCache): If set, the evaluation of the prompt resumes from the longest cached prefix of its tokens.
+    context_pool (ContextPool): If set, a context of the model is checked out of this pool for the generation,
+        so several generations can run in parallel threads. Otherwise the single context of the model is used.
+    trace (GenerationTrace): If set, the steps of the generation are recorded in it (see benchmark.py).
+    stats (GenerationStats): If set, the timing breakdown of the generation is recorded in it.
+    stats_callback (function): If set, it is called with the stats at the end of the generation (even if it is interrupted).
+    native_grammar (bool): If True and the JSON schema can be translated into a GBNF grammar, the sampling is constrained
+        by the native grammar sampling of llama.cpp instead of the Python constrainer (which is the fallback for the other schemas).
+    max_tokens (int): The maximum number of generated tokens. With a JSON schema, the shortest text closing the JSON value
+        is forced when the budget is about to run out, so the generated JSON is complete.
+    pipelined (bool): If True, the evaluation of each sampled token by the model overlaps with the constraint work of the next step.
+    draft_model_path (str): If set, a small model in gguf format (with the same vocabulary) drafts up to n_draft tokens
+        under the JSON schema, and the model verifies them in one evaluation (speculative decoding, see do_speculative_inference).
+        The generated text follows the same distribution. The prompt cache, the trace, the stats, the native grammar and
+        the pipelined mode are not used in this mode.
+    n_draft (int): The maximum number of tokens drafted at each step.
 
     Yields:
     str: The generated text that follows the constraints of the JSON schema.
     """
-    json_schema_completer = None
-    if json_schema:
-        json_schema_completer = JsonSchemaConstrainer(json_schema)
-    def do_completion(history: str):
-        first_index = history.find(prompt)
-        bot_history = history[first_index+len(prompt):]
+    json_schema_completer = make_json_schema_completer(model_path, json_schema, compiled_schema_cache_dir)
+    def do_completion(new_text: str):
+        # Only the text generated since the previous call is given (the prompt is never seen).
         completions = None
         if json_schema_completer:
-            completions = json_schema_completer.compute_completion(bot_history)
+            completions = json_schema_completer.compute_next_completion(new_text)
         # print(f"""[completions:{completions}]""")
-        byte_completions = completions
-        if isinstance(completions, list):
-            byte_completions = [c.encode() if type(c) is str else c for c in completions]
-        return byte_completions
+        return to_byte_completions(completions)
+    completion_callback = do_completion
+    closing_callback = _make_closing_callback(json_schema_completer)
+    grammar_gbnf = None
+    if native_grammar and json_schema_completer:
+        grammar_gbnf = json_schema_completer.to_gbnf()
+        if grammar_gbnf is not None:
+            # The tokens are constrained by the grammar in llama.cpp. The constrainer only follows the text,
+            # to force its closing text (without the end token, which the grammar does not accept) before the budget runs out.
+            def follow_text(new_text: str):
+                json_schema_completer.extend(new_text)
+                return None
+            completion_callback = follow_text
+            closing_callback = _make_closing_callback(json_schema_completer, end_text="")
     byte_prompt = prompt.encode()
-    for chunk in do_inference(prompt=byte_prompt, model_path=model_path, completion_callback=do_completion, verbose=False):
+    if trace is not None:
+        trace.prompt = prompt
+        trace.json_schema = json_schema
+    if draft_model_path is not None:
+        yield from _generate_speculative(byte_prompt, model_path, draft_model_path, n_draft, json_schema_completer, context_pool, prompt_cache,
+                                         max_tokens, get_literal_tokens_cache(model_path, json_schema) if json_schema else None)
+        return
+    if stats is None and stats_callback is not None:
+        stats = GenerationStats()
+    inference_kwargs = dict(
+        prompt_cache=prompt_cache,
+        literal_tokens_cache=get_literal_tokens_cache(model_path, json_schema) if json_schema else None,
+        trace=trace,
+        stats=stats,
+        grammar_gbnf=grammar_gbnf,
+        n_predict=max_tokens,
+        pipelined=pipelined,
+        closing_callback=closing_callback)
+    try:
+        if context_pool is None:
+            yield from _generate(byte_prompt, model_path, None, completion_callback, inference_kwargs)
+            return
+        with context_pool.checkout() as ctx:
+            yield from _generate(byte_prompt, model_path, ctx, completion_callback, inference_kwargs)
+    finally:
+        if stats is not None:
+            stats.finish()
+            if stats_callback is not None:
+                stats_callback(stats)
+
+def _generate(byte_prompt: bytes, model_path: str, ctx, completion_callback, inference_kwargs: dict):
+    for chunk in do_inference(prompt=byte_prompt, model_path=model_path, ctx=ctx, completion_callback=completion_callback, verbose=False,
+                              incremental_callback=True, **inference_kwargs):
         if end_token in chunk:
             yield chunk.replace(end_token, "")
             return
         yield chunk
 
+def _generate_speculative(byte_prompt: bytes, model_path: str, draft_model_path: str, n_draft: int, json_schema_completer,
+                          context_pool: ContextPool, prompt_cache: PromptCache, max_tokens: int, literal_tokens_cache: dict):
+    draft_model = get_model(draft_model_path)
+    def generate(ctx, draft_ctx):
+        try:
+            for chunk in do_speculative_inference(byte_prompt, json_schema_completer, model_path=model_path, draft_model=draft_model,
+                                                  ctx=ctx, draft_ctx=draft_ctx, n_draft=n_draft, n_predict=max_tokens, stop_text=end_token,
+                                                  literal_tokens_cache=literal_tokens_cache):
+                if end_token in chunk:
+                    yield chunk.replace(end_token, "")
+                    return
+                yield chunk
+        finally:
+            # The KV cache of the context no longer holds the tokens known by the prompt cache.
+            if prompt_cache is not None:
+                prompt_cache.set_context_tokens(ctx, [])
+    if context_pool is None:
+        yield from generate(get_context(get_model(model_path)), get_context(draft_model))
+        return
+    draft_context_pool = get_context_pool(draft_model, len(context_pool.contexts))
+    with context_pool.checkout() as ctx, draft_context_pool.checkout() as draft_ctx:
+        yield from generate(ctx, draft_ctx)
+
+def run_inference_events_constrained_by_json_schema(model_path: str, json_schema: dict, prompt: str, **kwargs):
+    """
+    This function runs inference constrained by a JSON schema like run_inference_constrained_by_json_schema
+    (with the same keyword arguments), and yields the events of the generated JSON as soon as they are known,
+    so the first values can be used while the generation continues.
+
+    Yields:
+    tuple: (kind, path) for the start and the end of the objects and arrays ("start_object", "end_object", "start_array", "end_array"),
+        and ("value", path, value) for each string, number and boolean once it is complete.
+        The path is the tuple of the property names and array indices leading to the value (see json_events.format_path).
+    """
+    event_parser = JsonEventParser(json_schema)
+    for chunk in run_inference_constrained_by_json_schema(model_path, json_schema, prompt, **kwargs):
+        yield from event_parser.feed(chunk)
+    yield from event_parser.finish()
+
+def _make_completion_callback(json_schema_completer):
+    # The incremental completion callback of a sequence decoded in a batch (see do_batched_inference).
+    def do_completion(new_text: str):
+        if json_schema_completer is None:
+            return None
+        return to_byte_completions(json_schema_completer.compute_next_completion(new_text))
+    return do_completion
+
+def _make_closing_callback(json_schema_completer, end_text: str = end_token):
+    # The closing callback of a generation (see do_inference): the shortest text which ends the JSON value, then the end text.
+    if json_schema_completer is None:
+        return None
+    def do_closing():
+        closing_text = json_schema_completer.closing_text()
+        return None if closing_text is None else (closing_text + end_text).encode()
+    return do_closing
+
+def run_batched_inference_constrained_by_json_schema(model_path: str, requests: List[Tuple[str, dict]], compiled_schema_cache_dir: str = None, n_parallel: int = 8,
+                                                     max_tokens: int = 200):
+    """
+    This function runs inference on several prompts together, each one constrained by its own JSON schema.
+    The sequences are decoded in the same batches, which is much faster than running them one after the other.
+
+    Parameters:
+    model_path (str): The path to the LLM model in gguf format.
+    requests (list): The (prompt, JSON schema) pairs.
+    compiled_schema_cache_dir (str): See run_inference_constrained_by_json_schema.
+    n_parallel (int): The maximum number of sequences decoded together.
+    max_tokens (int): The maximum number of generated tokens per request (the JSON is closed before).
+
+    Yields:
+    tuple: The index of the request and a new chunk of its generated text, following the constraints of its JSON schema.
+    """
+    prompts = [prompt.encode() for prompt, json_schema in requests]
+    json_schema_completers = [make_json_schema_completer(model_path, json_schema, compiled_schema_cache_dir) for prompt, json_schema in requests]
+    completion_callbacks = [_make_completion_callback(completer) for completer in json_schema_completers]
+    closing_callbacks = [_make_closing_callback(completer) for completer in json_schema_completers]
+    literal_tokens_caches = [get_literal_tokens_cache(model_path, json_schema) if json_schema else None for prompt, json_schema in requests]
+    for index, chunk in do_batched_inference(prompts, completion_callbacks, model_path=model_path, n_predict=max_tokens, n_parallel=n_parallel,
+                                             stop_text=end_token, literal_tokens_caches=literal_tokens_caches, incremental_callback=True,
+                                             closing_callbacks=closing_callbacks):
+        chunk = chunk.replace(end_token, "")
+        if chunk:
+            yield (index, chunk)
+
+def run_n_best_inference_constrained_by_json_schema(model_path: str, json_schema: dict, prompt: str, n: int = 4,
+                                                     compiled_schema_cache_dir: str = None, max_tokens: int = 200):
+    """
+    This function samples n outputs for the same prompt, each one constrained by the JSON schema (e.g. to rerank them).
+    The prompt is evaluated once and its KV cache is shared by the n sequences, which are decoded together in the same batches.
+    The context must be large enough to hold the prompt and the n generated outputs.
+
+    Parameters:
+    model_path (str): The path to the LLM model in gguf format.
+    json_schema (dict): The JSON schema to enforce.
+    prompt (str): The input prompt.
+    n (int): The number of outputs.
+    compiled_schema_cache_dir (str): See run_inference_constrained_by_json_schema.
+    max_tokens (int): The maximum number of generated tokens per output (the JSON is closed before).
+
+    Yields:
+    tuple: The index of the output and a new chunk of its text, following the constraints of the JSON schema.
+    """
+    # Each output has its own constrainer (its own parser state).
+    json_schema_completers = [make_json_schema_completer(model_path, json_schema, compiled_schema_cache_dir) for _ in range(n)]
+    completion_callbacks = [_make_completion_callback(completer) for completer in json_schema_completers]
+    closing_callbacks = [_make_closing_callback(completer) for completer in json_schema_completers]
+    literal_tokens_cache = get_literal_tokens_cache(model_path, json_schema) if json_schema else None
+    for index, chunk in do_n_best_inference(prompt.encode(), completion_callbacks, model_path=model_path, n_predict=max_tokens, stop_text=end_token,
+                                            literal_tokens_cache=literal_tokens_cache, incremental_callback=True, closing_callbacks=closing_callbacks):
+        chunk = chunk.replace(end_token, "")
+        if chunk:
+            yield (index, chunk)
+
 def cli():
     """
     Command Line Interface for running inference constrained by a JSON schema.
 
     This function parses command line arguments for model path, prompt, and JSON schema.
     It then validates the model path and JSON schema, and runs inference using the provided model and prompt, constrained by the JSON schema.
+    With the `batch` subcommand, the prompts and JSON schemas are read from a JSONL file instead (see batch.py).
     """
+    if sys.argv[1:2] == ["batch"]:
+        import batch
+        batch.cli(sys.argv[2:])
+        return
     parser = argparse.ArgumentParser()
     parser.add_argument("--model-path", type=str, required=True, help="Path to the LLM model in gguf format")
     parser.add_argument("--prompt", type=str, required=True, help="Input prompt")
     parser.add_argument("--json-schema", type=str, help="JSON schema to enforce")
+    parser.add_argument("--compiled-schema-cache-dir", type=str, help="Directory where the JSON schema compiled for the model is cached")
+    parser.add_argument("--prompt-cache-dir", type=str, help="Directory where the states of the evaluated prompts are cached")
+    parser.add_argument("--prompt-cache-max-bytes", type=int, default=2**32, help="Maximum total size of the cached prompt states")
+    parser.add_argument("--trace-path", type=str, help="Path where the trace of the generation is saved (for benchmark.py --replay)")
+    parser.add_argument("--stats", action="store_true", help="Print the timing breakdown of the generation")
+    parser.add_argument("--max-tokens", type=int, default=200, help="Maximum number of generated tokens (the JSON is closed before)")
+    parser.add_argument("--pipelined", action="store_true", help="Overlap the evaluation of the model with the constraint work")
+    parser.add_argument("--native-grammar", action="store_true", help="Use the native grammar sampling of llama.cpp when the JSON schema is supported")
+    parser.add_argument("--draft-model-path", type=str, help="Path to a small draft model in gguf format (same vocabulary) for speculative decoding")
+    parser.add_argument("--n-draft", type=int, default=4, help="Maximum number of tokens drafted at each step")
+    parser.add_argument("--events", action="store_true", help="Print the events of the generated JSON (one json line each) instead of the text")
+    parser.add_argument("--n-best", type=int, help="Sample this number of outputs sharing the evaluation of the prompt (one per line)")
     args = parser.parse_args()
+    if args.n_best:
+        # The n-best generation only supports the JSON schema, its compiled cache and the token budget.
+        unsupported = {"--prompt-cache-dir": args.prompt_cache_dir, "--trace-path": args.trace_path, "--stats": args.stats,
+                       "--pipelined": args.pipelined, "--native-grammar": args.native_grammar,
+                       "--draft-model-path": args.draft_model_path, "--events": args.events}
+        for option, value in unsupported.items():
+            if value:
+                parser.error(f"{option} can not be used with --n-best")
 
     model_path = args.model_path
     string_json_schema = args.json_schema
@@ -69,16 +295,40 @@ def cli():
         print("Error: The JSON schema is not a valid json.")
         return
 
-    try:
-        Draft7Validator.check_schema(json_schema)
-    except Exception as e:
-        print(e)
-        print("Error: The JSON schema is not a valid json schema.")        
+    from jsonschema import Draft7Validator
+    error = schema_registry.validate(json_schema, Draft7Validator.check_schema)
+    if error is not None:
+        print(error)
+        print("Error: The JSON schema is not a valid json schema.")
         return
     
-    for chunk in run_inference_constrained_by_json_schema(model_path, json_schema, prompt):
-        print(chunk, end="", flush=True)
-    print("", flush=True)
+    prompt_cache = None
+    if args.prompt_cache_dir:
+        prompt_cache = PromptCache(max_bytes=args.prompt_cache_max_bytes, cache_dir=args.prompt_cache_dir)
+
+    trace = GenerationTrace() if args.trace_path else None
+    stats = GenerationStats() if args.stats else None
+    inference_kwargs = dict(compiled_schema_cache_dir=args.compiled_schema_cache_dir, prompt_cache=prompt_cache, trace=trace, stats=stats,
+                            native_grammar=args.native_grammar, max_tokens=args.max_tokens, pipelined=args.pipelined,
+                            draft_model_path=args.draft_model_path, n_draft=args.n_draft)
+    if args.n_best:
+        outputs = ["" for _ in range(args.n_best)]
+        for index, chunk in run_n_best_inference_constrained_by_json_schema(model_path, json_schema, prompt, args.n_best,
+                                                                             args.compiled_schema_cache_dir, args.max_tokens):
+            outputs[index] += chunk
+        for output in outputs:
+            print(output, flush=True)
+    elif args.events:
+        for event in run_inference_events_constrained_by_json_schema(model_path, json_schema, prompt, **inference_kwargs):
+            print(json.dumps(event), flush=True)
+    else:
+        for chunk in run_inference_constrained_by_json_schema(model_path, json_schema, prompt, **inference_kwargs):
+            print(chunk, end="", flush=True)
+        print("", flush=True)
+    if stats is not None:
+        print(json.dumps(stats.to_dict(), indent=2))
+    if trace is not None:
+        trace.save(args.trace_path)
 
 
 if __name__ == "__main__":
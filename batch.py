@@ -0,0 +1,177 @@
+import argparse
+import json
+import os
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Iterable, Iterator, Set, Tuple
+from schema_registry import schema_registry
+
+
+def read_requests(lines: Iterable[str]) -> Iterator[Tuple[int, dict]]:
+    """
+    This function reads the requests of a JSONL stream, one json object per line with a "prompt"
+    and optionally a "json_schema" and an "id" (copied in the result). Empty lines are skipped.
+
+    Yields:
+    tuple: The index of the request (its number among the non empty lines) and the request.
+        An invalid request is given as {"error": message}.
+    """
+    index = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict) or not isinstance(request.get("prompt"), str):
+                request = {"error": "The request must be a json object with a 'prompt' string."}
+        except ValueError:
+            request = {"error": "The line is not a valid json."}
+        yield index, request
+        index += 1
+
+
+def read_checkpoint(output_path: str) -> Set[int]:
+    """
+    This function returns the indices of the requests already written in an output file, to resume an interrupted job.
+    A last line which was not fully written is removed from the file.
+    """
+    if not os.path.exists(output_path):
+        return set()
+    with open(output_path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            data = data[:data.rfind(b"\n")+1]
+            f.truncate(len(data))
+    return {json.loads(line)["index"] for line in data.splitlines() if line.strip()}
+
+
+def run_requests(requests: Iterable[Tuple[int, dict]], generate: Callable[[int, dict], dict], write_result: Callable[[dict], None],
+                 n_workers: int = 1, ordered: bool = False, done_indices: Set[int] = None):
+    """
+    This function runs `generate(index, request)` for a stream of requests in `n_workers` threads, and writes the results.
+
+    Parameters:
+    requests (iterable): The (index, request) pairs, see read_requests. They are read as the workers get free.
+    generate (function): It returns the result of a request.
+    write_result (function): It is called with the result of each request.
+    n_workers (int): The number of requests run at the same time.
+    ordered (bool): If True, the results are written in the order of the requests, otherwise as soon as they are generated.
+    done_indices (set): The indices of the requests to skip (already done by an interrupted run, see read_checkpoint).
+    """
+    # The futures in the order of the requests, and the results waiting for the previous ones (ordered mode).
+    pending = deque()
+    finished = {}
+    with ThreadPoolExecutor(n_workers) as executor:
+        requests = iter(requests)
+        exhausted = False
+        while True:
+            # Keep the workers busy, without reading the whole input in advance.
+            while not exhausted and len(pending) < 2 * n_workers:
+                index, request = next(requests, (None, None))
+                if request is None:
+                    exhausted = True
+                elif done_indices is None or index not in done_indices:
+                    pending.append(executor.submit(generate, index, request))
+            if not pending:
+                break
+            done, _ = wait([future for future in pending if future not in finished], return_when=FIRST_COMPLETED)
+            if ordered:
+                finished.update((future, future.result()) for future in done)
+                while pending and pending[0] in finished:
+                    write_result(finished.pop(pending.popleft()))
+            else:
+                for future in done:
+                    pending.remove(future)
+                    write_result(future.result())
+
+
+def run_batch(model_path: str, requests: Iterable[Tuple[int, dict]], write_result: Callable[[dict], None], n_workers: int = 1,
+              ordered: bool = False, done_indices: Set[int] = None, compiled_schema_cache_dir: str = None, max_tokens: int = 200,
+              n_ctx: int = 0, n_threads: int = None):
+    """
+    This function runs the generations of a stream of requests with one model, loaded once.
+    The generations are spread over `n_workers` contexts of the model, run in parallel threads.
+
+    Parameters:
+    model_path (str): The path to the LLM model in gguf format.
+    requests (iterable): The (index, request) pairs, see read_requests. They are read as the workers get free.
+    write_result (function): It is called with the result of each request: {"index", "id" (if set), "output"} or {"index", "id", "error"}.
+    n_workers, ordered, done_indices: See run_requests.
+    compiled_schema_cache_dir, max_tokens: See run_inference_constrained_by_json_schema.
+    n_ctx, n_threads: The settings of each context, see new_context.
+    """
+    # The model dependencies are only imported to generate, so the reading and the ordering of the requests work without them.
+    from jsonschema import Draft7Validator
+    from LLM_json_schema import run_inference_constrained_by_json_schema
+    from llama_cpp_wrapper.python_llama_cpp.model_utils import get_model, get_context_pool
+
+    context_pool = get_context_pool(get_model(model_path), n_workers, n_ctx, n_threads=n_threads)
+
+    def generate(index: int, request: dict) -> dict:
+        result = {"index": index}
+        if "id" in request:
+            result["id"] = request["id"]
+        error = request.get("error")
+        json_schema = request.get("json_schema")
+        if error is None and json_schema is not None:
+            error = schema_registry.validate(json_schema, Draft7Validator.check_schema)
+            if error is not None:
+                error = f"The JSON schema is not a valid json schema: {error}"
+        if error is not None:
+            result["error"] = error
+            return result
+        try:
+            result["output"] = "".join(run_inference_constrained_by_json_schema(
+                model_path, json_schema, request["prompt"], compiled_schema_cache_dir, context_pool=context_pool, max_tokens=max_tokens))
+        except Exception as e:
+            result["error"] = str(e)
+        return result
+
+    run_requests(requests, generate, write_result, n_workers, ordered, done_indices)
+
+
+def cli(argv=None):
+    """
+    Command Line Interface to run the generations of a JSONL file of requests (`LLM_json_schema.py batch ...`).
+    """
+    parser = argparse.ArgumentParser(prog="LLM_json_schema.py batch")
+    parser.add_argument("--model-path", type=str, required=True, help="Path to the LLM model in gguf format")
+    parser.add_argument("--input", type=str, default="-", help="JSONL file of the requests ({\"prompt\", \"json_schema\", \"id\"} per line, - for stdin)")
+    parser.add_argument("--output", type=str, default="-", help="JSONL file of the results (- for stdout)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of generations run at the same time (one context each)")
+    parser.add_argument("--ordered", action="store_true", help="Write the results in the order of the requests (otherwise as soon as they are generated)")
+    parser.add_argument("--resume", action="store_true", help="Skip the requests already written in the output file, and append the new results")
+    parser.add_argument("--compiled-schema-cache-dir", type=str, help="Directory where the JSON schemas compiled for the model are cached")
+    parser.add_argument("--max-tokens", type=int, default=200, help="Maximum number of generated tokens per request")
+    parser.add_argument("--n-ctx", type=int, default=0, help="Size of each context in tokens (0: training context size of the model)")
+    parser.add_argument("--threads", type=int, help="Number of threads of each context")
+    args = parser.parse_args(argv)
+
+    if args.resume and args.output == "-":
+        parser.error("--resume needs an --output file")
+    if not os.path.exists(args.model_path):
+        print("Error: The model path does not exist.")
+        return
+
+    done_indices = read_checkpoint(args.output) if args.resume else None
+    input_file = sys.stdin if args.input == "-" else open(args.input)
+    output_file = sys.stdout if args.output == "-" else open(args.output, "a" if args.resume else "w")
+
+    def write_result(result: dict):
+        # Each result is flushed, so the output file is the checkpoint of the job.
+        output_file.write(json.dumps(result) + "\n")
+        output_file.flush()
+
+    try:
+        run_batch(args.model_path, read_requests(input_file), write_result, args.workers, args.ordered, done_indices,
+                  args.compiled_schema_cache_dir, args.max_tokens, args.n_ctx, args.threads)
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+        if output_file is not sys.stdout:
+            output_file.close()
+
+
+if __name__ == "__main__":
+    cli()
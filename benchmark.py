@@ -0,0 +1,252 @@
+import argparse
+import json
+import time
+import tracemalloc
+from typing import List
+import numpy as np
+from constrainers import JsonSchemaConstrainer, CompiledJsonSchemaConstrainer, end_token
+from compiled_json_schema_constraint import CompiledJsonSchemaIndex
+from llama_cpp_wrapper.python_llama_cpp.vocab_utils import TokenPrefixIndex, Vocab
+from llama_cpp_wrapper.python_llama_cpp.constraint_utils import adjust_logits_based_on_suggestions, forced_prefix, to_byte_completions
+from llama_cpp_wrapper.python_llama_cpp.generation_trace import GenerationTrace
+from llama_cpp_wrapper.python_llama_cpp.generation_stats import GenerationStats
+
+# Pieces found in the vocabularies of real models, which make the generated JSON progress.
+_JSON_PIECES = ['"', '",', '":', '"}', '"]', ' "', ', "', '{', '}', '[', ']', ',', ', ', ':', ' ', '.', '-', 'e',
+                'true', 'false', ' true', ' false', '{"', '["', '[{', '}]', '},', '}}', ']]', '],', '\\', '\\"']
+
+
+def synthetic_vocab(n_vocab: int, seed: int = 0) -> Vocab:
+    """
+    This function creates a deterministic vocabulary of the given size, which looks like the vocabulary of a model:
+    the 256 bytes, JSON punctuation, numbers, and words with or without a leading space.
+    """
+    rng = np.random.default_rng(seed)
+    pieces = [bytes([i]) for i in range(256)]
+    pieces += [piece.encode() for piece in _JSON_PIECES] + [str(i).encode() for i in range(10, 1000)]
+    known = set(pieces)
+    letters = np.frombuffer(b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ", dtype=np.uint8)
+    while len(pieces) < n_vocab:
+        word = letters[rng.integers(0, len(letters), rng.integers(1, 10))].tobytes()
+        if rng.random() < 0.5:
+            word = b" " + word
+        if word not in known:
+            known.add(word)
+            pieces.append(word)
+    return Vocab.from_pieces(pieces[:n_vocab])
+
+
+class FakeBackend:
+    """
+    This is a deterministic stand-in for the model: the logits only depend on the evaluated tokens.
+    They are drawn from a few precomputed rows, so producing them costs (almost) nothing compared to the constraint work.
+    The tokens closing strings get a bias, so the generated JSON goes forward instead of staying in one long string,
+    and the arrays are not closed, so the length of the output is set by n_predict.
+    """
+    def __init__(self, vocab: Vocab, seed: int = 0, n_rows: int = 64, closing_bias: float = 2.0):
+        rng = np.random.default_rng(seed)
+        self.rows = rng.standard_normal((n_rows, len(vocab)), dtype=np.float32)
+        closing = np.fromiter((b'"' in piece or b"," in piece for piece in vocab), dtype=bool, count=len(vocab))
+        self.rows[:, closing] += closing_bias
+        self.rows[:, np.fromiter((b"]" in piece for piece in vocab), dtype=bool, count=len(vocab))] = -1e4
+        self.logits = np.empty(len(vocab), dtype=np.float32)
+
+    def eval(self, tokens: List[int]) -> np.ndarray:
+        row = (len(tokens) * 31 + (tokens[-1] if tokens else 0)) % len(self.rows)
+        np.copyto(self.logits, self.rows[row])
+        return self.logits
+
+
+def nested_schema(depth: int) -> dict:
+    """
+    This function returns a schema of the given depth, alternating objects and arrays.
+    """
+    if depth <= 1:
+        return {"type": "object", "properties": {"name": {"type": "string"}, "value": {"type": "number"}, "valid": {"type": "boolean"}}}
+    return {"type": "object", "properties": {"name": {"type": "string"}, "children": {"type": "array", "items": nested_schema(depth - 1)}}}
+
+
+def fake_model(vocab: Vocab, seed: int = 0):
+    """
+    This function returns a fake model of the vocabulary (see fake_llama_cpp), whose logits are given by a FakeBackend.
+    The llama_cpp module is replaced by fake_llama_cpp, so the generation loops of llama_cpp_wrapper run on the fake model.
+    """
+    import fake_llama_cpp
+    fake_llama_cpp.install()
+    return fake_llama_cpp.FakeModel(vocab, FakeBackend(vocab, seed))
+
+
+def generate(constrainer, model, n_predict: int, seed: int = 0, stats: GenerationStats = None, allocations: List[int] = None) -> str:
+    """
+    This function generates a text with do_inference (and its sampling) on a fake model, in a new context.
+
+    Parameters:
+    constrainer: The constrainer (JsonSchemaConstrainer or CompiledJsonSchemaConstrainer).
+    model (fake_llama_cpp.FakeModel): The fake model, see fake_model.
+    n_predict (int): The maximum number of generated tokens (sampled and forced), the JSON value is closed before the end of the budget.
+    seed (int): The seed of the sampling.
+    stats (GenerationStats): If set, the timing breakdown of the generation is recorded in it
+        (the constraint work is the completion callback, the masking and sampling are done by sample_next_token).
+    allocations (list): If set (and tracemalloc is started), the peak memory allocated by each call of the completion callback is appended to it.
+
+    Returns:
+    str: The generated text.
+    """
+    import llama_cpp
+    from llama_cpp_wrapper.python_llama_cpp.inference_with_completion import do_inference
+    from llama_cpp_wrapper.python_llama_cpp.context_resources import free_context_resources
+
+    def completion_callback(new_text: str):
+        if allocations is not None:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        suggestions = to_byte_completions(constrainer.compute_next_completion(new_text))
+        if allocations is not None:
+            allocations.append(tracemalloc.get_traced_memory()[1] - start_memory)
+        return suggestions
+
+    def closing_callback():
+        closing_text = constrainer.closing_text()
+        return None if closing_text is None else (closing_text + end_token).encode()
+
+    context_params = llama_cpp.llama_context_default_params()
+    context_params.seed = seed
+    # The closing text can exceed the budget.
+    context_params.n_ctx = n_predict + 256
+    ctx = llama_cpp.llama_new_context_with_model(model, context_params)
+    text = ""
+    try:
+        for chunk in do_inference(b"Hi", model=model, ctx=ctx, completion_callback=completion_callback, verbose=False, stats=stats,
+                                  incremental_callback=True, n_predict=n_predict, closing_callback=closing_callback):
+            if end_token in chunk:
+                text += chunk[:chunk.index(end_token)]
+                break
+            text += chunk
+    finally:
+        free_context_resources(ctx)
+        llama_cpp.llama_free(ctx)
+    return text
+
+
+def summarize(durations: List[float]) -> dict:
+    if not durations:
+        return {}
+    us = np.array(durations) * 1e6
+    return {"mean_us": float(us.mean()), "p50_us": float(np.percentile(us, 50)), "p99_us": float(np.percentile(us, 99))}
+
+
+def benchmark_generation(json_schema: dict, model, n_predict: int, compiled_index: CompiledJsonSchemaIndex = None, n_runs: int = 3) -> dict:
+    """
+    Returns:
+    dict: The per-token latencies of each stage, the forced and sampled token counts, and the allocations of the constraint work per token.
+    """
+    max_token_length = model.prefix_index.max_piece_length
+    def new_constrainer():
+        if compiled_index is not None:
+            return CompiledJsonSchemaConstrainer(json_schema, compiled_index, max_token_length=max_token_length)
+        return JsonSchemaConstrainer(json_schema, max_token_length)
+    # Warm up the caches (regexp masks...)
+    generate(new_constrainer(), model, n_predict)
+    runs = []
+    generated_length = 0
+    for run in range(n_runs):
+        stats = GenerationStats()
+        generated_length += len(generate(new_constrainer(), model, n_predict, run, stats))
+        runs.append(stats)
+    allocations = []
+    tracemalloc.start()
+    try:
+        generate(new_constrainer(), model, n_predict, 0, allocations=allocations)
+    finally:
+        tracemalloc.stop()
+    return {
+        "constraint": summarize([t for stats in runs for t in stats.callback_times]),
+        "mask": summarize([t for stats in runs for t in stats.mask_times]),
+        "sample": summarize([t for stats in runs for t in stats.sample_times]),
+        "forced_tokens": sum(stats.n_forced_tokens for stats in runs) / n_runs,
+        "sampled_tokens": sum(stats.n_sampled_tokens for stats in runs) / n_runs,
+        "generated_chars": generated_length / n_runs,
+        "peak_alloc_bytes_per_token": float(np.mean(allocations)) if allocations else 0.0,
+    }
+
+
+def replay(trace: GenerationTrace, prefix_index: TokenPrefixIndex) -> dict:
+    """
+    This function replays the constraint work of a recorded generation: the constrainer is given the recorded histories,
+    and its suggestions are turned into masks of the given vocabulary.
+
+    Returns:
+    dict: The latencies of the constraint and mask stages, and the number of steps whose suggestions differ from the recorded ones.
+    """
+    constrainer = JsonSchemaConstrainer(trace.json_schema, prefix_index.max_piece_length)
+    logits = np.zeros(len(prefix_index.vocab), dtype=np.float32)
+    timings = {"constraint": [], "mask": []}
+    n_different = 0
+    for step in trace.steps:
+        history = step["history"]
+        history = history[history.find(trace.prompt)+len(trace.prompt):]
+        t0 = time.perf_counter()
+        completions = constrainer.compute_completion(history)
+        suggestions = to_byte_completions(completions)
+        t1 = time.perf_counter()
+        if suggestions is not None and not forced_prefix(suggestions):
+            logits.fill(0.0)
+            adjust_logits_based_on_suggestions(suggestions, logits, prefix_index)
+        t2 = time.perf_counter()
+        timings["constraint"].append(t1 - t0)
+        timings["mask"].append(t2 - t1)
+        recorded = step["suggestions"]
+        if isinstance(recorded, list):
+            replayed = [{"regexp": c.pattern} if hasattr(c, "pattern") else {"text": c} for c in completions or []]
+            n_different += replayed != recorded
+    return {"steps": len(trace.steps), "constraint": summarize(timings["constraint"]), "mask": summarize(timings["mask"]),
+            "different_suggestions": n_different}
+
+
+def cli():
+    """
+    Command Line Interface of the benchmarks of the constraint engine, which run the generation loop without a model.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocab-sizes", type=int, nargs="+", default=[32000, 128000], help="Sizes of the synthetic vocabularies")
+    parser.add_argument("--n-predict", type=int, nargs="+", default=[50, 200, 800], help="Output lengths (sampled and forced tokens)")
+    parser.add_argument("--depths", type=int, nargs="+", default=[1, 2, 4, 8], help="Depths of the nested schemas")
+    parser.add_argument("--n-runs", type=int, default=3, help="Number of generations per configuration")
+    parser.add_argument("--compiled", action="store_true", help="Benchmark the compiled schemas instead of the incremental parser")
+    parser.add_argument("--replay", type=str, nargs="*", default=[], help="Traces recorded with LLM_json_schema.py --trace-path to replay")
+    parser.add_argument("--vocab", type=str, help="Vocabulary cache of a model (.vocab file next to the model) used to replay the traces")
+    parser.add_argument("--json", type=str, help="Path where the results are saved as json")
+    args = parser.parse_args()
+
+    results = {"generation": [], "replay": []}
+    for n_vocab in args.vocab_sizes:
+        model = fake_model(synthetic_vocab(n_vocab))
+        for depth in args.depths:
+            json_schema = nested_schema(depth)
+            compiled_index = CompiledJsonSchemaIndex.compile(json_schema, model.prefix_index) if args.compiled else None
+            for n_predict in args.n_predict:
+                result = benchmark_generation(json_schema, model, n_predict, compiled_index, args.n_runs)
+                result.update({"n_vocab": n_vocab, "depth": depth, "n_predict": n_predict})
+                results["generation"].append(result)
+                print(f"vocab={n_vocab:>6} depth={depth} n_predict={n_predict:>4} | "
+                      f"constraint {result['constraint'].get('mean_us', 0):8.1f}us "
+                      f"mask {result['mask'].get('mean_us', 0):8.1f}us "
+                      f"sample {result['sample'].get('mean_us', 0):8.1f}us | "
+                      f"forced {result['forced_tokens']:.0f} sampled {result['sampled_tokens']:.0f} | "
+                      f"alloc {result['peak_alloc_bytes_per_token']/1024:.1f}KiB/token", flush=True)
+    if args.replay:
+        vocab = Vocab.load(args.vocab) if args.vocab else synthetic_vocab(args.vocab_sizes[0])
+        prefix_index = TokenPrefixIndex(vocab)
+        for path in args.replay:
+            result = replay(GenerationTrace.load(path), prefix_index)
+            result["trace"] = path
+            results["replay"].append(result)
+            print(f"replay {path}: {result['steps']} steps | constraint {result['constraint'].get('mean_us', 0):.1f}us "
+                  f"mask {result['mask'].get('mean_us', 0):.1f}us | different suggestions {result['different_suggestions']}", flush=True)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    cli()
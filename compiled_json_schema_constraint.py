@@ -0,0 +1,162 @@
+import json
+import os
+from typing import List, Dict, Union
+import numpy as np
+from incremental_json_schema_constraint import IncrementalJsonSchemaParser
+from schema_registry import schema_hash
+from llama_cpp_wrapper.python_llama_cpp.constraint_utils import forced_prefix
+
+# Increase it when the parser states or the file format change, so old compiled indexes are not reused.
+COMPILED_INDEX_VERSION = 5
+
+
+def _to_tuple(key):
+    if isinstance(key, list):
+        return tuple(_to_tuple(k) for k in key)
+    return key
+
+
+class CompiledJsonSchemaIndex:
+    """
+    This is a JSON schema compiled for the vocabulary of a model.
+    It maps every parser state reachable during generation to the set of allowed tokens
+    (stored as a packed bit mask), or to the text to force when there is only one suggestion.
+    When there are several suggestions, the prefix they share is kept as well, to jump forward over it.
+    """
+    def __init__(self, state_keys: List[tuple], forced_texts: List[Union[str, None]], shared_prefixes: List[Union[str, None]],
+                 packed_masks: np.ndarray, n_vocab: int):
+        self.state_keys = state_keys
+        self.state_ids: Dict[tuple, int] = {key: i for i, key in enumerate(state_keys)}
+        self.forced_texts = forced_texts
+        self.shared_prefixes = shared_prefixes
+        self.packed_masks = packed_masks
+        self.n_vocab = n_vocab
+        # The ids of the allowed tokens of the states already used, unpacked once per state.
+        self.token_ids: Dict[int, np.ndarray] = {}
+
+    def allowed_token_mask(self, state_id: int) -> np.ndarray:
+        """
+        Returns:
+        np.ndarray: Boolean mask of the allowed tokens in the given state.
+        """
+        return np.unpackbits(self.packed_masks[state_id], count=self.n_vocab).view(bool)
+
+    def allowed_token_ids(self, state_id: int) -> np.ndarray:
+        """
+        Returns:
+        np.ndarray: The sorted ids (read-only) of the allowed tokens in the given state. They are computed once per state.
+        """
+        token_ids = self.token_ids.get(state_id)
+        if token_ids is None:
+            token_ids = np.flatnonzero(self.allowed_token_mask(state_id)).astype(np.intc)
+            token_ids.flags.writeable = False
+            self.token_ids[state_id] = token_ids
+        return token_ids
+
+    @staticmethod
+    def compile(json_schema, prefix_index) -> "CompiledJsonSchemaIndex":
+        """
+        This function explores all the parser states reachable with the tokens allowed by the suggestions,
+        and computes the mask of allowed tokens of each state.
+
+        Parameters:
+        json_schema (dict): The JSON schema to enforce.
+        prefix_index (TokenPrefixIndex): The index of the vocabulary of the model.
+        """
+        vocab = prefix_index.vocab
+        texts = [piece.decode("utf-8", errors="replace") for piece in vocab]
+        # The strings with more characters left than the longest token share the mask of ongoing_string_regexp.
+        parser = IncrementalJsonSchemaParser(json_schema, prefix_index.max_piece_length)
+        parsers = [parser]
+        state_keys = [parser.state_key()]
+        state_ids = {state_keys[0]: 0}
+        forced_texts = []
+        shared_prefixes = []
+        packed_masks = []
+        empty_mask = np.zeros((len(vocab)+7)//8, dtype=np.uint8)
+        # parsers grows while it is explored (breadth first).
+        for parser in parsers:
+            completions = parser.completions()
+            if len(completions) == 1 and type(completions[0]) is str:
+                forced_texts.append(completions[0])
+                shared_prefixes.append(None)
+                packed_masks.append(empty_mask)
+                next_texts = completions
+            else:
+                forced_texts.append(None)
+                suggestions = [c.encode() if type(c) is str else c for c in completions]
+                shared_prefix = forced_prefix(suggestions).decode() or None
+                shared_prefixes.append(shared_prefix)
+                mask = prefix_index.compute_allowed_token_mask(suggestions)
+                packed_masks.append(np.packbits(mask))
+                next_texts = dict.fromkeys(texts[token_id] for token_id in np.flatnonzero(mask))
+                # The states after the jump forward are reached as well.
+                if shared_prefix is not None:
+                    next_texts[shared_prefix] = None
+            for text in next_texts:
+                next_parser = parser.copy()
+                next_parser.feed(text)
+                if next_parser.error:
+                    continue
+                key = next_parser.state_key()
+                if key not in state_ids:
+                    state_ids[key] = len(state_keys)
+                    state_keys.append(key)
+                    parsers.append(next_parser)
+        return CompiledJsonSchemaIndex(state_keys, forced_texts, shared_prefixes, np.stack(packed_masks), len(vocab))
+
+    def save(self, path: str):
+        """
+        Save the index in two files: `path`.masks.npy (the packed masks) and `path`.states.json.
+        The files are written atomically, so concurrent workers can share a cache directory.
+        """
+        tmp_suffix = f".{os.getpid()}.tmp"
+        with open(path + ".masks.npy" + tmp_suffix, "wb") as f:
+            np.save(f, self.packed_masks)
+        with open(path + ".states.json" + tmp_suffix, "w") as f:
+            json.dump({"n_vocab": self.n_vocab, "state_keys": self.state_keys, "forced_texts": self.forced_texts,
+                       "shared_prefixes": self.shared_prefixes}, f)
+        os.replace(path + ".masks.npy" + tmp_suffix, path + ".masks.npy")
+        os.replace(path + ".states.json" + tmp_suffix, path + ".states.json")
+
+    @staticmethod
+    def load(path: str) -> "CompiledJsonSchemaIndex":
+        """
+        Load an index saved with `save`. The masks are memory-mapped, not read.
+        """
+        with open(path + ".states.json") as f:
+            states = json.load(f)
+        packed_masks = np.load(path + ".masks.npy", mmap_mode="r")
+        state_keys = [_to_tuple(key) for key in states["state_keys"]]
+        return CompiledJsonSchemaIndex(state_keys, states["forced_texts"], states["shared_prefixes"], packed_masks, states["n_vocab"])
+
+
+_compiled_indexes: Dict[str, CompiledJsonSchemaIndex] = {}
+
+def get_compiled_json_schema_index(json_schema, prefix_index, cache_dir: str) -> CompiledJsonSchemaIndex:
+    """
+    This function returns the index of a JSON schema compiled for a vocabulary.
+    It is loaded from the cache directory if it was already compiled (by this process or another one),
+    otherwise it is compiled and saved in the cache directory.
+
+    Parameters:
+    json_schema (dict): The JSON schema to enforce.
+    prefix_index (TokenPrefixIndex): The index of the vocabulary of the model.
+    cache_dir (str): The directory of the compiled indexes.
+
+    Returns:
+    CompiledJsonSchemaIndex: The compiled index.
+    """
+    name = f"{schema_hash(json_schema)}_{prefix_index.vocab_hash()}_v{COMPILED_INDEX_VERSION}"
+    compiled_index = _compiled_indexes.get(name)
+    if compiled_index is not None:
+        return compiled_index
+    path = os.path.join(cache_dir, name)
+    if os.path.exists(path + ".states.json") and os.path.exists(path + ".masks.npy"):
+        compiled_index = CompiledJsonSchemaIndex.load(path)
+    else:
+        compiled_index = CompiledJsonSchemaIndex.compile(json_schema, prefix_index)
+        os.makedirs(cache_dir, exist_ok=True)
+        compiled_index.save(path)
+    _compiled_indexes[name] = compiled_index
+    return compiled_index
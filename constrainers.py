@@ -1,5 +1,10 @@
+import copy
 from typing import Union, List
 import json_schema_constraint
+from incremental_json_schema_constraint import IncrementalJsonSchemaParser
+from compiled_json_schema_constraint import CompiledJsonSchemaIndex
+from json_schema_gbnf import get_gbnf
+import numpy as np
 
 end_token = json_schema_constraint.end_token
 
@@ -15,10 +20,80 @@ class JsonSchemaConstrainer:
     """
     This is a class for constraining JSON schemas. 
     A JsonSchemaConstrainer is an object that can compute a completion (suggestions) for an incomplete string based on a given JSON schema.
+    It keeps the state of an incremental parser, so only the text appended since the previous call is parsed.
+    max_token_length is the length of the longest token piece of the vocabulary, if known (see IncrementalJsonSchemaParser).
     """
-    def __init__(self, json_schema):
+    def __init__(self, json_schema, max_token_length: int = None):
         self.json_schema = json_schema
+        self.parser = IncrementalJsonSchemaParser(json_schema, max_token_length)
+        self.parsed_string = ""
+    def advance(self, incomplete_string: str):
+        """
+        Update the parser state with the text appended since the previous call.
+        """
+        if self.parsed_string is None or not incomplete_string.startswith(self.parsed_string):
+            # The history was rewritten, restart from scratch.
+            self.parser.reset()
+            self.parsed_string = ""
+        self.parser.feed(incomplete_string[len(self.parsed_string):])
+        self.parsed_string = incomplete_string
+    def extend(self, new_text: str):
+        """
+        Update the parser state with the text appended since the previous call, given alone.
+        The whole string is not kept, so a later call of `advance` restarts from scratch.
+        """
+        self.parser.feed(new_text)
+        self.parsed_string = None
+    def completions(self):
+        return self.parser.completions()
+    def copy(self) -> "JsonSchemaConstrainer":
+        """
+        Returns an independent copy of the constrainer in its current state (e.g. to try a continuation and roll it back).
+        """
+        other = copy.copy(self)
+        other.parser = self.parser.copy()
+        return other
     def compute_completion(self, incomplete_string: str) -> Union[str, List[str], None]:
-        return json_schema_constraint.auto_complete(incomplete_string, self.json_schema)
+        self.advance(incomplete_string)
+        return self.completions()
+    def compute_next_completion(self, new_text: str) -> Union[str, List[str], None]:
+        """
+        Same as compute_completion, but only given the text appended since the previous call.
+        """
+        self.extend(new_text)
+        return self.completions()
+    def closing_text(self) -> Union[str, None]:
+        """
+        Returns the shortest text which ends the JSON value from the current state, or None if the text does not follow the schema.
+        """
+        return self.parser.closing_text()
+    def to_gbnf(self) -> Union[str, None]:
+        """
+        Returns the GBNF grammar of the schema for the native grammar sampling of llama.cpp,
+        or None if the schema is not supported (then this constrainer must be used).
+        """
+        return get_gbnf(self.json_schema)
+
+class CompiledJsonSchemaConstrainer(JsonSchemaConstrainer):
+    """
+    This is a JsonSchemaConstrainer using a schema compiled ahead of time for the vocabulary of a model.
+    Instead of suggestions, it directly returns the precomputed ids of the allowed tokens for the current parser state
+    (suggestions are still returned for forced text, and for states missing from the compiled index).
+    With jump_forward, the prefix shared by all the suggestions of the state is returned as the forced text.
+    """
+    def __init__(self, json_schema, compiled_index: CompiledJsonSchemaIndex, jump_forward: bool = True, max_token_length: int = None):
+        super().__init__(json_schema, max_token_length)
+        self.compiled_index = compiled_index
+        self.jump_forward = jump_forward
+    def completions(self) -> Union[List[str], np.ndarray, None]:
+        state_id = self.compiled_index.state_ids.get(self.parser.state_key())
+        if state_id is None:
+            return self.parser.completions()
+        forced_text = self.compiled_index.forced_texts[state_id]
+        if forced_text is None and self.jump_forward:
+            forced_text = self.compiled_index.shared_prefixes[state_id]
+        if forced_text is not None:
+            return [forced_text]
+        return self.compiled_index.allowed_token_ids(state_id)
     
 
@@ -0,0 +1,395 @@
+"""
+This module is a stand-in for the llama_cpp package, with the functions used by llama_cpp_wrapper.
+The real generation loops (do_inference, do_batched_inference, do_speculative_inference...) run on it without a model:
+the logits of a token are given by a backend (see benchmark.FakeBackend) from the tokens of its sequence in the KV cache,
+and the samplers work like the ones of llama.cpp on the candidates buffer. The KV cache is checked: a token can only be
+evaluated after the previous positions of its sequence, so a sequence whose KV cache is wrongly copied or removed fails.
+The grammars are accepted but not enforced.
+
+Call install() before importing llama_cpp_wrapper, or to replace llama_cpp in the modules already imported.
+"""
+import ctypes
+import sys
+import threading
+from typing import Dict, List, Sequence
+import numpy as np
+from llama_cpp_wrapper.python_llama_cpp.vocab_utils import TokenPrefixIndex
+
+llama_token = ctypes.c_int32
+llama_token_p = ctypes.POINTER(llama_token)
+
+
+class llama_token_data(ctypes.Structure):
+    _fields_ = [("id", llama_token), ("logit", ctypes.c_float), ("p", ctypes.c_float)]
+
+
+llama_token_data_p = ctypes.POINTER(llama_token_data)
+
+
+class llama_token_data_array(ctypes.Structure):
+    _fields_ = [("data", llama_token_data_p), ("size", ctypes.c_size_t), ("sorted", ctypes.c_bool)]
+
+
+_token_data_dtype = np.dtype([("id", np.intc), ("logit", np.single), ("p", np.single)], align=True)
+
+
+class llama_model_params:
+    pass
+
+
+class llama_context_params:
+    def __init__(self):
+        self.seed = 0
+        self.n_ctx = 512
+        self.n_batch = 512
+        self.n_threads = 1
+        self.n_threads_batch = 1
+
+
+class FakeModel:
+    """
+    This is the model: a vocabulary, and a backend giving the logits after a sequence of tokens (backend.eval(tokens)).
+    With add_space_prefix, llama_tokenize adds a space before the text, like the SentencePiece tokenizers.
+    """
+    def __init__(self, vocab: Sequence[bytes], backend, n_ctx_train: int = 4096, bos: int = 1, eos: int = 2, add_space_prefix: bool = False):
+        self.vocab = vocab
+        self.backend = backend
+        self.n_ctx_train = n_ctx_train
+        self.bos = bos
+        self.eos = eos
+        self.add_space_prefix = add_space_prefix
+        self.prefix_index = TokenPrefixIndex(vocab)
+
+    def tokenize(self, text: bytes, add_bos: bool) -> List[int]:
+        if self.add_space_prefix:
+            text = b" " + text
+        tokens = self.prefix_index.tokenize_greedy(text)
+        if tokens is None:
+            raise ValueError(f"The text can not be tokenized with the vocabulary: {text!r}")
+        return [self.bos] + tokens if add_bos else tokens
+
+
+class FakeContext:
+    """
+    This is the context: a KV cache of n_ctx cells (position, token and sequence ids), and the logits of the last decode call.
+    n_evaluating is the number of evaluations running (to check that none outlives a generation).
+    """
+    def __init__(self, model: FakeModel, params: llama_context_params):
+        self.model = model
+        self.n_ctx = params.n_ctx or model.n_ctx_train
+        self.n_batch = params.n_batch
+        self.rng = np.random.default_rng(params.seed)
+        self.cells: List[list] = [None] * self.n_ctx
+        self.logits = np.empty((0, len(model.vocab)), dtype=np.float32)
+        self.logits_rows: Dict[int, int] = {}
+        self.n_evaluating = 0
+        self.freed = False
+        self.lock = threading.Lock()
+
+    def check(self):
+        if self.freed:
+            raise RuntimeError("The context is freed")
+
+    def sequence_tokens(self, seq_id: int, pos: int) -> List[int]:
+        """
+        Returns the tokens of the positions 0 to pos-1 of a sequence.
+        """
+        tokens = [None] * pos
+        for cell in self.cells:
+            if cell is not None and seq_id in cell[2] and cell[0] < pos:
+                tokens[cell[0]] = cell[1]
+        if None in tokens:
+            raise RuntimeError(f"The position {tokens.index(None)} of the sequence {seq_id} is not in the KV cache")
+        return tokens
+
+
+class llama_batch:
+    def __init__(self, n_tokens: int, n_seq_max: int):
+        self.n_tokens = 0
+        self.token = [0] * n_tokens
+        self.pos = [0] * n_tokens
+        self.n_seq_id = [0] * n_tokens
+        self.seq_id = [[0] * n_seq_max for _ in range(n_tokens)]
+        self.logits = [False] * n_tokens
+
+
+class LlamaGrammar:
+    """
+    The grammars are kept as text, the sampling is not constrained by them.
+    """
+    def __init__(self, text: str):
+        self.text = text
+        self.grammar = self
+
+    @classmethod
+    def from_string(cls, grammar: str, verbose: bool = True) -> "LlamaGrammar":
+        return cls(grammar)
+
+    def reset(self):
+        pass
+
+
+_models: Dict[str, FakeModel] = {}
+
+
+def register_model(model_path: str, model: FakeModel):
+    """
+    Makes llama_load_model_from_file load this model from this path.
+    """
+    _models[model_path] = model
+
+
+def install():
+    """
+    Makes `import llama_cpp` import this module, and replaces llama_cpp in the llama_cpp_wrapper modules already imported.
+    """
+    module = sys.modules[__name__]
+    sys.modules["llama_cpp"] = module
+    for name, imported in list(sys.modules.items()):
+        if name.startswith("llama_cpp_wrapper.") and hasattr(imported, "llama_cpp"):
+            imported.llama_cpp = module
+
+
+def llama_backend_init(numa: bool = False):
+    pass
+
+
+def llama_model_default_params() -> llama_model_params:
+    return llama_model_params()
+
+
+def llama_context_default_params() -> llama_context_params:
+    return llama_context_params()
+
+
+def llama_load_model_from_file(path_model: bytes, params: llama_model_params) -> FakeModel:
+    return _models.get(path_model.decode("utf-8"))
+
+
+def llama_new_context_with_model(model: FakeModel, params: llama_context_params) -> FakeContext:
+    return FakeContext(model, params)
+
+
+def llama_free(ctx: FakeContext):
+    ctx.check()
+    ctx.freed = True
+    ctx.cells = None
+
+
+def llama_n_vocab(model: FakeModel) -> int:
+    return len(model.vocab)
+
+
+def llama_n_ctx(ctx: FakeContext) -> int:
+    return ctx.n_ctx
+
+
+def llama_token_eos(ctx: FakeContext) -> int:
+    return ctx.model.eos
+
+
+def llama_token_bos(ctx: FakeContext) -> int:
+    return ctx.model.bos
+
+
+def llama_token_to_piece(model: FakeModel, token, buf, length: int) -> int:
+    piece = model.vocab[token.value if isinstance(token, llama_token) else token]
+    if len(piece) > length:
+        return -len(piece)
+    ctypes.memmove(buf, piece, len(piece))
+    return len(piece)
+
+
+def llama_tokenize(model: FakeModel, text: bytes, text_len: int, tokens, n_max_tokens: int, add_bos: bool) -> int:
+    token_ids = model.tokenize(text[:text_len], add_bos)
+    if len(token_ids) > n_max_tokens:
+        return -len(token_ids)
+    for i, token_id in enumerate(token_ids):
+        tokens[i] = token_id
+    return len(token_ids)
+
+
+def llama_batch_init(n_tokens: int, embd: int, n_seq_max: int) -> llama_batch:
+    return llama_batch(n_tokens, n_seq_max)
+
+
+def llama_batch_free(batch: llama_batch):
+    pass
+
+
+def llama_decode(ctx: FakeContext, batch: llama_batch) -> int:
+    """
+    Adds the tokens of the batch to the KV cache, and computes the logits of the tokens which need them.
+    Returns 1 if the KV cache has not enough free cells, like llama_decode.
+    """
+    ctx.check()
+    with ctx.lock:
+        ctx.n_evaluating += 1
+    try:
+        free_cells = [i for i, cell in enumerate(ctx.cells) if cell is None]
+        if len(free_cells) < batch.n_tokens:
+            return 1
+        for i in range(batch.n_tokens):
+            seq_ids = set(batch.seq_id[i][:batch.n_seq_id[i]])
+            for j in range(i):
+                if batch.pos[j] == batch.pos[i] and seq_ids & set(batch.seq_id[j][:batch.n_seq_id[j]]):
+                    raise RuntimeError(f"The position {batch.pos[i]} is twice in the batch")
+            for cell in ctx.cells:
+                if cell is not None and cell[0] == batch.pos[i] and seq_ids & cell[2]:
+                    raise RuntimeError(f"The position {batch.pos[i]} is already in the KV cache")
+            ctx.cells[free_cells[i]] = [batch.pos[i], batch.token[i], seq_ids]
+        # A token sees the previous positions of its sequence (including the ones of the batch).
+        outputs = [i for i in range(batch.n_tokens) if batch.logits[i]]
+        histories = [ctx.sequence_tokens(batch.seq_id[i][0], batch.pos[i]) + [batch.token[i]] for i in outputs]
+        if len(ctx.logits) < len(outputs):
+            ctx.logits = np.empty((len(outputs), len(ctx.model.vocab)), dtype=np.float32)
+        ctx.logits_rows = {}
+        for row, (i, tokens) in enumerate(zip(outputs, histories)):
+            ctx.logits[row] = ctx.model.backend.eval(tokens)
+            ctx.logits_rows[i] = row
+        return 0
+    finally:
+        with ctx.lock:
+            ctx.n_evaluating -= 1
+
+
+def llama_eval(ctx: FakeContext, tokens, n_tokens: int, n_past: int) -> int:
+    """
+    Evaluates tokens of the sequence 0 after its first n_past tokens (the next ones are removed), the logits of the last one are kept.
+    """
+    ctx.check()
+    with ctx.lock:
+        ctx.n_evaluating += 1
+    try:
+        llama_kv_cache_seq_rm(ctx, 0, n_past, -1)
+        batch = llama_batch(n_tokens, 1)
+        for i in range(n_tokens):
+            batch.token[i] = tokens[i]
+            batch.pos[i] = n_past + i
+            batch.n_seq_id[i] = 1
+        batch.logits[n_tokens - 1] = True
+        batch.n_tokens = n_tokens
+        return llama_decode(ctx, batch)
+    finally:
+        with ctx.lock:
+            ctx.n_evaluating -= 1
+
+
+def llama_get_logits(ctx: FakeContext):
+    ctx.check()
+    return ctx.logits[0].ctypes.data_as(ctypes.POINTER(ctypes.c_float))
+
+
+def llama_get_logits_ith(ctx: FakeContext, i: int):
+    ctx.check()
+    return ctx.logits[ctx.logits_rows[i]].ctypes.data_as(ctypes.POINTER(ctypes.c_float))
+
+
+def llama_kv_cache_tokens_rm(ctx: FakeContext, c0: int, c1: int):
+    ctx.check()
+    c0 = 0 if c0 < 0 else c0
+    c1 = ctx.n_ctx if c1 < 0 else c1
+    ctx.cells[c0:c1] = [None] * (c1 - c0)
+
+
+def llama_kv_cache_seq_rm(ctx: FakeContext, seq_id: int, p0: int, p1: int):
+    ctx.check()
+    p0 = 0 if p0 < 0 else p0
+    p1 = sys.maxsize if p1 < 0 else p1
+    for i, cell in enumerate(ctx.cells):
+        if cell is not None and (seq_id < 0 or seq_id in cell[2]) and p0 <= cell[0] < p1:
+            cell[2] = set() if seq_id < 0 else cell[2] - {seq_id}
+            if not cell[2]:
+                ctx.cells[i] = None
+
+
+def llama_kv_cache_seq_cp(ctx: FakeContext, seq_id_src: int, seq_id_dst: int, p0: int, p1: int):
+    ctx.check()
+    p0 = 0 if p0 < 0 else p0
+    p1 = sys.maxsize if p1 < 0 else p1
+    for cell in ctx.cells:
+        if cell is not None and seq_id_src in cell[2] and p0 <= cell[0] < p1:
+            cell[2] = cell[2] | {seq_id_dst}
+
+
+def _candidates(candidates_p) -> np.ndarray:
+    # Numpy view of the candidates (the array of llama_token_data)
+    array = candidates_p.contents
+    buffer = (ctypes.c_char * (array.size * _token_data_dtype.itemsize)).from_address(ctypes.addressof(array.data.contents))
+    return np.frombuffer(buffer, dtype=_token_data_dtype)
+
+
+def llama_sample_softmax(ctx: FakeContext, candidates_p):
+    array = candidates_p.contents
+    candidates = _candidates(candidates_p)
+    if not array.sorted:
+        candidates[:] = candidates[np.argsort(-candidates["logit"], kind="stable")]
+        array.sorted = True
+    probs = np.exp(candidates["logit"].astype(np.float64) - candidates["logit"][0])
+    candidates["p"] = probs / probs.sum()
+
+
+def llama_sample_top_k(ctx: FakeContext, candidates_p, k: int, min_keep: int = 1):
+    array = candidates_p.contents
+    k = array.size if k <= 0 else min(max(k, min_keep), array.size)
+    candidates = _candidates(candidates_p)
+    if not array.sorted:
+        # Like llama.cpp, only the k first candidates are sorted.
+        top = np.argpartition(-candidates["logit"], k - 1)[:k] if k < array.size else np.arange(array.size)
+        candidates[:k] = candidates[top[np.argsort(-candidates["logit"][top], kind="stable")]]
+        array.sorted = True
+    array.size = k
+
+
+def llama_sample_top_p(ctx: FakeContext, candidates_p, p: float, min_keep: int = 1):
+    if p >= 1.0:
+        return
+    llama_sample_softmax(ctx, candidates_p)
+    cumulative = np.cumsum(_candidates(candidates_p)["p"])
+    candidates_p.contents.size = max(int(np.searchsorted(cumulative, p)) + 1, min_keep)
+
+
+def llama_sample_temperature(ctx: FakeContext, candidates_p, temp: float):
+    candidates = _candidates(candidates_p)
+    candidates["logit"] /= temp
+
+
+def llama_sample_repetition_penalty(ctx: FakeContext, candidates_p, last_tokens_data, last_tokens_size: int, penalty: float):
+    if last_tokens_size == 0 or penalty == 1.0:
+        return
+    candidates = _candidates(candidates_p)
+    repeated = np.isin(candidates["id"], list(last_tokens_data[:last_tokens_size]))
+    logits = candidates["logit"]
+    logits[repeated] = np.where(logits[repeated] > 0, logits[repeated] / penalty, logits[repeated] * penalty)
+    candidates_p.contents.sorted = False
+
+
+def llama_sample_frequency_and_presence_penalties(ctx: FakeContext, candidates_p, last_tokens_data, last_tokens_size: int,
+                                                  alpha_frequency: float, alpha_presence: float):
+    if last_tokens_size == 0 or (alpha_frequency == 0.0 and alpha_presence == 0.0):
+        return
+    candidates = _candidates(candidates_p)
+    token_ids, counts = np.unique(list(last_tokens_data[:last_tokens_size]), return_counts=True)
+    index = np.searchsorted(token_ids, candidates["id"]).clip(max=len(token_ids) - 1)
+    count = np.where(token_ids[index] == candidates["id"], counts[index], 0)
+    candidates["logit"] -= count * alpha_frequency + (count > 0) * alpha_presence
+    candidates_p.contents.sorted = False
+
+
+def llama_sample_grammar(ctx: FakeContext, candidates_p, grammar: LlamaGrammar):
+    pass
+
+
+def llama_grammar_accept_token(ctx: FakeContext, grammar: LlamaGrammar, token: int):
+    pass
+
+
+def llama_sample_token(ctx: FakeContext, candidates_p) -> int:
+    llama_sample_softmax(ctx, candidates_p)
+    candidates = _candidates(candidates_p)
+    probs = candidates["p"].astype(np.float64)
+    return int(candidates["id"][ctx.rng.choice(len(candidates), p=probs / probs.sum())])
+
+
+def llama_print_timings(ctx: FakeContext):
+    pass
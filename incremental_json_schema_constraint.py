@@ -0,0 +1,617 @@
+import re
+from functools import lru_cache
+from typing import Dict, Union, List
+from json_schema_constraint import end_token, ongoing_string_regexp, END_NOT_REACHED, CAN_END_OR_CONTINUE
+from schema_registry import SchemaNode, get_schema_root
+
+# Status of a frame whose value is complete and can not be continued (closing quote, bracket...).
+ENDED = "ENDED"
+
+_WHITESPACES = " \t\n\r"
+_DIGITS = "0123456789"
+
+
+def strip_end_token(completions: list) -> list:
+    """
+    Remove the end token from the completions of a nested value,
+    because the parent container still needs to be closed before ending.
+    """
+    completions = [c for c in completions if c != end_token]
+    return [c.replace(end_token, "") if type(c) is str else c for c in completions]
+
+
+# The number of characters allowed by each regexp of bounded_string_regexp.
+_bounded_string_lengths: Dict[re.Pattern, int] = {}
+
+
+@lru_cache(maxsize=None)
+def bounded_string_regexp(max_chars: int) -> re.Pattern:
+    """
+    Same as `ongoing_string_regexp`, for a string which can only have `max_chars` more characters (an escape sequence is one character).
+    The regexps are cached, so their token masks are only computed once.
+    """
+    char = r'(?:[^"\\\x00-\x1f]|\\.)'
+    if max_chars == 0:
+        pattern = re.compile(r'^"?$')
+    else:
+        pattern = re.compile(rf'^(?:{char}{{0,{max_chars - 1}}}\\|{char}{{0,{max_chars}}}"?)$')
+    _bounded_string_lengths[pattern] = max_chars
+    return pattern
+
+
+class Frame:
+    """
+    This is the base class of the parser stack frames. A frame parses one JSON value.
+    `feed` returns False if the character is rejected, True if it is consumed,
+    or the frame of a nested value opened by this character.
+    """
+    __slots__ = ()
+
+    def copy(self):
+        other = object.__new__(type(self))
+        for name in self.__slots__:
+            setattr(other, name, getattr(self, name))
+        return other
+
+    def key(self) -> tuple:
+        """
+        Returns a hashable description of the state of the frame.
+        """
+        raise NotImplementedError()
+
+    def closing_text(self) -> str:
+        """
+        Returns the shortest text which ends the value of the frame (once its nested values are ended).
+        """
+        raise NotImplementedError()
+
+
+class StringFrame(Frame):
+    """Parser state of a JSON string value. `length` is the number of characters of the string, checked against maxLength."""
+    __slots__ = ("state", "status", "max_length", "length")
+    BEFORE, INSIDE, ESCAPED, CLOSED = range(4)
+
+    def __init__(self, node: SchemaNode):
+        self.state = StringFrame.BEFORE
+        self.status = END_NOT_REACHED
+        self.max_length = node.max_length
+        self.length = 0
+
+    def feed(self, c: str):
+        state = self.state
+        if state == StringFrame.INSIDE:
+            if c == '"':
+                self.state = StringFrame.CLOSED
+                self.status = ENDED
+                return True
+            if self.max_length is not None and self.length >= self.max_length:
+                return False
+            self.length += 1
+            if c == "\\":
+                self.state = StringFrame.ESCAPED
+            return True
+        if state == StringFrame.ESCAPED:
+            self.state = StringFrame.INSIDE
+            return True
+        if state == StringFrame.BEFORE:
+            if c == '"':
+                self.state = StringFrame.INSIDE
+                return True
+            return c in _WHITESPACES
+        return False
+
+    def completions(self) -> list:
+        if self.state == StringFrame.BEFORE:
+            return ['"']
+        if self.state == StringFrame.CLOSED:
+            return [end_token]
+        if self.max_length is not None:
+            if self.state == StringFrame.ESCAPED:
+                # The escaped character is matched like a character, but it is already counted.
+                return [bounded_string_regexp(self.max_length - self.length + 1)]
+            if self.length >= self.max_length:
+                return ['"']
+            return [bounded_string_regexp(self.max_length - self.length)]
+        return [ongoing_string_regexp]
+
+    def key(self) -> tuple:
+        return ("string", self.state, self.length if self.max_length is not None else None)
+
+    def closing_text(self) -> str:
+        if self.state == StringFrame.BEFORE:
+            return '""'
+        if self.state == StringFrame.ESCAPED:
+            return 'n"'
+        if self.state == StringFrame.INSIDE:
+            return '"'
+        return ""
+
+
+class NumberFrame(Frame):
+    """Parser state of a JSON number value."""
+    __slots__ = ("last", "has_dot", "has_e", "status")
+
+    def __init__(self, node: SchemaNode):
+        self.last = ""
+        self.has_dot = False
+        self.has_e = False
+        self.status = END_NOT_REACHED
+
+    def feed(self, c: str):
+        last = self.last
+        if c in _DIGITS:
+            self.status = CAN_END_OR_CONTINUE
+        elif c == "+" or c == "-":
+            if last and last != "e":
+                return False
+            self.status = END_NOT_REACHED
+        elif c == ".":
+            if self.has_dot or self.has_e:
+                return False
+            self.has_dot = True
+            self.status = END_NOT_REACHED
+        elif c == "e" or c == "E":
+            if self.has_e or not last or last not in _DIGITS:
+                return False
+            self.has_e = True
+            self.status = END_NOT_REACHED
+            c = "e"
+        else:
+            # leading whitespaces are skipped
+            return not last and c in _WHITESPACES
+        self.last = c
+        return True
+
+    def completions(self) -> list:
+        last = self.last
+        suggestions = ["0", "1", "2", "3", "4", "5", "6", "7", "8", "9"]
+        if not last or last == "e":
+            suggestions.append("+")
+            suggestions.append("-")
+        if not self.has_dot and not self.has_e:
+            suggestions.append(".")
+        if last and last in _DIGITS:
+            if not self.has_e:
+                suggestions.append("e")
+            suggestions.append(end_token)
+        return suggestions
+
+    def key(self) -> tuple:
+        last = "0" if self.last and self.last in _DIGITS else self.last
+        return ("number", last, self.has_dot, self.has_e)
+
+    def closing_text(self) -> str:
+        return "" if self.last and self.last in _DIGITS else "0"
+
+
+class BooleanFrame(Frame):
+    """Parser state of a JSON boolean value."""
+    __slots__ = ("literal", "pos", "status")
+
+    def __init__(self, node: SchemaNode):
+        self.literal = None
+        self.pos = 0
+        self.status = END_NOT_REACHED
+
+    def feed(self, c: str):
+        literal = self.literal
+        if literal is None:
+            if c == "t":
+                self.literal = "true"
+            elif c == "f":
+                self.literal = "false"
+            else:
+                return c in _WHITESPACES
+            self.pos = 1
+            return True
+        if self.pos < len(literal) and literal[self.pos] == c:
+            self.pos += 1
+            if self.pos == len(literal):
+                self.status = ENDED
+            return True
+        return False
+
+    def completions(self) -> list:
+        if self.literal is None:
+            return ["true"+end_token, "false"+end_token]
+        return [self.literal[self.pos:]+end_token]
+
+    def key(self) -> tuple:
+        return ("boolean", self.literal, self.pos)
+
+    def closing_text(self) -> str:
+        if self.literal is None:
+            return "true"
+        return self.literal[self.pos:]
+
+
+class ArrayFrame(Frame):
+    """
+    Parser state of a JSON array.
+    The frame of the current item is pushed on the parser stack on top of this one,
+    while the array itself waits for the ", " or "]" that follows the item.
+    `n_items` is the number of items, checked against maxItems.
+    """
+    __slots__ = ("node", "items", "state", "status", "max_items", "n_items")
+    BEFORE, AFTER_ITEM, CLOSED = range(3)
+
+    def __init__(self, node: SchemaNode):
+        self.node = node
+        self.items = node.items
+        self.state = ArrayFrame.BEFORE
+        self.status = END_NOT_REACHED
+        self.max_items = node.max_items
+        self.n_items = 0
+
+    def feed(self, c: str):
+        if c in _WHITESPACES:
+            return self.state != ArrayFrame.CLOSED
+        if self.state == ArrayFrame.BEFORE:
+            if c == "[":
+                self.state = ArrayFrame.AFTER_ITEM
+                if self.max_items == 0:
+                    # The array can only be empty, it is closed right after the bracket.
+                    return True
+                self.n_items = 1
+                return new_frame(self.items)
+        elif self.state == ArrayFrame.AFTER_ITEM:
+            if c == "," and (self.max_items is None or self.n_items < self.max_items):
+                self.n_items += 1
+                return new_frame(self.items)
+            if c == "]":
+                self.state = ArrayFrame.CLOSED
+                self.status = ENDED
+                return True
+        return False
+
+    def completions(self) -> list:
+        if self.state == ArrayFrame.BEFORE:
+            return ["["]
+        if self.state == ArrayFrame.AFTER_ITEM:
+            if self.max_items is not None and self.n_items >= self.max_items:
+                return ["]"+end_token]
+            return [", ", "]"+end_token]
+        return [end_token]
+
+    def key(self) -> tuple:
+        return ("array", self.node.node_id, self.state, self.n_items if self.max_items is not None else None)
+
+    def closing_text(self) -> str:
+        if self.state == ArrayFrame.BEFORE:
+            return self.node.min_text
+        if self.state == ArrayFrame.AFTER_ITEM:
+            return "]"
+        return ""
+
+
+class ObjectFrame(Frame):
+    """
+    Parser state of a JSON object.
+    Properties are expected in the order of the schema, like in `auto_complete_object`.
+    `key_pos` is the number of characters of the current '"property":' literal already generated.
+    """
+    __slots__ = ("node", "properties", "index", "key_pos", "seen_comma", "state", "status")
+    BEFORE, INSIDE, CLOSED = range(3)
+
+    def __init__(self, node: SchemaNode):
+        self.node = node
+        self.properties = node.properties
+        self.index = 0
+        self.key_pos = 0
+        self.seen_comma = False
+        self.state = ObjectFrame.BEFORE
+        self.status = END_NOT_REACHED
+
+    def feed(self, c: str):
+        if self.state == ObjectFrame.INSIDE:
+            if self.key_pos > 0:
+                pattern, val_type = self.properties[self.index]
+                if pattern[self.key_pos] != c:
+                    return False
+                self.key_pos += 1
+                if self.key_pos < len(pattern):
+                    return True
+                self.index += 1
+                self.key_pos = 0
+                self.seen_comma = False
+                return new_frame(val_type)
+            if c in _WHITESPACES:
+                return True
+            if self.index == len(self.properties):
+                if c == "}":
+                    self.state = ObjectFrame.CLOSED
+                    self.status = ENDED
+                    return True
+                return False
+            if c == "," and self.index > 0 and not self.seen_comma:
+                self.seen_comma = True
+                return True
+            if c == '"':
+                self.key_pos = 1
+                return True
+            return False
+        if self.state == ObjectFrame.BEFORE:
+            if c == "{":
+                self.state = ObjectFrame.INSIDE
+                return True
+            return c in _WHITESPACES
+        return False
+
+    def completions(self) -> list:
+        if self.state == ObjectFrame.BEFORE:
+            return ["{"]
+        if self.state == ObjectFrame.CLOSED:
+            return [end_token]
+        if self.index == len(self.properties):
+            return ["}"+end_token]
+        pattern = self.properties[self.index][0]
+        if self.key_pos > 0:
+            return [pattern[self.key_pos:]]
+        if self.index == 0 or self.seen_comma:
+            return [pattern]
+        return [", "+pattern]
+
+    def key(self) -> tuple:
+        return ("object", self.node.node_id, self.state, self.index, self.key_pos, self.seen_comma)
+
+    def closing_text(self) -> str:
+        if self.state == ObjectFrame.BEFORE:
+            return self.node.min_text
+        if self.state == ObjectFrame.CLOSED:
+            return ""
+        texts = []
+        index = self.index
+        if self.key_pos > 0:
+            pattern, val_type = self.properties[index]
+            texts.append(pattern[self.key_pos:] + val_type.min_text)
+            index += 1
+        needs_comma = self.key_pos > 0 or (index > 0 and not self.seen_comma)
+        for pattern, val_type in self.properties[index:]:
+            texts.append(("," if needs_comma else "") + pattern + val_type.min_text)
+            needs_comma = True
+        texts.append("}")
+        return "".join(texts)
+
+
+class EnumFrame(Frame):
+    """
+    Parser state of a value among the texts of an enum (or a const).
+    `candidates` are the indices of the texts still matching the generated text, so the last one is forced as soon as it is alone.
+    """
+    __slots__ = ("node", "candidates", "pos", "status")
+
+    def __init__(self, node: SchemaNode):
+        self.node = node
+        self.candidates = tuple(range(len(node.values)))
+        self.pos = 0
+        self.status = END_NOT_REACHED
+
+    def feed(self, c: str):
+        pos = self.pos
+        values = self.node.values
+        candidates = tuple(i for i in self.candidates if len(values[i]) > pos and values[i][pos] == c)
+        if not candidates:
+            # leading whitespaces are skipped
+            return pos == 0 and c in _WHITESPACES
+        self.candidates = candidates
+        self.pos = pos = pos + 1
+        if any(len(values[i]) == pos for i in candidates):
+            self.status = ENDED if len(candidates) == 1 else CAN_END_OR_CONTINUE
+        else:
+            self.status = END_NOT_REACHED
+        return True
+
+    def completions(self) -> list:
+        values = self.node.values
+        return [values[i][self.pos:]+end_token for i in self.candidates]
+
+    def key(self) -> tuple:
+        return ("enum", self.node.node_id, self.pos, self.candidates)
+
+    def closing_text(self) -> str:
+        values = self.node.values
+        return min((values[i][self.pos:] for i in self.candidates), key=len)
+
+
+def _feed_stack(stack: list, c: str) -> bool:
+    """
+    Feeds a character to a stack of frames parsing one value (like `IncrementalJsonSchemaParser.feed_char`).
+    The stack is empty once the value is ended.
+
+    Returns:
+    bool: False if the character is rejected, or if it follows the end of the value.
+    """
+    while True:
+        top = stack[-1]
+        res = top.feed(c)
+        if res is True:
+            if top.status is ENDED:
+                stack.pop()
+            return True
+        if res is not False:
+            stack.append(res)
+            return True
+        if top.status is END_NOT_REACHED or len(stack) == 1:
+            return False
+        stack.pop()
+
+
+def _stack_completions(stack: list) -> list:
+    """
+    Returns the completions of a stack of frames parsing one value, with the end token where the value can end.
+    """
+    if not stack:
+        return [end_token]
+    top = stack[-1]
+    if len(stack) == 1:
+        return top.completions()
+    item_completions = strip_end_token(top.completions())
+    if top.status is CAN_END_OR_CONTINUE:
+        return [*stack[-2].completions(), *item_completions]
+    return item_completions
+
+
+class UnionFrame(Frame):
+    """
+    Parser state of a value of one of several alternatives (anyOf, oneOf or a list of types).
+    All the alternatives still viable are followed together, like the states of an NFA: each branch is an
+    (alternative index, stack of frames) pair, and the branches rejecting a character are dropped at once,
+    so the work per character is bounded by the number of live branches and nothing is parsed again.
+    The completions are the union of the completions of the branches. An ended branch has an empty stack.
+    The branches continuing with a character are preferred to the ones ending before it (like a number continuing).
+    """
+    __slots__ = ("node", "branches", "status")
+
+    def __init__(self, node: SchemaNode):
+        self.node = node
+        self.branches = [(i, [new_frame(alternative)]) for i, alternative in enumerate(node.alternatives)]
+        self.status = END_NOT_REACHED
+
+    def copy(self):
+        other = super().copy()
+        other.branches = [(i, [frame.copy() for frame in stack]) for i, stack in self.branches]
+        return other
+
+    def feed(self, c: str):
+        branches = [(i, stack) for i, stack in self.branches if stack and _feed_stack(stack, c)]
+        if not branches:
+            return False
+        self.branches = branches
+        if all(not stack for i, stack in branches):
+            self.status = ENDED
+        elif any(not stack or (len(stack) == 1 and stack[0].status is CAN_END_OR_CONTINUE) for i, stack in branches):
+            self.status = CAN_END_OR_CONTINUE
+        else:
+            self.status = END_NOT_REACHED
+        return True
+
+    def completions(self) -> list:
+        return list(dict.fromkeys(c for i, stack in self.branches for c in _stack_completions(stack)))
+
+    def key(self) -> tuple:
+        return ("union", self.node.node_id, tuple((i, tuple(frame.key() for frame in stack)) for i, stack in self.branches))
+
+    def closing_text(self) -> str:
+        return min(("".join(frame.closing_text() for frame in reversed(stack)) for i, stack in self.branches), key=len)
+
+
+_FRAME_TYPES = {"string": StringFrame, "number": NumberFrame, "boolean": BooleanFrame, "object": ObjectFrame, "array": ArrayFrame,
+                "enum": EnumFrame, "union": UnionFrame}
+
+def new_frame(node: SchemaNode):
+    """
+    This function creates the parser frame of a value of the given schema node.
+    """
+    return _FRAME_TYPES[node.type](node)
+
+
+class IncrementalJsonSchemaParser:
+    """
+    This is a push-down automaton which follows a JSON value being generated, character by character.
+    It keeps a stack of frames (one per nested value being parsed), so each new character
+    is processed in O(1) amortized time instead of re-parsing the whole history.
+    It gives the same suggestions as `json_schema_constraint.auto_complete`.
+    The schema is normalized once (see `schema_registry`), so the frames do no lookup in the schema dicts.
+    If max_token_length (the length of the longest token piece of the vocabulary) is given, a string which can have
+    at least as many more characters before its maxLength is suggested `ongoing_string_regexp`, which matches the same tokens,
+    so the masks of the bounded regexps are only computed for the last characters of the strings.
+    """
+    def __init__(self, json_schema: Union[dict, SchemaNode], max_token_length: int = None):
+        self.json_schema = json_schema
+        self.root = get_schema_root(json_schema)
+        self.max_token_length = max_token_length
+        self.reset()
+
+    def reset(self):
+        self.stack = [new_frame(self.root)]
+        self.finished = False
+        self.error = False
+
+    def feed(self, text: str):
+        """
+        Advance the parser with newly generated text.
+        """
+        for c in text:
+            if self.error:
+                return
+            self.feed_char(c)
+
+    def copy(self) -> "IncrementalJsonSchemaParser":
+        """
+        Returns an independent copy of the parser in its current state.
+        """
+        other = object.__new__(IncrementalJsonSchemaParser)
+        other.json_schema = self.json_schema
+        other.root = self.root
+        other.max_token_length = self.max_token_length
+        other.stack = [frame.copy() for frame in self.stack]
+        other.finished = self.finished
+        other.error = self.error
+        return other
+
+    def state_key(self) -> tuple:
+        """
+        Returns a hashable description of the parser state, which is stable across processes.
+        Two parsers with the same key give the same completions now and after any text.
+        """
+        if self.error:
+            return ("error",)
+        if self.finished:
+            return ("finished",)
+        return tuple(frame.key() for frame in self.stack)
+
+    def feed_char(self, c: str):
+        """
+        Advance the parser with one character. The stack of frames can be inspected after each character (see json_events).
+        """
+        stack = self.stack
+        while True:
+            if self.finished:
+                self.error = c not in _WHITESPACES and c != end_token
+                return
+            top = stack[-1]
+            res = top.feed(c)
+            if res is True:
+                if top.status is ENDED:
+                    self._pop()
+                return
+            if res is not False:
+                stack.append(res)
+                return
+            # the character is rejected, it belongs to the parent if the value can end here.
+            if top.status is END_NOT_REACHED:
+                self.error = True
+                return
+            self._pop()
+
+    def _pop(self):
+        if len(self.stack) > 1:
+            self.stack.pop()
+        else:
+            self.finished = True
+
+    def completions(self) -> Union[List[str], None]:
+        """
+        Returns:
+        list: List of possible completions, or None if the text does not follow the schema.
+        """
+        if self.error:
+            return None
+        if self.finished:
+            return [end_token]
+        completions = _stack_completions(self.stack)
+        if self.max_token_length is not None:
+            completions = [ongoing_string_regexp if _bounded_string_lengths.get(c, -1) >= self.max_token_length else c for c in completions]
+        return completions
+
+    def closing_text(self) -> Union[str, None]:
+        """
+        Returns:
+        str: The shortest text which ends the JSON value (the properties left are given their shortest value),
+            or None if the text does not follow the schema.
+        """
+        if self.error:
+            return None
+        if self.finished:
+            return ""
+        return "".join(frame.closing_text() for frame in reversed(self.stack))
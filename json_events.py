@@ -0,0 +1,147 @@
+from typing import List, Tuple, Union
+import json
+import re
+from json_schema_constraint import end_token
+from incremental_json_schema_constraint import IncrementalJsonSchemaParser, BooleanFrame, ArrayFrame, ObjectFrame, ENDED
+from schema_registry import SchemaNode
+
+# Kinds of events. The value events are ("value", path, value), the others are (kind, path).
+START_OBJECT = "start_object"
+END_OBJECT = "end_object"
+START_ARRAY = "start_array"
+END_ARRAY = "end_array"
+VALUE = "value"
+
+Path = Tuple[Union[str, int], ...]
+
+
+def format_path(path: Path) -> str:
+    """
+    Returns the JSONPath of a path of property names and array indices, e.g. ("items", 0, "name") -> "$.items[0].name".
+    """
+    return "$" + "".join(f"[{part}]" if isinstance(part, int) else f".{part}" for part in path)
+
+
+# The strings, and the numbers as allowed by the constraint (with a leading "+" or ".", which json.loads does not accept).
+_JSON_STRING_OR_NUMBER = re.compile(r'"(?:[^"\\]|\\.)*"|[-+]?[0-9.][0-9.eE+-]*')
+
+
+def _number_value(text: str):
+    if "." in text or "e" in text or "E" in text:
+        return float(text)
+    return int(text)
+
+
+def _json_value(text: str):
+    """
+    Same as json.loads, with the numbers allowed by the constraint.
+    """
+    return json.loads(_JSON_STRING_OR_NUMBER.sub(lambda m: m.group() if m.group()[0] == '"' else json.dumps(_number_value(m.group())), text))
+
+
+def _scalar_value(frame, text: str):
+    text = text.strip()
+    if isinstance(frame, BooleanFrame):
+        return text == "true"
+    # The strings, the numbers, the enums and the alternatives of a union (given as one value, even if it is an object or an array).
+    return _json_value(text)
+
+
+class JsonEventParser:
+    """
+    This parser turns the text generated under a JSON schema into events, as soon as they are known:
+    the start and the end of each object and array, and the value of each string, number and boolean once it is complete.
+    It follows the frames of an IncrementalJsonSchemaParser, so the end of a value is found like for the constraint
+    (e.g. a number ends with the character after it).
+    The path of an event is a tuple of the property names and array indices leading to the value (see format_path).
+    A value of an enum or of a union (anyOf, oneOf) is given by one value event once it is complete, even if it is an object or an array.
+    """
+    def __init__(self, json_schema: Union[dict, SchemaNode]):
+        self.parser = IncrementalJsonSchemaParser(json_schema)
+        # The frames of the parser stack, with the path and the start of the text of their value.
+        self.frames = list(self.parser.stack)
+        self.paths: List[Path] = [()]
+        self.starts = [0]
+        self.opened = set()
+        self.text = ""
+
+    def feed(self, text: str) -> list:
+        """
+        Advance the parser with newly generated text.
+
+        Returns:
+        list: The events completed by this text.
+
+        Raises:
+        ValueError: If the text does not follow the JSON schema.
+        """
+        events = []
+        pos = len(self.text)
+        self.text += text
+        parser = self.parser
+        for c in text:
+            if parser.finished:
+                break
+            parser.feed_char(c)
+            if parser.error:
+                raise ValueError(f"The text does not follow the JSON schema: '{self.text[:pos+1]}'")
+            self._update(pos, events)
+            pos += 1
+        return events
+
+    def finish(self) -> list:
+        """
+        Ends the text (a number at the root is only complete at the end of the text).
+
+        Returns:
+        list: The events completed by the end of the text.
+
+        Raises:
+        ValueError: If the text is not a complete JSON value (e.g. a string is not terminated).
+        """
+        if self.parser.finished:
+            return []
+        if end_token not in (self.parser.completions() or []):
+            raise ValueError(f"The text is not a complete JSON value: '{self.text}'")
+        return self.feed(end_token)
+
+    def _update(self, pos: int, events: list):
+        stack = self.parser.stack
+        frames = self.frames
+        i = 0
+        while i < len(frames) and i < len(stack) and frames[i] is stack[i]:
+            i += 1
+        # The frames popped by this character, the innermost first. The root frame stays on the stack when it ends.
+        popped = list(range(len(frames) - 1, i - 1, -1))
+        if self.parser.finished:
+            popped.append(0)
+        for j in popped:
+            frame = frames[j]
+            if isinstance(frame, ObjectFrame):
+                events.append((END_OBJECT, self.paths[j]))
+            elif isinstance(frame, ArrayFrame):
+                events.append((END_ARRAY, self.paths[j]))
+            else:
+                # The values ended by their last character (closing quote...) include it, the others (numbers...) end before it.
+                end = pos + 1 if frame.status is ENDED else pos
+                events.append((VALUE, self.paths[j], _scalar_value(frame, self.text[self.starts[j]:end])))
+            self.opened.discard(id(frame))
+        del frames[i:]
+        del self.paths[i:]
+        del self.starts[i:]
+        if self.parser.finished:
+            return
+        # The container which consumed the character may have been opened by it.
+        top = frames[-1] if frames else None
+        if top is not None and id(top) not in self.opened and isinstance(top, (ObjectFrame, ArrayFrame)) and top.state != top.BEFORE:
+            self.opened.add(id(top))
+            events.append((START_OBJECT if isinstance(top, ObjectFrame) else START_ARRAY, self.paths[-1]))
+        for frame in stack[i:]:
+            parent = frames[-1]
+            if isinstance(parent, ObjectFrame):
+                key = json.loads(parent.properties[parent.index - 1][0][:-1])
+            else:
+                key = parent.n_items - 1
+            frames.append(frame)
+            self.paths.append((*self.paths[-1], key))
+            self.starts.append(pos + 1)
@@ -8,7 +8,8 @@ class EarlyEndOfValue(Exception):
     def __init__(self, index):
         self.index = index
 
-ongoing_string_regexp = re.compile(r'^(?!.*(?<!\\)").*$')
+# Text which can continue a string: no unescaped quote, except the closing one at the end.
+ongoing_string_regexp = re.compile(r'^(?:[^"\\\x00-\x1f]|\\.)*(?:\\|")?$')
 
 def auto_complete_string(incomplete_string: str):
     if len(incomplete_string)==0:
@@ -0,0 +1,103 @@
+import json
+from typing import Dict, List, Union
+from compiled_json_schema_constraint import schema_hash
+
+# Rules of the primitive types, with the same syntax as the incremental parser
+# (the keys of the objects are in the order of the schema, like in `auto_complete_object`).
+_PRIMITIVE_RULES = {
+    "string": r'string ::= "\"" ( [^"\\\x00-\x1F] | "\\" [^\x00-\x1F] )* "\""',
+    "number": r'number ::= [-+]? ( [0-9]+ ( "." [0-9]+ )? | "." [0-9]+ ) ( [eE] [-+]? [0-9]+ )?',
+    "boolean": r'boolean ::= "true" | "false"',
+}
+_WS_RULE = r'ws ::= " "?'
+
+
+def gbnf_literal(text: str) -> str:
+    """
+    Returns the GBNF literal matching exactly the given text.
+    """
+    return '"' + text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n").replace("\r", "\\r").replace("\t", "\\t") + '"'
+
+
+def _value_rule(json_schema, rules: List[str], used_primitives: set) -> Union[str, None]:
+    """
+    Adds the rules of a value of the schema, and returns the name of its rule (None if the schema is not supported).
+    """
+    if not isinstance(json_schema, dict):
+        return None
+    schema_type = json_schema.get("type")
+    if "maxLength" in json_schema or "maxItems" in json_schema:
+        return None
+    alternatives = json_schema.get("anyOf", json_schema.get("oneOf"))
+    if alternatives is None and isinstance(schema_type, list):
+        alternatives = [{**json_schema, "type": alternative_type} for alternative_type in schema_type]
+    is_enum = "const" in json_schema or "enum" in json_schema
+    if schema_type in _PRIMITIVE_RULES and alternatives is None and not is_enum:
+        used_primitives.add(schema_type)
+        return schema_type
+    index = len(rules)
+    name = f"node{index}"
+    rules.append(None)
+    if is_enum:
+        values = [json_schema["const"]] if "const" in json_schema else json_schema["enum"]
+        if not values:
+            return None
+        rule = " | ".join(dict.fromkeys(gbnf_literal(json.dumps(value, ensure_ascii=False)) for value in values))
+    elif alternatives is not None:
+        alternative_rules = [_value_rule(alternative, rules, used_primitives) for alternative in alternatives]
+        if not alternative_rules or None in alternative_rules:
+            return None
+        rule = " | ".join(alternative_rules)
+    elif schema_type == "null":
+        rule = '"null"'
+    elif schema_type == "array" and "items" in json_schema:
+        item = _value_rule(json_schema["items"], rules, used_primitives)
+        if item is None:
+            return None
+        rule = f'"[" ws {item} ( ws "," ws {item} )* ws "]"'
+    elif schema_type == "object" and isinstance(json_schema.get("properties"), dict):
+        members = []
+        for property, val_type in json_schema["properties"].items():
+            value = _value_rule(val_type, rules, used_primitives)
+            if value is None:
+                return None
+            key = gbnf_literal(json.dumps(property, ensure_ascii=False) + ":")
+            members.append(f"{key} ws {value}")
+        rule = '"{" ws ' + ' ws "," ws '.join(members) + (' ws ' if members else '') + '"}"'
+    else:
+        return None
+    rules[index] = f"{name} ::= {rule}"
+    return name
+
+
+def json_schema_to_gbnf(json_schema) -> Union[str, None]:
+    """
+    This function translates a JSON schema into a GBNF grammar, for the native grammar sampling of llama.cpp.
+    The supported types are string, number, boolean, null, array (with items) and object (with properties),
+    with enum, const, anyOf, oneOf and lists of types.
+
+    Parameters:
+    json_schema (dict): The JSON schema to enforce.
+
+    Returns:
+    str: The grammar, or None if the schema uses unsupported constructs (then the Python constrainer must be used).
+    """
+    rules = []
+    used_primitives = set()
+    root = _value_rule(json_schema, rules, used_primitives)
+    if root is None:
+        return None
+    lines = [f"root ::= {root}", *rules, *(_PRIMITIVE_RULES[name] for name in sorted(used_primitives)), _WS_RULE]
+    return "\n".join(lines) + "\n"
+
+
+_gbnf_grammars: Dict[str, Union[str, None]] = {}
+
+def get_gbnf(json_schema) -> Union[str, None]:
+    """
+    Same as json_schema_to_gbnf, with the grammars cached by schema.
+    """
+    key = schema_hash(json_schema)
+    if key not in _gbnf_grammars:
+        _gbnf_grammars[key] = json_schema_to_gbnf(json_schema)
+    return _gbnf_grammars[key]
@@ -0,0 +1,266 @@
+from typing import Callable, Dict, List, Iterator, Tuple
+from .model_utils import get_context, get_model
+from .inference_with_completion import LastTokens, get_sampling_buffers, get_token_prefix_index, sample_next_token, forced_prefix, tokenize_forced_text, \
+    forced_closing_text
+from .prompt_cache import PromptCache
+from .history_buffer import HistoryBuffer
+import llama_cpp
+import numpy as np
+
+
+class Sequence:
+    """
+    This is the state of one sequence decoded in a batch: its tokens waiting to be evaluated,
+    its position in the KV cache, and its own generated text (seen by its constrainer) and penalty tokens.
+    """
+    def __init__(self, index: int, seq_id: int, tokens: List[int], completion_callback: Callable, n_predict: int, last_n_size: int,
+                 literal_tokens_cache: Dict[bytes, List[int]] = None, incremental_callback: bool = False, closing_callback: Callable = None):
+        self.index = index
+        self.seq_id = seq_id
+        self.pending_tokens = list(tokens)
+        self.n_past = 0
+        self.completion_callback = completion_callback
+        self.closing_callback = closing_callback
+        self.literal_tokens_cache = literal_tokens_cache
+        self.remaining_tokens = n_predict
+        self.history = HistoryBuffer(keep_text=not incremental_callback)
+        self.incremental_callback = incremental_callback
+        self.last_tokens = LastTokens(last_n_size)
+        for token_id in tokens[-last_n_size:]:
+            self.last_tokens.push(token_id)
+        # Index of the logits of the sequence in the last decoded batch, or None if they were not computed.
+        self.logits_index = None
+        self.finished = False
+
+
+def do_batched_inference(prompts: List[bytes], completion_callbacks: List[Callable], model_path=None, model=None, ctx=None,
+                         n_predict: int = 200, n_parallel: int = 8, n_batch: int = 512, stop_text: str = None,
+                         hard_mask: bool = True, prompt_cache: PromptCache = None,
+                         literal_tokens_caches: List[Dict[bytes, List[int]]] = None,
+                         incremental_callback: bool = False, closing_callbacks: List[Callable] = None) -> Iterator[Tuple[int, str]]:
+    """
+    This function generates the continuations of several prompts together, in one context:
+    the tokens of all the active sequences are evaluated by the same llama_decode call, each sequence having its own
+    sequence id in the KV cache. Each sequence is constrained by its own completion callback.
+    A finished sequence leaves the batch, its KV cells are freed and the next waiting prompt takes its place.
+
+    Parameters:
+    prompts (list): The prompts (bytes).
+    completion_callbacks (list): For each prompt, the function called with the text generated for it
+        (only the text generated since the previous call with incremental_callback), which returns the suggestions (see do_inference), or None.
+    model_path (str): The path of the model, used if the model is not given.
+    model (llama_cpp.llama_model): The model.
+    ctx (llama_cpp.llama_context): The context. Its n_ctx must hold the tokens of n_parallel sequences.
+    n_predict (int): The maximum number of tokens generated per sequence (sampled and forced).
+    n_parallel (int): The maximum number of sequences decoded together.
+    n_batch (int): The maximum number of tokens per llama_decode call (at most the n_batch of the context).
+    stop_text (str): A sequence is finished when this text is generated (or forced by its callback).
+    hard_mask (bool): See adjust_logits_based_on_suggestions.
+    prompt_cache (PromptCache): The prompt cache used with this context, which is told that the context was overwritten.
+    literal_tokens_caches (list): For each prompt, the cache of the tokenizations of its forced texts (see tokenize_forced_text).
+    incremental_callback (bool): See completion_callbacks.
+    closing_callbacks (list): For each prompt, its closing callback or None: the shortest text closing its generation
+        is forced before its budget of tokens runs out, like in do_inference.
+
+    Yields:
+    tuple: The index of the prompt and a new chunk of its generated text.
+    """
+    if model is None and model_path is not None:
+        model = get_model(model_path)
+    if ctx is None and model is not None:
+        ctx = get_context(model)
+    prefix_index = get_token_prefix_index(model, model_path)
+    last_n_size = 64
+    buffers = get_sampling_buffers(ctx, model, 24, last_n_size)
+
+    # The batch decoding overwrites the KV cache of the context
+    llama_cpp.llama_kv_cache_tokens_rm(ctx, -1, -1)
+    if prompt_cache is not None:
+        prompt_cache.set_context_tokens(ctx, [])
+
+    waiting = list(range(len(prompts)))[::-1]
+
+    def new_sequence(seq_id: int):
+        # The next waiting prompt takes the free sequence id.
+        if not waiting:
+            return None
+        index = waiting.pop()
+        tokens = buffers.tokenize(model, b" " + prompts[index], True)
+        literal_tokens_cache = literal_tokens_caches[index] if literal_tokens_caches is not None else None
+        closing_callback = closing_callbacks[index] if closing_callbacks is not None else None
+        return Sequence(index, seq_id, tokens, completion_callbacks[index], n_predict, last_n_size, literal_tokens_cache, incremental_callback,
+                        closing_callback)
+
+    batch = llama_cpp.llama_batch_init(n_batch, 0, 1)
+    try:
+        yield from _decode_sequences(ctx, model, prefix_index, buffers, batch, n_batch, [], list(range(n_parallel))[::-1], new_sequence,
+                                     stop_text, hard_mask)
+    finally:
+        llama_cpp.llama_batch_free(batch)
+
+
+def do_n_best_inference(prompt: bytes, completion_callbacks: List[Callable], model_path=None, model=None, ctx=None,
+                        n_predict: int = 200, n_batch: int = 512, stop_text: str = None, hard_mask: bool = True,
+                        prompt_cache: PromptCache = None, literal_tokens_cache: Dict[bytes, List[int]] = None,
+                        incremental_callback: bool = False, closing_callbacks: List[Callable] = None) -> Iterator[Tuple[int, str]]:
+    """
+    This function samples several continuations of one prompt (n-best, self-consistency...), one per completion callback.
+    The prompt is evaluated once in the sequence 0 of the KV cache, and its cells are shared with the other sequences
+    (llama_kv_cache_seq_cp), which all start from the logits of its last token. Then the sequences are decoded together,
+    like in do_batched_inference, each one constrained by its own callback.
+
+    Parameters:
+    prompt (bytes): The prompt.
+    completion_callbacks (list): For each sequence, its completion callback (with its own constrainer), see do_batched_inference.
+    ctx (llama_cpp.llama_context): The context. Its n_ctx must hold the tokens of the prompt and of the generated texts of all the sequences.
+    literal_tokens_cache (dict): The cache of the tokenizations of the forced texts, shared by the sequences (see tokenize_forced_text).
+    closing_callbacks (list): For each sequence, its closing callback (with its own constrainer) or None, see do_batched_inference.
+    model_path, model, n_predict, n_batch, stop_text, hard_mask, prompt_cache, incremental_callback: See do_batched_inference.
+
+    Yields:
+    tuple: The index of the sequence and a new chunk of its generated text.
+    """
+    if model is None and model_path is not None:
+        model = get_model(model_path)
+    if ctx is None and model is not None:
+        ctx = get_context(model)
+    prefix_index = get_token_prefix_index(model, model_path)
+    last_n_size = 64
+    buffers = get_sampling_buffers(ctx, model, 24, last_n_size)
+
+    llama_cpp.llama_kv_cache_tokens_rm(ctx, -1, -1)
+    if prompt_cache is not None:
+        prompt_cache.set_context_tokens(ctx, [])
+
+    tokens = buffers.tokenize(model, b" " + prompt, True)
+    batch = llama_cpp.llama_batch_init(n_batch, 0, 1)
+    try:
+        # Evaluate the prompt once, then share its KV cells with all the sequences.
+        for start in range(0, len(tokens), n_batch):
+            chunk = tokens[start:start+n_batch]
+            for i, token_id in enumerate(chunk):
+                batch.token[i] = token_id
+                batch.pos[i] = start + i
+                batch.n_seq_id[i] = 1
+                batch.seq_id[i][0] = 0
+                batch.logits[i] = start + i == len(tokens) - 1
+            batch.n_tokens = len(chunk)
+            if llama_cpp.llama_decode(ctx, batch) != 0:
+                raise RuntimeError("llama_decode failed: the context is too small for the prompt")
+            logits_index = len(chunk) - 1
+        sequences = []
+        for index, completion_callback in enumerate(completion_callbacks):
+            if index > 0:
+                llama_cpp.llama_kv_cache_seq_cp(ctx, 0, index, 0, len(tokens))
+            closing_callback = closing_callbacks[index] if closing_callbacks is not None else None
+            seq = Sequence(index, index, tokens, completion_callback, n_predict, last_n_size, literal_tokens_cache, incremental_callback,
+                           closing_callback)
+            seq.pending_tokens = []
+            seq.n_past = len(tokens)
+            seq.logits_index = logits_index
+            sequences.append(seq)
+        yield from _decode_sequences(ctx, model, prefix_index, buffers, batch, n_batch, sequences, [], lambda seq_id: None,
+                                     stop_text, hard_mask)
+    finally:
+        llama_cpp.llama_batch_free(batch)
+
+
+def _decode_sequences(ctx, model, prefix_index, buffers, batch, n_batch: int, active: List[Sequence], free_seq_ids: List[int],
+                      new_sequence: Callable[[int], Sequence], stop_text: str, hard_mask: bool) -> Iterator[Tuple[int, str]]:
+    """
+    This function decodes sequences together until they are all finished: at each step, the next token of each sequence
+    whose inputs are evaluated is sampled (or its forced text is added), and the pending tokens of all the sequences
+    are evaluated by one llama_decode call. The KV cells of a finished sequence are freed, and its sequence id
+    is given to new_sequence, which returns the next sequence to decode (or None).
+    """
+    n_vocab = buffers.n_vocab
+    eos = llama_cpp.llama_token_eos(ctx)
+    try:
+        while True:
+            # Fill the free slots with the next sequences
+            while free_seq_ids:
+                seq = new_sequence(free_seq_ids[-1])
+                if seq is None:
+                    break
+                free_seq_ids.pop()
+                active.append(seq)
+            if not active:
+                break
+
+            # Sample the next token of the sequences whose inputs are evaluated
+            for seq in active:
+                logits_index = seq.logits_index
+                if logits_index is None:
+                    continue
+                seq.logits_index = None
+                suggestions = None
+                if seq.completion_callback is not None:
+                    suggestions = seq.completion_callback(seq.history.new_text() if seq.incremental_callback else seq.history.text())
+                forced = forced_prefix(suggestions)
+                if seq.closing_callback is not None:
+                    # Force the end of the sequence when the next sampled token or forced text could not be followed by it.
+                    forced = forced_closing_text(seq.closing_callback, seq.remaining_tokens, model, buffers, prefix_index,
+                                                 seq.literal_tokens_cache) or forced
+                if forced:
+                    # The text determined by the suggestions is directly added (jump forward),
+                    # and its tokens are evaluated with the next batch.
+                    chunk = seq.history.append(forced)
+                    yield (seq.index, chunk)
+                    if stop_text is not None and stop_text in chunk:
+                        seq.finished = True
+                        continue
+                    seq.pending_tokens = tokenize_forced_text(model, forced, buffers, prefix_index, seq.literal_tokens_cache)
+                    seq.remaining_tokens -= len(seq.pending_tokens)
+                    if not seq.pending_tokens or seq.remaining_tokens <= 0:
+                        seq.finished = True
+                    for token_id in seq.pending_tokens:
+                        seq.last_tokens.push(token_id)
+                    continue
+                logits = np.ctypeslib.as_array(llama_cpp.llama_get_logits_ith(ctx, logits_index), shape=(n_vocab,))
+                if not hard_mask:
+                    # The soft mask changes the logits in place, and the sequences forked from a prompt share its logits.
+                    logits = logits.copy()
+                id = sample_next_token(ctx, logits, buffers, seq.last_tokens, suggestions, prefix_index, hard_mask)
+                seq.remaining_tokens -= 1
+                chunk = seq.history.append(prefix_index.vocab[id])
+                if chunk:
+                    yield (seq.index, chunk)
+                if id == eos or seq.remaining_tokens <= 0 or (stop_text is not None and stop_text in chunk):
+                    seq.finished = True
+                else:
+                    seq.pending_tokens = [id]
+
+            # The finished sequences leave the batch
+            for seq in active:
+                if seq.finished:
+                    llama_cpp.llama_kv_cache_seq_rm(ctx, seq.seq_id, -1, -1)
+                    free_seq_ids.append(seq.seq_id)
+            active = [seq for seq in active if not seq.finished]
+            if not active:
+                continue
+
+            # Put the pending tokens of all the sequences in one batch
+            n_tokens = 0
+            for seq in active:
+                n = min(len(seq.pending_tokens), n_batch - n_tokens)
+                for token_id in seq.pending_tokens[:n]:
+                    batch.token[n_tokens] = token_id
+                    batch.pos[n_tokens] = seq.n_past
+                    batch.n_seq_id[n_tokens] = 1
+                    batch.seq_id[n_tokens][0] = seq.seq_id
+                    batch.logits[n_tokens] = False
+                    seq.n_past += 1
+                    n_tokens += 1
+                seq.pending_tokens = seq.pending_tokens[n:]
+                if n > 0 and not seq.pending_tokens:
+                    # All the inputs of the sequence are in the batch, its next token can be sampled.
+                    batch.logits[n_tokens - 1] = True
+                    seq.logits_index = n_tokens - 1
+                if n_tokens == n_batch:
+                    break
+            batch.n_tokens = n_tokens
+            if llama_cpp.llama_decode(ctx, batch) != 0:
+                raise RuntimeError("llama_decode failed: the context is too small for the batched sequences")
+    finally:
+        for seq in active:
+            llama_cpp.llama_kv_cache_seq_rm(ctx, seq.seq_id, -1, -1)
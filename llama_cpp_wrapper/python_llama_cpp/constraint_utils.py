@@ -0,0 +1,90 @@
+import os
+import re
+from typing import List
+import numpy as np
+from .vocab_utils import TokenPrefixIndex
+
+
+def adjust_logits_based_on_suggestions(suggestions: List[str], logits: np.ndarray, prefix_index: TokenPrefixIndex, hard_mask: bool = True):
+    """
+    Constrain the logits (modified in place) to the tokens which are compatible with one of the suggestions.
+    A token is compatible with a string suggestion if it is a prefix of it,
+    and with a regexp suggestion if it matches it.
+
+    Parameters:
+    suggestions (list): The suggestions of the constrainer, or directly the allowed tokens (boolean mask or ids).
+    logits (np.ndarray): The logits of the last evaluated token.
+    prefix_index (TokenPrefixIndex): The index of the vocabulary.
+    hard_mask (bool): If True, the incompatible tokens get a -inf logit and can not be sampled,
+        otherwise the compatible tokens only get a +5 bias.
+    """
+    if isinstance(suggestions, np.ndarray) and suggestions.dtype != bool:
+        # Precomputed ids of the allowed tokens (compiled schemas)
+        if len(suggestions) == 0:
+            return
+        if hard_mask:
+            allowed_logits = logits[suggestions]
+            logits.fill(-np.inf)
+            logits[suggestions] = allowed_logits
+        else:
+            logits[suggestions] += 5.0
+        return
+    if isinstance(suggestions, np.ndarray):
+        allowed = suggestions
+    else:
+        allowed = prefix_index.allowed_token_mask(suggestions)
+    if not allowed.any():
+        return
+    if hard_mask:
+        np.putmask(logits, ~allowed, -np.inf)
+    else:
+        logits[allowed] += 5.0
+
+
+def to_byte_completions(completions):
+    """
+    Encode the string completions to bytes, the form expected by the inference loop (regexps and masks are kept).
+    """
+    if isinstance(completions, list):
+        return [c.encode() if type(c) is str else c for c in completions]
+    return completions
+
+
+def allowed_token_ids(suggestions, prefix_index: TokenPrefixIndex) -> np.ndarray:
+    """
+    Returns the sorted ids of the tokens compatible with one of the suggestions.
+
+    Parameters:
+    suggestions (list): The suggestions of the constrainer, or directly the allowed tokens (boolean mask or ids).
+    prefix_index (TokenPrefixIndex): The index of the vocabulary.
+    """
+    if isinstance(suggestions, np.ndarray):
+        if suggestions.dtype != bool:
+            return suggestions
+        return np.flatnonzero(suggestions).astype(np.intc)
+    return prefix_index.allowed_token_ids(suggestions)
+
+
+def forced_prefix(suggestions) -> bytes:
+    """
+    This function returns the text determined by the suggestions: the longest prefix shared by all of them
+    (the whole suggestion if there is only one). It can be added without sampling.
+
+    Parameters:
+    suggestions: The suggestions of the constrainer (bytes or compiled regexps), the allowed tokens (mask or ids), or None.
+
+    Returns:
+    bytes: The forced text, empty if the next token has to be sampled.
+    """
+    if type(suggestions) is not list or len(suggestions) == 0 \
+            or any(isinstance(suggestion, re.Pattern) for suggestion in suggestions):
+        return b""
+    prefix = os.path.commonprefix(suggestions)
+    # Do not cut a utf-8 character
+    while prefix:
+        try:
+            prefix.decode()
+            break
+        except UnicodeDecodeError:
+            prefix = prefix[:-1]
+    return prefix
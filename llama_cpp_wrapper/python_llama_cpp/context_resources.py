@@ -0,0 +1,37 @@
+import threading
+from concurrent.futures import Executor
+from typing import Callable, Dict, Hashable
+
+
+# The objects attached to each context (sampling buffers, grammars, evaluation thread...), dropped when it is freed.
+_context_resources: Dict[object, dict] = {}
+_context_resources_lock = threading.Lock()
+
+
+def get_context_resource(ctx, key: Hashable, create: Callable[[], object]):
+    """
+    This function returns an object attached to a context, created once by `create()`.
+    Unlike a cache keyed by the context, it does not keep a freed context alive: see free_context_resources.
+
+    Parameters:
+    ctx (llama_cpp.llama_context): The context.
+    key: The name (and settings) of the object.
+    create (function): It creates the object the first time it is needed.
+    """
+    with _context_resources_lock:
+        resources = _context_resources.setdefault(ctx, {})
+        resource = resources.get(key)
+        if resource is None:
+            resource = resources[key] = create()
+    return resource
+
+
+def free_context_resources(ctx):
+    """
+    This function drops the objects attached to a context, before the context is freed (the executors are shut down).
+    """
+    with _context_resources_lock:
+        resources = _context_resources.pop(ctx, {})
+    for resource in resources.values():
+        if isinstance(resource, Executor):
+            resource.shutdown(wait=False)
@@ -0,0 +1,100 @@
+import threading
+import time
+from typing import Dict, List
+import numpy as np
+
+
+class GenerationStats:
+    """
+    This is the timing breakdown of a generation, filled by do_inference:
+    the evaluation of the prompt, the evaluation of each generated token, and the Python side work of each step
+    (completion callback, masking of the logits, sampling). Durations are in seconds.
+    """
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.end_time = None
+        self.n_prompt_tokens = 0
+        self.prompt_eval_time = 0.0
+        self.forced_eval_time = 0.0
+        self.token_eval_times: List[float] = []
+        self.callback_times: List[float] = []
+        self.mask_times: List[float] = []
+        self.sample_times: List[float] = []
+        self.n_forced_tokens = 0
+        self.n_sampled_tokens = 0
+
+    def finish(self):
+        if self.end_time is None:
+            self.end_time = time.perf_counter()
+
+    @property
+    def total_time(self) -> float:
+        end_time = self.end_time if self.end_time is not None else time.perf_counter()
+        return end_time - self.start_time
+
+    @property
+    def tokens_per_second(self) -> float:
+        """
+        The number of generated tokens (sampled and forced) per second, after the evaluation of the prompt.
+        """
+        generation_time = self.total_time - self.prompt_eval_time
+        n_tokens = self.n_forced_tokens + self.n_sampled_tokens
+        return n_tokens / generation_time if generation_time > 0 else 0.0
+
+    def to_dict(self) -> Dict[str, float]:
+        def mean(values):
+            return float(np.mean(values)) if values else 0.0
+        return {
+            "total_time": self.total_time,
+            "n_prompt_tokens": self.n_prompt_tokens,
+            "prompt_eval_time": self.prompt_eval_time,
+            "forced_eval_time": self.forced_eval_time,
+            "token_eval_time": mean(self.token_eval_times),
+            "callback_time": mean(self.callback_times),
+            "mask_time": mean(self.mask_times),
+            "sample_time": mean(self.sample_times),
+            "n_forced_tokens": self.n_forced_tokens,
+            "n_sampled_tokens": self.n_sampled_tokens,
+            "tokens_per_second": self.tokens_per_second,
+        }
+
+
+class StatsHistograms:
+    """
+    This aggregates the stats of many generations (e.g. in a server) into histograms,
+    with logarithmic buckets from 1 microsecond to 100 seconds.
+    """
+    bucket_bounds = 10.0 ** np.arange(-6, 2.25, 0.25)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.n_generations = 0
+        self.counts: Dict[str, np.ndarray] = {}
+
+    def _add(self, name: str, values):
+        counts = self.counts.get(name)
+        if counts is None:
+            counts = self.counts[name] = np.zeros(len(self.bucket_bounds) + 1, dtype=np.int64)
+        np.add.at(counts, np.searchsorted(self.bucket_bounds, values), 1)
+
+    def add(self, stats: GenerationStats):
+        with self.lock:
+            self.n_generations += 1
+            self._add("total_time", [stats.total_time])
+            self._add("prompt_eval_time", [stats.prompt_eval_time])
+            self._add("token_eval_time", stats.token_eval_times)
+            self._add("callback_time", stats.callback_times)
+            self._add("mask_time", stats.mask_times)
+            self._add("sample_time", stats.sample_times)
+
+    def to_dict(self) -> dict:
+        """
+        Returns:
+        dict: For each metric, the count of values below each bucket bound (the last count is above the last bound).
+        """
+        with self.lock:
+            return {
+                "n_generations": self.n_generations,
+                "bucket_bounds": self.bucket_bounds.tolist(),
+                "counts": {name: counts.tolist() for name, counts in self.counts.items()},
+            }
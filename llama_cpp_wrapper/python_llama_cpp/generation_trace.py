@@ -0,0 +1,50 @@
+import json
+import re
+from typing import List, Union
+import numpy as np
+
+
+def _suggestions_to_json(suggestions):
+    if suggestions is None:
+        return None
+    if isinstance(suggestions, np.ndarray):
+        # The number of allowed tokens (boolean mask or ids)
+        return {"mask": int(suggestions.sum()) if suggestions.dtype == bool else len(suggestions)}
+    return [{"regexp": s.pattern} if isinstance(s, re.Pattern) else {"text": s.decode(errors="replace")} for s in suggestions]
+
+
+class GenerationTrace:
+    """
+    This is the record of a generation: at each step, the history given to the completion callback,
+    its suggestions, and the chosen token (None when the text was forced).
+    It can be saved as JSON lines, to replay the constraint work of real generations without the model (see benchmark.py).
+    """
+    def __init__(self, prompt: str = None, json_schema: dict = None):
+        self.prompt = prompt
+        self.json_schema = json_schema
+        self.steps: List[dict] = []
+
+    def record(self, history: str, suggestions, token_id: Union[int, None], piece: bytes):
+        self.steps.append({
+            "history": history,
+            "suggestions": _suggestions_to_json(suggestions),
+            "token": token_id,
+            "piece": piece.hex(),
+        })
+
+    def save(self, path: str):
+        """
+        Save the trace: a first line with the prompt and the schema, then one line per step.
+        """
+        with open(path, "w") as f:
+            f.write(json.dumps({"prompt": self.prompt, "json_schema": self.json_schema}) + "\n")
+            for step in self.steps:
+                f.write(json.dumps(step) + "\n")
+
+    @staticmethod
+    def load(path: str) -> "GenerationTrace":
+        with open(path) as f:
+            header = json.loads(f.readline())
+            trace = GenerationTrace(header["prompt"], header["json_schema"])
+            trace.steps = [json.loads(line) for line in f if line.strip()]
+        return trace
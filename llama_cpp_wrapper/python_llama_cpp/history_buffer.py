@@ -0,0 +1,73 @@
+import codecs
+from typing import List
+
+
+class HistoryBuffer:
+    """
+    This is the history of a generation, made of the bytes of the evaluated tokens, decoded incrementally.
+    A token can end in the middle of a multi-byte utf-8 character: its bytes are then kept by the decoder
+    until the character is complete, instead of failing to decode.
+    The text appended since the previous call of `new_text` is read without rebuilding the whole history.
+    """
+    def __init__(self, data: bytes = b"", keep_text: bool = True):
+        """
+        Parameters:
+        data (bytes): The initial bytes.
+        keep_text (bool): If False, the text is dropped once it is read by `new_text`, and `text` can not be used.
+        """
+        self.n_bytes = 0
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.keep_text = keep_text
+        self.text_parts: List[str] = []
+        # Number of text parts already returned by new_text
+        self.n_read_parts = 0
+        self._text = ""
+        self._n_joined_parts = 0
+        self.append(data)
+
+    def append(self, piece: bytes) -> str:
+        """
+        Append the bytes of a token.
+
+        Returns:
+        str: The newly decoded text (empty if the bytes end in the middle of a character).
+        """
+        self.n_bytes += len(piece)
+        text = self.decoder.decode(piece)
+        if text:
+            self.text_parts.append(text)
+        return text
+
+    def copy(self) -> "HistoryBuffer":
+        """
+        Returns a buffer continuing from the same bytes (including a character not complete yet), with no text.
+        The text is not kept, so only `new_text` can be used.
+        """
+        other = HistoryBuffer(keep_text=False)
+        other.n_bytes = self.n_bytes
+        other.decoder.setstate(self.decoder.getstate())
+        return other
+
+    def new_text(self) -> str:
+        """
+        Returns:
+        str: The text appended since the previous call.
+        """
+        text = "".join(self.text_parts[self.n_read_parts:])
+        if self.keep_text:
+            self.n_read_parts = len(self.text_parts)
+        else:
+            self.text_parts.clear()
+        return text
+
+    def text(self) -> str:
+        """
+        Returns:
+        str: The whole decoded text.
+        """
+        if not self.keep_text:
+            raise Exception("The text of the history is not kept")
+        if self._n_joined_parts < len(self.text_parts):
+            self._text += "".join(self.text_parts[self._n_joined_parts:])
+            self._n_joined_parts = len(self.text_parts)
+        return self._text
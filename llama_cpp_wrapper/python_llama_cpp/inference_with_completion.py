@@ -1,180 +1,512 @@
 # Import necessary libraries
 import ctypes
 import os
-from typing import List
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import List, Dict
 from .model_utils import get_context, get_model
+from .context_resources import get_context_resource
+from .vocab_utils import TokenPrefixIndex, Vocab, vocab_cache_path
+from .constraint_utils import adjust_logits_based_on_suggestions, allowed_token_ids, forced_prefix
+from .prompt_cache import PromptCache
+from .generation_trace import GenerationTrace
+from .generation_stats import GenerationStats
+from .history_buffer import HistoryBuffer
+from functools import lru_cache
 import sys
+import time
 # Import the llama_cpp library
 import llama_cpp
-import re
+import numpy as np
 
-def get_vocab(model) -> List[str]:
-    vocab = []
+def token_to_piece(model, token_id: int, buffer_size: int = 32) -> bytes:
+    """
+    This function returns the text (bytes) of a token, whatever its length.
+    """
+    buffer = (ctypes.c_char * buffer_size)()
+    n = llama_cpp.llama_token_to_piece(model, llama_cpp.llama_token(token_id), buffer, buffer_size)
+    if n < 0:
+        # The buffer is too small, -n is the required size.
+        return token_to_piece(model, token_id, -n)
+    return buffer[:n]
+
+def extract_vocab(model) -> Vocab:
+    """
+    This function extracts the pieces of all the tokens of a model.
+    """
     n_vocab = llama_cpp.llama_n_vocab(model)
-    size = 32
-    buffer = (ctypes.c_char * size)()
-    for id in range(n_vocab):
-        n = llama_cpp.llama_token_to_piece(
-            model, llama_cpp.llama_token(id), buffer, size)
-        vocab.append(buffer[:n])
+    return Vocab.from_pieces([token_to_piece(model, id) for id in range(n_vocab)])
+
+def get_vocab(model, model_path: str = None) -> Vocab:
+    """
+    This function returns the vocabulary of a model.
+    If the path of the model is given, the vocabulary is extracted only once per model file:
+    it is cached next to the model file, and memory-mapped by the next runs.
+
+    Parameters:
+    model (llama_cpp.llama_model): The model.
+    model_path (str): The path of the model file.
+
+    Returns:
+    Vocab: The vocabulary.
+    """
+    if model_path is None:
+        return extract_vocab(model)
+    cache_path = vocab_cache_path(model_path)
+    if os.path.exists(cache_path):
+        return Vocab.load(cache_path)
+    vocab = extract_vocab(model)
+    try:
+        vocab.save(cache_path)
+    except OSError:
+        # The directory of the model may be read-only, the vocabulary is just not cached.
+        pass
     return vocab
 
-def adjust_logits_based_on_suggestions(suggestions: List[str], logits, vocab: List[str], n_vocab: int):
-    for v in range(n_vocab):
-        word = vocab[v]
-        for suggestion in suggestions:
-            if isinstance(suggestion, re.Pattern):
-                if suggestion.match(str(word)):
-                    logits[v] += 5.0
-                    break
-                continue
-            if len(word) > len(suggestion):
-                continue
-            # length = len(suggestion)
-            length = min(len(word), len(suggestion))
-            if length == 0:
-                continue
-            elif word[:length] == suggestion[:length]:
-                # print(word)
-                # print(logits[v])
-                logits[v] += 5.0
-                # print(logits[v])
-                break
+# Numpy equivalent of llama_cpp.llama_token_data
+llama_token_data_dtype = np.dtype([("id", np.intc), ("logit", np.single), ("p", np.single)], align=True)
+
+class LastTokens:
+    """
+    Ring buffer of the last tokens of a sequence, for the penalties (their order does not matter).
+    """
+    def __init__(self, size: int):
+        self.size = size
+        self.tokens = (llama_cpp.llama_token * size)()
+        self.pos = 0
+
+    def reset(self):
+        ctypes.memset(self.tokens, 0, ctypes.sizeof(self.tokens))
+        self.pos = 0
+
+    def push(self, token_id: int):
+        self.tokens[self.pos] = token_id
+        self.pos = (self.pos + 1) % self.size
+
+    def fill(self, tokens: List[int]):
+        """
+        Replace the content of the buffer by the last tokens of the given list.
+        """
+        self.reset()
+        for token_id in tokens[-self.size:]:
+            self.push(token_id)
+
+class SamplingBuffers:
+    """
+    This class holds the buffers of the sampling loop.
+    They are allocated once per context and refilled in place at each step,
+    instead of allocating new ctypes arrays for every generated token.
+    """
+    def __init__(self, ctx, model, n_batch: int, last_n_size: int):
+        self.n_vocab = llama_cpp.llama_n_vocab(model)
+        self.token_ids = np.arange(self.n_vocab, dtype=np.intc)
+        self.candidates = np.empty(self.n_vocab, dtype=llama_token_data_dtype)
+        self.candidates_array = llama_cpp.llama_token_data_array(
+            self.candidates.ctypes.data_as(llama_cpp.llama_token_data_p), self.n_vocab, False)
+        self.candidates_p = ctypes.pointer(self.candidates_array)
+        self.last_tokens = LastTokens(last_n_size)
+        self.eval_tokens = (llama_cpp.llama_token * n_batch)()
+        self.tokenize_tokens = (llama_cpp.llama_token * llama_cpp.llama_n_ctx(ctx))()
+
+    def reset(self):
+        self.last_tokens.reset()
+
+    def fill_candidates(self, logits: np.ndarray, token_ids: np.ndarray = None):
+        """
+        Fill the candidates with the logits (the sampling functions sort them and change their size in place).
+        If token_ids is set, the candidates are only these tokens.
+
+        Returns:
+        The pointer to the llama_token_data_array of the candidates.
+        """
+        if token_ids is None:
+            token_ids = self.token_ids
+            candidates = self.candidates
+            np.copyto(candidates["logit"], logits)
         else:
-            logits[v] -= -5.0
+            candidates = self.candidates[:len(token_ids)]
+            np.take(logits, token_ids, out=candidates["logit"])
+        np.copyto(candidates["id"], token_ids)
+        candidates["p"] = 0.0
+        self.candidates_array.size = len(token_ids)
+        self.candidates_array.sorted = False
+        return self.candidates_p
+
+    def eval(self, ctx, tokens: List[int], n_past: int):
+        n_tokens = len(tokens)
+        self.eval_tokens[:n_tokens] = tokens
+        llama_cpp.llama_eval(ctx, self.eval_tokens, n_tokens, n_past)
+
+    def tokenize(self, model, text: bytes, add_bos: bool) -> List[int]:
+        n_tokens = llama_cpp.llama_tokenize(model, text, len(text), self.tokenize_tokens, len(self.tokenize_tokens), add_bos)
+        if n_tokens < 0:
+            # The buffer is too small (e.g. a prompt longer than the context), -n_tokens is the required size.
+            self.tokenize_tokens = (llama_cpp.llama_token * -n_tokens)()
+            n_tokens = llama_cpp.llama_tokenize(model, text, len(text), self.tokenize_tokens, len(self.tokenize_tokens), add_bos)
+            if n_tokens < 0:
+                raise RuntimeError(f"llama_tokenize failed: {-n_tokens} tokens do not fit in a buffer of {len(self.tokenize_tokens)}")
+        return self.tokenize_tokens[:n_tokens]
+
+def get_sampling_buffers(ctx, model, n_batch: int, last_n_size: int) -> SamplingBuffers:
+    """
+    This function returns the sampling buffers of a context, allocated once (they are dropped when the context is freed).
+    """
+    return get_context_resource(ctx, ("sampling_buffers", model, n_batch, last_n_size),
+                                lambda: SamplingBuffers(ctx, model, n_batch, last_n_size))
+
+def get_llama_grammar(gbnf: str, ctx, max_grammars: int = 256) -> llama_cpp.LlamaGrammar:
+    """
+    This function parses a GBNF grammar once per context (the state of a grammar is used by one generation at a time,
+    and a context is used by one generation at a time). Reset it before each generation.
+    The last max_grammars grammars used by the context are kept.
+    """
+    grammars = get_context_resource(ctx, "grammars", OrderedDict)
+    grammar = grammars.get(gbnf)
+    if grammar is None:
+        grammar = grammars[gbnf] = llama_cpp.LlamaGrammar.from_string(gbnf, verbose=False)
+        while len(grammars) > max_grammars:
+            grammars.popitem(last=False)
+    else:
+        grammars.move_to_end(gbnf)
+    return grammar
+
+def get_eval_executor(ctx) -> ThreadPoolExecutor:
+    """
+    This function returns the thread evaluating the tokens of a context in pipelined mode (one per context,
+    so the evaluations of a context never overlap, even if a generation is interrupted during an evaluation).
+    """
+    return get_context_resource(ctx, "eval_executor", lambda: ThreadPoolExecutor(max_workers=1))
+
+@lru_cache(maxsize=None)
+def get_token_prefix_index(model, model_path: str = None) -> TokenPrefixIndex:
+    """
+    This function indexes the vocabulary of a model once, so it can be reused at every generation step.
+    """
+    return TokenPrefixIndex(get_vocab(model, model_path))
+
+def tokenize_forced_text(model, text: bytes, buffers: SamplingBuffers, prefix_index: TokenPrefixIndex,
+                         literal_tokens_cache: Dict[bytes, List[int]] = None) -> List[int]:
+    """
+    This function tokenizes a text forced in the middle of a generation.
+    It is tokenized without BOS, and the pieces of the tokens must be exactly the text, so it starts on the boundary
+    of the previous token (llama_tokenize may add a leading space). If they are not, the text is tokenized greedily.
+
+    Parameters:
+    model (llama_cpp.llama_model): The model.
+    text (bytes): The forced text.
+    buffers (SamplingBuffers): The buffers of the context.
+    prefix_index (TokenPrefixIndex): The index of the vocabulary.
+    literal_tokens_cache (dict): If set, the tokenizations are cached in it (the literals of a schema are forced again and again).
+
+    Returns:
+    list: The tokens.
+    """
+    if literal_tokens_cache is not None:
+        tokens = literal_tokens_cache.get(text)
+        if tokens is not None:
+            return tokens
+    tokens = buffers.tokenize(model, text, False)
+    if b"".join(prefix_index.vocab[token_id] for token_id in tokens) != text:
+        tokens = prefix_index.tokenize_greedy(text)
+        if tokens is None:
+            tokens = buffers.tokenize(model, text, False)
+    if literal_tokens_cache is not None:
+        if len(literal_tokens_cache) >= 4096:
+            literal_tokens_cache.clear()
+        literal_tokens_cache[text] = tokens
+    return tokens
+
+def forced_closing_text(closing_callback, remaining_tokens: int, model, buffers: SamplingBuffers, prefix_index: TokenPrefixIndex,
+                        literal_tokens_cache: Dict[bytes, List[int]] = None) -> bytes:
+    """
+    This function returns the closing text of a generation if it has to be forced at the next step:
+    when its tokens, and one more, do not fit in the remaining budget of tokens.
+    It replaces a sampled token as well as a forced text (the forced text is the start of the closing text,
+    since all the continuations start with it), so a forced text is never added if the closing text could not follow it.
+
+    Parameters:
+    closing_callback (function): It returns the shortest text (bytes) which ends the generation, or None (see do_inference).
+    remaining_tokens (int): The number of tokens left in the budget.
+
+    Returns:
+    bytes: The closing text, or b"" if the generation can go on.
+    """
+    closing_text = closing_callback()
+    # Its length in bytes bounds its number of tokens, so it is only tokenized near the end of the budget.
+    if closing_text and len(closing_text) + 1 >= remaining_tokens and \
+            len(tokenize_forced_text(model, closing_text, buffers, prefix_index, literal_tokens_cache)) + 1 >= remaining_tokens:
+        return closing_text
+    return b""
+
+def sample_next_token(ctx, logits: np.ndarray, buffers: SamplingBuffers, last_tokens: LastTokens,
+                      suggestions, prefix_index: TokenPrefixIndex, hard_mask: bool = True,
+                      last_n_repeat: int = 64, repeat_penalty: float = 1, frequency_penalty: float = 0.0, presence_penalty: float = 0.0,
+                      top_k: int = 40, top_p: float = 0.8, temperature: float = 0.2, stats: GenerationStats = None,
+                      grammar: llama_cpp.LlamaGrammar = None, allowed_ids: np.ndarray = None) -> int:
+    """
+    This function samples the next token of a sequence from its logits, constrained by the suggestions.
 
+    Parameters:
+    ctx (llama_cpp.llama_context): The context.
+    logits (np.ndarray): The logits of the last evaluated token of the sequence (modified in place with a soft mask).
+    buffers (SamplingBuffers): The buffers of the context.
+    last_tokens (LastTokens): The last tokens of the sequence, the sampled token is added to them.
+    suggestions: The suggestions of the constrainer (or the mask of the allowed tokens), or None.
+    prefix_index (TokenPrefixIndex): The index of the vocabulary.
+    hard_mask (bool): See adjust_logits_based_on_suggestions. With a hard mask, the candidates of the sampling are only the allowed tokens
+        (the penalties, top-k, top-p and temperature give the same probabilities, since the other tokens have a null probability),
+        and if only one token is allowed, it is chosen without sampling.
+    stats (GenerationStats): If set, the masking and sampling times are added to it.
+    grammar (llama_cpp.LlamaGrammar): If set, the sampling is also constrained by this grammar (in llama.cpp),
+        and the sampled token is accepted by it.
+    allowed_ids (np.ndarray): The allowed_token_ids of the suggestions, if they are already computed.
 
-def do_inference(prompt, model_path=None, model=None, ctx=None, completion_callback=None, verbose=True):
+    Returns:
+    int: The sampled token.
+    """
+    start_time = time.perf_counter()
+    token_ids = None
+    if suggestions is not None and hard_mask:
+        # Only the allowed tokens are candidates (if none is allowed, the sampling is not constrained).
+        token_ids = allowed_ids if allowed_ids is not None else allowed_token_ids(suggestions, prefix_index)
+        if len(token_ids) == 0:
+            token_ids = None
+    elif suggestions is not None:
+        # Adjust logits based on suggestions to make sure than one of the suggestion is chosen.
+        adjust_logits_based_on_suggestions(suggestions, logits, prefix_index, hard_mask)
+    mask_time = time.perf_counter()
+
+    if token_ids is not None and len(token_ids) == 1:
+        id = int(token_ids[0])
+    else:
+        # Fill the preallocated array of token data with the logits
+        candidates_p = buffers.fill_candidates(logits, token_ids)
+
+        # Apply penalties and sample tokens
+        _arr = last_tokens.tokens
+        llama_cpp.llama_sample_repetition_penalty(ctx, candidates_p, _arr, last_n_repeat, repeat_penalty)
+        llama_cpp.llama_sample_frequency_and_presence_penalties(ctx, candidates_p, _arr, last_n_repeat, frequency_penalty, presence_penalty)
+        if grammar is not None:
+            llama_cpp.llama_sample_grammar(ctx, candidates_p, grammar.grammar)
+        llama_cpp.llama_sample_top_k(ctx, candidates_p, k=top_k, min_keep=1)
+        llama_cpp.llama_sample_top_p(ctx, candidates_p, p=top_p, min_keep=1)
+        llama_cpp.llama_sample_temperature(ctx, candidates_p, temp=temperature)
+        id = llama_cpp.llama_sample_token(ctx, candidates_p)
+    if grammar is not None:
+        llama_cpp.llama_grammar_accept_token(ctx, grammar.grammar, id)
+    last_tokens.push(id)
+    if stats is not None:
+        stats.mask_times.append(mask_time - start_time)
+        stats.sample_times.append(time.perf_counter() - mask_time)
+        stats.n_sampled_tokens += 1
+    return id
+
+
+def do_inference(prompt, model_path=None, model=None, ctx=None, completion_callback=None, verbose=True, hard_mask=True, prompt_cache: PromptCache = None,
+                 jump_forward: bool = True, literal_tokens_cache: Dict[bytes, List[int]] = None, trace: GenerationTrace = None,
+                 stats: GenerationStats = None, incremental_callback: bool = False, grammar_gbnf: str = None,
+                 n_predict: int = 200, closing_callback=None, pipelined: bool = False):
+    """
+    This function generates text after a prompt, constrained by the suggestions of the completion callback, and yields the generated chunks.
+
+    Parameters:
+    prompt (bytes): The prompt.
+    completion_callback (function): It returns the suggestions for the text generated so far (or since its previous call with incremental_callback).
+    n_predict (int): The maximum number of generated tokens (sampled and forced).
+    closing_callback (function): If set, it returns the shortest text (bytes) which ends the generation in the current state.
+        Once the remaining budget of tokens is about to be smaller than the tokens of this text, the text is forced
+        instead of the next sampled token or forced text (see forced_closing_text), so the generation ends properly
+        instead of being truncated. The closing text is added even if it exceeds the budget (when a sampled token,
+        such as an item separator, made it longer than the tokens left).
+        It is called after the completion callback (which can return None to only follow the text, e.g. with grammar_gbnf),
+        and it returns None if the text can not be ended.
+    pipelined (bool): If True, each sampled token is evaluated in a worker thread (llama_eval releases the GIL),
+        while the completion callback gets its text and the allowed tokens of the next step are computed.
+    """
     if model is None and model_path is not None:
         model = get_model(model_path)
     if ctx is None and model is not None:
         ctx = get_context(model)
-    vocab = get_vocab(model)
-    # Determine the required inference memory per token
-    tmp = [0, 1, 2, 3]
-    n_past = 0
-    llama_cpp.llama_eval(ctx, (llama_cpp.c_int * len(tmp))(*tmp), len(tmp), n_past)
+    prefix_index = get_token_prefix_index(model, model_path)
 
     # Add a space to the beginning of the prompt
     prompt = b" " + prompt
 
+    # Get the buffers of the sampling loop (allocated once per context)
+    last_n_size = 64
+    n_batch = 24
+    buffers = get_sampling_buffers(ctx, model, n_batch, last_n_size)
+    buffers.reset()
+
+    # Native grammar constrained sampling (in llama.cpp)
+    grammar = None
+    if grammar_gbnf is not None:
+        grammar = get_llama_grammar(grammar_gbnf, ctx)
+        grammar.reset()
+
     # Tokenize the prompt
-    embd_inp = (llama_cpp.llama_token * (len(prompt) + 1))()
-    n_of_tok = llama_cpp.llama_tokenize(model, prompt, len(prompt), embd_inp, len(embd_inp), True)
-    embd_inp = embd_inp[:n_of_tok]
+    embd_inp = buffers.tokenize(model, prompt, True)
 
     # Get the number of context tokens
     n_ctx = llama_cpp.llama_n_ctx(ctx)
 
     # Define the number of tokens to predict
-    n_predict = 200
     n_predict = min(n_predict, n_ctx - len(embd_inp))
 
+    # Resume from the longest prefix of the prompt already evaluated
+    prompt_tokens = embd_inp
+    n_past = 0
+    if prompt_cache is not None:
+        n_past = prompt_cache.restore(ctx, prompt_tokens)
+    n_reused = n_past
+    evaluated_tokens = list(prompt_tokens[:n_past])
+    if prompt_cache is not None:
+        prompt_cache.set_context_tokens(ctx, evaluated_tokens)
+    for token_id in prompt_tokens[max(n_past - last_n_size, 0):n_past]:
+        buffers.last_tokens.push(token_id)
+
     # Initialize variables
-    input_consumed = 0
+    input_consumed = n_past
     input_noecho = False
     remaining_tokens = n_predict
     embd = []
-    last_n_size = 64
-    last_n_tokens_data = [0] * last_n_size
-    n_batch = 24
-    last_n_repeat = 64
-    repeat_penalty = 1
-    frequency_penalty = 0.0
-    presence_penalty = 0.0
 
     auto_complete_suggestions = None
-    history = ""
-    # Main loop for token prediction
-    while remaining_tokens > 0:
-        # Evaluate the model with the current tokens
-        if len(embd) > 0:
-            llama_cpp.llama_eval(ctx, (llama_cpp.c_int * len(embd))(*embd), len(embd), n_past)
-        n_past += len(embd)
-        embd = []
-
-        # Auto-completion
-        if len(embd_inp) <= input_consumed and completion_callback is not None:
-            # Compute the auto completions.
-            auto_complete_suggestions = completion_callback(history)
-            # If there is only one auto completion's suggestion, directly add it.
-            there_is_one_suggestion = auto_complete_suggestions \
-                and type(auto_complete_suggestions) is list \
-                and len(auto_complete_suggestions) == 1 \
-                and not isinstance(auto_complete_suggestions[0], re.Pattern)
-            if there_is_one_suggestion:
-                new_prompt = auto_complete_suggestions[0]
-                embd_inp2 = (llama_cpp.llama_token * (len(new_prompt) + 1))()
-                n_of_tok2 = llama_cpp.llama_tokenize(model, new_prompt, len(new_prompt), embd_inp2, len(embd_inp2), True)
-                embd_inp2 = embd_inp2[:n_of_tok2]
-                input_consumed = 0
-                embd_inp = embd_inp2
-
-        is_consuming_inputs = True
-        # If all input tokens have been consumed, generate new tokens
-        if len(embd_inp) <= input_consumed:
-            is_consuming_inputs = False
-            # Get the logits from the model
-            logits = llama_cpp.llama_get_logits(ctx)            
-            n_vocab = llama_cpp.llama_n_vocab(model)
-
-            # If there is at least two auto-complete's suggestion
-            # (one suggestion case is handle else where),
-            #  adjust logits based on suggestions to make sure than one of the suggestion is chosen.
-            if auto_complete_suggestions is not None and not there_is_one_suggestion:
-                adjust_logits_based_on_suggestions(auto_complete_suggestions, logits, vocab, n_vocab)
-
-            # Create an array of token data
-            _arr = (llama_cpp.llama_token_data * n_vocab)(*[
-                llama_cpp.llama_token_data(token_id, logits[token_id], 0.0)
-                for token_id in range(n_vocab)
-            ])
-            candidates_p = llama_cpp.ctypes.pointer(
-                llama_cpp.llama_token_data_array(_arr, len(_arr), False))
-
-            # Apply penalties and sample tokens
-            _arr = (llama_cpp.c_int * len(last_n_tokens_data))(*last_n_tokens_data)
-            llama_cpp.llama_sample_repetition_penalty(ctx, candidates_p, _arr, last_n_repeat, repeat_penalty)
-            llama_cpp.llama_sample_frequency_and_presence_penalties(ctx, candidates_p, _arr, last_n_repeat, frequency_penalty, presence_penalty)
-            llama_cpp.llama_sample_top_k(ctx, candidates_p, k=40, min_keep=1)
-            llama_cpp.llama_sample_top_p(ctx, candidates_p, p=0.8, min_keep=1)
-            llama_cpp.llama_sample_temperature(ctx, candidates_p, temp=0.2)
-            id = llama_cpp.llama_sample_token(ctx, candidates_p)
-
-            # Update the tokens
-            last_n_tokens_data = last_n_tokens_data[1:] + [id]
-            embd.append(id)
-            input_noecho = False
-            remaining_tokens -= 1
-        else:
-            # If there are still input tokens, consume them
-            while len(embd_inp) > input_consumed:
-                embd.append(embd_inp[input_consumed])
-                last_n_tokens_data = last_n_tokens_data[1:] + [embd_inp[input_consumed]]
-                input_consumed += 1
-                if len(embd) >= n_batch:
-                    break
-
-        # Print the generated tokens
-        if not input_noecho:
-            for id in embd:
-                size = 32
-                buffer = (ctypes.c_char * size)()
-                n = llama_cpp.llama_token_to_piece(model, llama_cpp.llama_token(id), buffer, size)
-                assert n <= size
-                chunk = buffer[:n].decode('utf-8')
-                # Yield chunks if they are not part of the input sequence.
-                # If the chunk is part of an autocompletion it should be yield as well.
-                if not is_consuming_inputs or auto_complete_suggestions is not None:
-                    yield chunk
-                if verbose:
-                    print(chunk, end="", flush=True)
-                sys.stdout.flush()
-                history += buffer[:n].decode()
-
-        # Break the loop if the end of sentence token is generated
-        if len(embd) > 0 and embd[-1] == llama_cpp.llama_token_eos(ctx):
-            break
+    # The history starts with the text of the reused prompt tokens, which are not evaluated again.
+    # With incremental_callback, the completion callback only gets the text generated since its previous call,
+    # so the whole history is not kept (except for the trace).
+    history = HistoryBuffer(keep_text=not incremental_callback or trace is not None)
+    for token_id in prompt_tokens[:n_past]:
+        history.append(prefix_index.vocab[token_id])
+    prompt_read = False
+    if stats is not None:
+        stats.n_prompt_tokens = len(prompt_tokens)
+    # Kind of the tokens of embd for the stats: "prompt", "forced" or "sampled"
+    embd_kind = "prompt"
+
+    def evaluate(tokens: List[int], n_past: int, embd_kind: str):
+        eval_start_time = time.perf_counter()
+        buffers.eval(ctx, tokens, n_past)
+        if stats is not None:
+            eval_time = time.perf_counter() - eval_start_time
+            if embd_kind == "prompt":
+                stats.prompt_eval_time += eval_time
+            elif embd_kind == "forced":
+                stats.forced_eval_time += eval_time
+            else:
+                stats.token_eval_times.append(eval_time)
+        evaluated_tokens.extend(tokens)
+        if prompt_cache is not None and n_past < len(prompt_tokens) <= n_past + len(tokens):
+            # The prompt has just been fully evaluated
+            prompt_cache.save(ctx, prompt_tokens, n_reused)
+
+    # Main loop for token prediction (the forced tokens already tokenized are consumed even if the budget is exceeded)
+    eval_future = None
+    try:
+        while remaining_tokens > 0 or (embd_kind == "forced" and input_consumed < len(embd_inp)):
+            # Evaluate the model with the current tokens
+            if len(embd) > 0:
+                if pipelined and embd_kind == "sampled":
+                    # The constraint work of the next step runs during the evaluation of the sampled token.
+                    eval_future = get_eval_executor(ctx).submit(evaluate, embd, n_past, embd_kind)
+                else:
+                    evaluate(embd, n_past, embd_kind)
+            n_past += len(embd)
+            embd = []
+            allowed_ids = None
+
+            # Auto-completion
+            if len(embd_inp) <= input_consumed and completion_callback is not None:
+                # Compute the auto completions.
+                callback_start_time = time.perf_counter()
+                if not incremental_callback:
+                    auto_complete_suggestions = completion_callback(history.text())
+                else:
+                    if not prompt_read:
+                        # The callback never sees the prompt
+                        history.new_text()
+                        prompt_read = True
+                    auto_complete_suggestions = completion_callback(history.new_text())
+                if stats is not None:
+                    stats.callback_times.append(time.perf_counter() - callback_start_time)
+                # If there is only one auto completion's suggestion, directly add it.
+                # With jump forward, the prefix shared by all the suggestions is directly added as well.
+                new_prompt = forced_prefix(auto_complete_suggestions)
+                if not jump_forward and not (type(auto_complete_suggestions) is list and len(auto_complete_suggestions) == 1):
+                    new_prompt = b""
+                if closing_callback is not None:
+                    # Force the end of the generation when the next sampled token or forced text could not be followed by it.
+                    new_prompt = forced_closing_text(closing_callback, remaining_tokens, model, buffers, prefix_index, literal_tokens_cache) or new_prompt
+                if new_prompt:
+                    if trace is not None:
+                        trace.record(history.text(), auto_complete_suggestions, None, new_prompt)
+                    input_consumed = 0
+                    embd_inp = tokenize_forced_text(model, new_prompt, buffers, prefix_index, literal_tokens_cache)
+                    embd_kind = "forced"
+                    if stats is not None:
+                        stats.n_forced_tokens += len(embd_inp)
+                if pipelined and hard_mask and auto_complete_suggestions is not None and len(embd_inp) <= input_consumed:
+                    allowed_ids = allowed_token_ids(auto_complete_suggestions, prefix_index)
+
+            if eval_future is not None:
+                eval_future.result()
+                eval_future = None
+
+            is_consuming_inputs = True
+            # If all input tokens have been consumed, generate new tokens
+            if len(embd_inp) <= input_consumed:
+                is_consuming_inputs = False
+                # Get the logits from the model, as a numpy view of the llama.cpp buffer (no copy)
+                logits = np.ctypeslib.as_array(llama_cpp.llama_get_logits(ctx), shape=(buffers.n_vocab,))
+
+                # If there is at least two auto-complete's suggestion
+                # (one suggestion case is handle else where), the sampling is constrained by them.
+                id = sample_next_token(ctx, logits, buffers, buffers.last_tokens, auto_complete_suggestions, prefix_index, hard_mask, stats=stats, grammar=grammar,
+                                       allowed_ids=allowed_ids)
+                embd_kind = "sampled"
+                if trace is not None:
+                    trace.record(history.text(), auto_complete_suggestions, id, prefix_index.vocab[id])
+
+                # Update the tokens
+                embd.append(id)
+                input_noecho = False
+                remaining_tokens -= 1
+            else:
+                # If there are still input tokens, consume them
+                while len(embd_inp) > input_consumed:
+                    embd.append(embd_inp[input_consumed])
+                    buffers.last_tokens.push(embd_inp[input_consumed])
+                    if embd_kind == "forced":
+                        if grammar is not None:
+                            llama_cpp.llama_grammar_accept_token(ctx, grammar.grammar, embd_inp[input_consumed])
+                        remaining_tokens -= 1
+                    input_consumed += 1
+                    if len(embd) >= n_batch:
+                        break
+
+            # Print the generated tokens
+            if not input_noecho:
+                for id in embd:
+                    # A token can end in the middle of a character, which is only decoded with the next token.
+                    chunk = history.append(prefix_index.vocab[id])
+                    if not chunk:
+                        continue
+                    # Yield chunks if they are not part of the prompt: the sampled tokens and the forced texts
+                    # (including the closing text forced with a native grammar, whose completion callback returns no suggestion).
+                    if not is_consuming_inputs or embd_kind == "forced":
+                        yield chunk
+                    if verbose:
+                        print(chunk, end="", flush=True)
+                    sys.stdout.flush()
+
+            # Break the loop if the end of sentence token is generated
+            if len(embd) > 0 and embd[-1] == llama_cpp.llama_token_eos(ctx):
+                break
+    finally:
+        # The context is not given back (e.g. to a pool) while it evaluates a sampled token,
+        # if the generation stopped during the evaluation (e.g. an exception in the completion callback).
+        if eval_future is not None:
+            wait([eval_future])
 
 
     # Print the timings
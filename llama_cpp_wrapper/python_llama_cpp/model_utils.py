@@ -1,6 +1,11 @@
 
+import queue
+import threading
 import llama_cpp
+from contextlib import contextmanager
 from functools import lru_cache
+from typing import Dict
+from .context_resources import free_context_resources
 
 
 @lru_cache(maxsize=None)
@@ -37,3 +42,108 @@ def get_context(model):
     ctx = llama_cpp.llama_new_context_with_model(model, context_params)
 
     return ctx
+
+def new_context(model, n_ctx: int = 0, n_batch: int = 512, n_threads: int = None):
+    """
+    This function creates a new context of a given model.
+
+    Parameters:
+    model (llama_cpp.llama_model): The model.
+    n_ctx (int): The size of the context in tokens (0: the training context size of the model).
+    n_batch (int): The maximum number of tokens evaluated by one call.
+    n_threads (int): The number of threads of the evaluation (None: the default of llama.cpp).
+
+    Returns:
+    llama_cpp.llama_context: The new context.
+    """
+    context_params = llama_cpp.llama_context_default_params()
+    context_params.n_ctx = n_ctx
+    context_params.n_batch = n_batch
+    if n_threads is not None:
+        context_params.n_threads = n_threads
+        context_params.n_threads_batch = n_threads
+    return llama_cpp.llama_new_context_with_model(model, context_params)
+
+class ContextPool:
+    """
+    This is a pool of contexts sharing the weights of one model.
+    A context holds the KV cache of one generation, so it is checked out exclusively by a worker,
+    and several generations can run in parallel (one per context) without reloading the model.
+    """
+    def __init__(self, model, size: int = 1, n_ctx: int = 0, n_batch: int = 512, n_threads: int = None):
+        """
+        Parameters:
+        model (llama_cpp.llama_model): The model.
+        size (int): The number of contexts.
+        n_ctx, n_batch, n_threads: The settings of each context, see new_context.
+        """
+        self.model = model
+        self.freed = False
+        self.contexts = [new_context(model, n_ctx, n_batch, n_threads) for _ in range(size)]
+        self.free_contexts = queue.LifoQueue()
+        for ctx in self.contexts:
+            self.free_contexts.put(ctx)
+
+    def acquire(self, timeout: float = None):
+        """
+        Returns a free context, waiting for one if they are all used.
+        Raises queue.Empty if no context is freed before the timeout, and RuntimeError if the pool is freed.
+        """
+        if self.freed:
+            raise RuntimeError("The context pool is freed")
+        ctx = self.free_contexts.get(timeout=timeout)
+        if self.freed:
+            raise RuntimeError("The context pool is freed")
+        return ctx
+
+    def release(self, ctx, reset: bool = False):
+        """
+        Gives back a context to the pool.
+        By default its KV cache is kept, so the next generation can reuse its prompt (see PromptCache).
+        With reset, the KV cache is cleared (then tell the PromptCache with set_context_tokens(ctx, [])).
+        """
+        if reset:
+            llama_cpp.llama_kv_cache_tokens_rm(ctx, -1, -1)
+        self.free_contexts.put(ctx)
+
+    @contextmanager
+    def checkout(self, timeout: float = None, reset: bool = False):
+        """
+        Context manager which acquires a context and releases it at the end of the block.
+        """
+        ctx = self.acquire(timeout)
+        try:
+            yield ctx
+        finally:
+            self.release(ctx, reset)
+
+    def free(self):
+        """
+        Frees the contexts, and the objects attached to them (see get_context_resource).
+        The pool can not be used anymore, get_context_pool creates a new one.
+        """
+        self.freed = True
+        with _context_pools_lock:
+            for key, pool in list(_context_pools.items()):
+                if pool is self:
+                    del _context_pools[key]
+        for ctx in self.contexts:
+            free_context_resources(ctx)
+            llama_cpp.llama_free(ctx)
+        self.contexts = []
+        self.free_contexts = queue.LifoQueue()
+
+# The context pools of get_context_pool, a pool is removed when it is freed.
+_context_pools: Dict[tuple, ContextPool] = {}
+_context_pools_lock = threading.Lock()
+
+def get_context_pool(model, size: int = 1, n_ctx: int = 0, n_batch: int = 512, n_threads: int = None) -> ContextPool:
+    """
+    This function returns the context pool of a given model and settings, created once (until it is freed).
+    """
+    key = (model, size, n_ctx, n_batch, n_threads)
+    with _context_pools_lock:
+        pool = _context_pools.get(key)
+        if pool is None:
+            pool = _context_pools[key] = ContextPool(model, size, n_ctx, n_batch, n_threads)
+    return pool
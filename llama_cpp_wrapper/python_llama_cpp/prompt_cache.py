@@ -0,0 +1,142 @@
+import ctypes
+import glob
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Tuple, Union
+import numpy as np
+
+
+def common_prefix_length(a: List[int], b: List[int]) -> int:
+    """
+    Returns the number of leading tokens shared by two token lists.
+    """
+    n = min(len(a), len(b))
+    different = np.flatnonzero(np.asarray(a[:n]) != np.asarray(b[:n]))
+    return int(different[0]) if len(different) else n
+
+
+class PromptCache:
+    """
+    This is a cache of evaluated prompts. The evaluation of a new prompt resumes
+    from the longest prefix of its tokens found in:
+    - the KV cache of the context, which still holds the tokens of the previous generation (free),
+    - the llama.cpp states saved after the evaluation of previous prompts.
+      They are kept in memory, or in a directory to be reused by next processes,
+      within a budget in bytes, and the least recently used ones are evicted first.
+    """
+    def __init__(self, max_bytes: int = 2**30, cache_dir: str = None, min_new_tokens: int = 16):
+        """
+        Parameters:
+        max_bytes (int): The maximum total size of the saved states.
+        cache_dir (str): If set, the states are saved in this directory instead of memory.
+        min_new_tokens (int): A state is saved only if the prompt had at least this number of tokens not found in the cache.
+        """
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.min_new_tokens = min_new_tokens
+        # tokens -> state (bytes) or path of the state file, in least recently used first order.
+        self.entries: "OrderedDict[Tuple[int, ...], Union[bytes, str]]" = OrderedDict()
+        self.sizes: Dict[Tuple[int, ...], int] = {}
+        self.total_bytes = 0
+        # tokens whose keys and values are currently in the KV cache of each context.
+        self.context_tokens: Dict[object, List[int]] = {}
+        self.lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._load_cache_dir()
+
+    def _load_cache_dir(self):
+        paths = sorted(glob.glob(os.path.join(self.cache_dir, "*.state")), key=os.path.getmtime)
+        for path in paths:
+            with open(path, "rb") as f:
+                n_tokens = int(np.frombuffer(f.read(8), dtype=np.int64)[0])
+                tokens = tuple(np.frombuffer(f.read(4 * n_tokens), dtype=np.int32).tolist())
+            self._add(tokens, path, os.path.getsize(path))
+
+    def _add(self, tokens: Tuple[int, ...], state: Union[bytes, str], size: int):
+        self.entries[tokens] = state
+        self.sizes[tokens] = size
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes and len(self.entries) > 0:
+            evicted_tokens, evicted_state = self.entries.popitem(last=False)
+            self.total_bytes -= self.sizes.pop(evicted_tokens)
+            if isinstance(evicted_state, str):
+                os.remove(evicted_state)
+
+    def _set_state(self, ctx, state: Union[bytes, str]):
+        # llama_cpp is only needed with a context, so the cache logic can be used without it.
+        import llama_cpp
+        if isinstance(state, str):
+            os.utime(state)
+            with open(state, "rb") as f:
+                n_tokens = int(np.frombuffer(f.read(8), dtype=np.int64)[0])
+                f.seek(8 + 4 * n_tokens)
+                state = f.read()
+        llama_cpp.llama_set_state_data(ctx, ctypes.cast(state, ctypes.POINTER(ctypes.c_uint8)))
+
+    def restore(self, ctx, tokens: List[int]) -> int:
+        """
+        Put in the context the keys and values of the longest cached prefix of the tokens.
+
+        Parameters:
+        ctx (llama_cpp.llama_context): The context where the tokens will be evaluated.
+        tokens (list): The tokens of the prompt.
+
+        Returns:
+        int: The number of tokens already evaluated, which should be passed as n_past to the next evaluation.
+            The last token is never counted, so its logits are computed again.
+        """
+        with self.lock:
+            best_tokens = None
+            best_length = common_prefix_length(self.context_tokens.get(ctx, []), tokens)
+            for cached_tokens in self.entries:
+                length = common_prefix_length(cached_tokens, tokens)
+                if length > best_length:
+                    best_tokens, best_length = cached_tokens, length
+            if best_tokens is not None:
+                self._set_state(ctx, self.entries[best_tokens])
+                self.entries.move_to_end(best_tokens)
+            n_past = max(min(best_length, len(tokens) - 1), 0)
+            self.context_tokens[ctx] = list(tokens[:n_past])
+            return n_past
+
+    def set_context_tokens(self, ctx, tokens: List[int]):
+        """
+        Record the tokens evaluated in the context (the list can be extended in place during the generation).
+        """
+        with self.lock:
+            self.context_tokens[ctx] = tokens
+
+    def save(self, ctx, tokens: List[int], n_reused: int):
+        """
+        Save the state of the context, right after the evaluation of the prompt tokens.
+
+        Parameters:
+        ctx (llama_cpp.llama_context): The context.
+        tokens (list): The tokens of the prompt.
+        n_reused (int): The number of tokens which were restored from the cache.
+        """
+        tokens = tuple(tokens)
+        with self.lock:
+            if len(tokens) - n_reused < self.min_new_tokens or tokens in self.entries:
+                return
+            import llama_cpp
+            buffer = (ctypes.c_uint8 * llama_cpp.llama_get_state_size(ctx))()
+            n_bytes = llama_cpp.llama_copy_state_data(ctx, buffer)
+            if n_bytes > self.max_bytes:
+                return
+            state = ctypes.string_at(buffer, n_bytes)
+            if self.cache_dir is None:
+                self._add(tokens, state, n_bytes)
+                return
+            name = hashlib.sha256(np.array(tokens, dtype=np.int32).tobytes()).hexdigest()
+            path = os.path.join(self.cache_dir, name + ".state")
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(np.array([len(tokens)], dtype=np.int64).tobytes())
+                f.write(np.array(tokens, dtype=np.int32).tobytes())
+                f.write(state)
+            os.replace(tmp_path, path)
+            self._add(tokens, path, os.path.getsize(path))
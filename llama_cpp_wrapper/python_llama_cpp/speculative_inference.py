@@ -0,0 +1,226 @@
+from typing import Dict, Iterator, List
+from .model_utils import get_context, get_model
+from .inference_with_completion import LastTokens, SamplingBuffers, get_sampling_buffers, get_token_prefix_index, tokenize_forced_text, \
+    forced_closing_text
+from .constraint_utils import allowed_token_ids, forced_prefix, to_byte_completions
+from .history_buffer import HistoryBuffer
+from .vocab_utils import TokenPrefixIndex
+from .speculative_sampling import Distribution, sample_token, verify_draft
+import llama_cpp
+import numpy as np
+
+
+def decode_tokens(ctx, batch, n_batch: int, n_vocab: int, tokens: List[int], n_past: int, n_logits: int) -> List[np.ndarray]:
+    """
+    This function evaluates tokens of the sequence 0 of a context, in chunks of at most n_batch tokens.
+
+    Parameters:
+    ctx (llama_cpp.llama_context): The context.
+    batch (llama_cpp.llama_batch): A batch of at least n_batch tokens.
+    tokens (list): The tokens, at the positions following n_past.
+    n_logits (int): The number of last tokens whose logits are returned.
+
+    Returns:
+    list: The logits (copies) of the last n_logits tokens.
+    """
+    logits = []
+    for start in range(0, len(tokens), n_batch):
+        chunk = tokens[start:start+n_batch]
+        for i, token_id in enumerate(chunk):
+            batch.token[i] = token_id
+            batch.pos[i] = n_past + start + i
+            batch.n_seq_id[i] = 1
+            batch.seq_id[i][0] = 0
+            batch.logits[i] = start + i >= len(tokens) - n_logits
+        batch.n_tokens = len(chunk)
+        if llama_cpp.llama_decode(ctx, batch) != 0:
+            raise RuntimeError("llama_decode failed: the context is too small")
+        for i in range(len(chunk)):
+            if start + i >= len(tokens) - n_logits:
+                logits.append(np.ctypeslib.as_array(llama_cpp.llama_get_logits_ith(ctx, i), shape=(n_vocab,)).copy())
+    return logits
+
+
+def token_distribution(ctx, logits: np.ndarray, buffers: SamplingBuffers, last_tokens: LastTokens, token_ids: np.ndarray,
+                       last_n_repeat: int = 64, repeat_penalty: float = 1, frequency_penalty: float = 0.0, presence_penalty: float = 0.0,
+                       top_k: int = 40, top_p: float = 0.8, temperature: float = 0.2) -> Distribution:
+    """
+    This function computes the probabilities of the next token given by the samplers of sample_next_token
+    (penalties, top-k, top-p and temperature), instead of sampling it.
+
+    Parameters:
+    token_ids (np.ndarray): The allowed tokens, or None if all the tokens are allowed.
+
+    Returns:
+    tuple: The ids of the tokens which can be sampled, and their probabilities.
+    """
+    candidates_p = buffers.fill_candidates(logits, token_ids)
+    _arr = last_tokens.tokens
+    llama_cpp.llama_sample_repetition_penalty(ctx, candidates_p, _arr, last_n_repeat, repeat_penalty)
+    llama_cpp.llama_sample_frequency_and_presence_penalties(ctx, candidates_p, _arr, last_n_repeat, frequency_penalty, presence_penalty)
+    llama_cpp.llama_sample_top_k(ctx, candidates_p, k=top_k, min_keep=1)
+    llama_cpp.llama_sample_top_p(ctx, candidates_p, p=top_p, min_keep=1)
+    llama_cpp.llama_sample_temperature(ctx, candidates_p, temp=temperature)
+    llama_cpp.llama_sample_softmax(ctx, candidates_p)
+    candidates = buffers.candidates[:buffers.candidates_array.size]
+    return candidates["id"].copy(), candidates["p"].astype(np.float64)
+
+
+def do_speculative_inference(prompt: bytes, constrainer, model_path=None, draft_model_path=None, model=None, draft_model=None,
+                             ctx=None, draft_ctx=None, n_draft: int = 4, n_predict: int = 200, n_batch: int = 512,
+                             stop_text: str = None, literal_tokens_cache: Dict[bytes, List[int]] = None, seed: int = None,
+                             sampling_params: dict = None) -> Iterator[str]:
+    """
+    This function generates text after a prompt, constrained by a constrainer (see JsonSchemaConstrainer), with speculative decoding:
+    a small draft model proposes up to n_draft tokens under the same constraints, and the model verifies them in one llama_decode call.
+    A draft token is accepted with the probability min(1, p/q) (p and q being the probabilities of the model and of the draft model),
+    and the first rejected one is replaced by a token sampled from max(0, p - q), so the generated text follows the same distribution
+    as the sampling of do_inference with the same settings. The constrainer follows the draft tokens on a copy, which is dropped
+    when they are rejected. The texts forced by the constrainer are added without drafting.
+    The two models must have the same vocabulary.
+
+    Parameters:
+    prompt (bytes): The prompt.
+    constrainer: The constrainer (with compute_next_completion, closing_text and copy), or None. Its string suggestions are encoded to bytes.
+    model_path, draft_model_path (str): The paths of the models, used if the models are not given.
+    ctx, draft_ctx (llama_cpp.llama_context): The contexts of the models (their KV caches are overwritten).
+    n_draft (int): The maximum number of tokens proposed by the draft model at each step.
+    n_predict (int): The maximum number of generated tokens (sampled and forced). The shortest text closing the JSON is forced
+        before the budget runs out, like in do_inference.
+    n_batch (int): The maximum number of tokens per llama_decode call (at most the n_batch of the contexts).
+    stop_text (str): The generation is finished when this text is generated or forced (it ends the closing text as well).
+    literal_tokens_cache (dict): See tokenize_forced_text.
+    seed (int): The seed of the sampling.
+    sampling_params (dict): The settings of the samplers (see sample_next_token).
+
+    Yields:
+    str: The chunks of the generated text.
+    """
+    if model is None:
+        model = get_model(model_path)
+    if draft_model is None:
+        draft_model = get_model(draft_model_path)
+    if ctx is None:
+        ctx = get_context(model)
+    if draft_ctx is None:
+        draft_ctx = get_context(draft_model)
+    if llama_cpp.llama_n_vocab(model) != llama_cpp.llama_n_vocab(draft_model):
+        raise ValueError("The draft model must have the same vocabulary as the model")
+    prefix_index: TokenPrefixIndex = get_token_prefix_index(model, model_path)
+    sampling_params = sampling_params or {}
+    last_n_size = 64
+    buffers = get_sampling_buffers(ctx, model, 24, last_n_size)
+    draft_buffers = get_sampling_buffers(draft_ctx, draft_model, 24, last_n_size)
+    last_tokens = LastTokens(last_n_size)
+    rng = np.random.default_rng(seed)
+    eos = llama_cpp.llama_token_eos(ctx)
+    n_vocab = buffers.n_vocab
+
+    # The committed tokens, and the number of them in the KV cache of each model.
+    # The last committed token is never evaluated yet, so its logits come with the next evaluation.
+    tokens = buffers.tokenize(model, b" " + prompt, True)
+    n_evaluated = 0
+    n_draft_evaluated = 0
+    llama_cpp.llama_kv_cache_tokens_rm(ctx, -1, -1)
+    llama_cpp.llama_kv_cache_tokens_rm(draft_ctx, -1, -1)
+
+    def can_sample(suggestions, step_constrainer, remaining: int) -> bool:
+        # The draft stops on forced texts, and where the closing text could have to be forced (its length in bytes bounds its tokens).
+        if forced_prefix(suggestions):
+            return False
+        if step_constrainer is None or suggestions is None:
+            return True
+        closing_text = step_constrainer.closing_text()
+        return not closing_text or len(closing_text.encode()) + 2 < remaining
+
+    def closing_callback():
+        closing_text = constrainer.closing_text()
+        return None if closing_text is None else (closing_text + (stop_text or "")).encode()
+
+    def allowed(suggestions):
+        if suggestions is None:
+            return None
+        token_ids = allowed_token_ids(suggestions, prefix_index)
+        return token_ids if len(token_ids) > 0 else None
+
+    history = HistoryBuffer(keep_text=False)
+    remaining_tokens = n_predict
+    batch = llama_cpp.llama_batch_init(n_batch, 0, 1)
+    try:
+        while remaining_tokens > 0:
+            suggestions = None
+            if constrainer is not None:
+                suggestions = to_byte_completions(constrainer.compute_next_completion(history.new_text()))
+            forced = forced_prefix(suggestions)
+            if constrainer is not None and suggestions is not None:
+                # Force the end of the generation when the next tokens or forced text could not be followed by it.
+                forced = forced_closing_text(closing_callback, remaining_tokens, model, buffers, prefix_index, literal_tokens_cache) or forced
+            if forced:
+                # The forced tokens are evaluated with the next draft and verification batches.
+                forced_tokens = tokenize_forced_text(model, forced, buffers, prefix_index, literal_tokens_cache)
+                tokens.extend(forced_tokens)
+                remaining_tokens -= len(forced_tokens)
+                chunk = history.append(forced)
+                if chunk:
+                    yield chunk
+                if not forced_tokens or (stop_text is not None and stop_text in chunk):
+                    return
+                continue
+
+            # The draft model proposes tokens, the constrainer following them on a copy.
+            draft_constrainer = constrainer.copy() if constrainer is not None else None
+            draft_history = history.copy()
+            draft_logits = decode_tokens(draft_ctx, batch, n_batch, n_vocab, tokens[n_draft_evaluated:], n_draft_evaluated, 1)[0]
+            n_draft_evaluated = len(tokens)
+            drafted: List[int] = []
+            draft_distributions = []
+            step_allowed = [allowed(suggestions)]
+            while True:
+                last_tokens.fill(tokens[-last_n_size:] + drafted)
+                q = token_distribution(draft_ctx, draft_logits, draft_buffers, last_tokens, step_allowed[-1], **sampling_params)
+                token_id = sample_token(q, rng)
+                drafted.append(token_id)
+                draft_distributions.append(q)
+                if token_id == eos:
+                    break
+                step_suggestions = None
+                if draft_constrainer is not None:
+                    step_suggestions = to_byte_completions(
+                        draft_constrainer.compute_next_completion(draft_history.append(prefix_index.vocab[token_id])))
+                if not can_sample(step_suggestions, draft_constrainer, remaining_tokens - len(drafted)) or len(drafted) >= remaining_tokens:
+                    break
+                # The position after this token can be sampled (by the draft model, or by the model after the last draft token).
+                step_allowed.append(allowed(step_suggestions))
+                if len(drafted) >= n_draft:
+                    break
+                draft_logits = decode_tokens(draft_ctx, batch, n_batch, n_vocab, [token_id], n_draft_evaluated + len(drafted) - 1, 1)[0]
+            n_draft_evaluated += len(drafted) - 1
+
+            # The model evaluates the pending tokens and the draft in one batch, and accepts a prefix of the draft.
+            # The position after the last draft token can be sampled too (if the draft did not stop on a forced text).
+            n_positions = len(step_allowed)
+            verified = decode_tokens(ctx, batch, n_batch, n_vocab, tokens[n_evaluated:] + drafted, n_evaluated, len(drafted) + 1)
+
+            def target_distribution(i: int) -> Distribution:
+                last_tokens.fill(tokens[-last_n_size:] + drafted[:i])
+                return token_distribution(ctx, verified[i], buffers, last_tokens, step_allowed[i], **sampling_params)
+
+            new_tokens = verify_draft(drafted, draft_distributions, target_distribution, n_positions, rng)
+
+            # Commit the accepted tokens, and remove the rejected ones from the KV caches.
+            n_accepted = next((i for i, (a, b) in enumerate(zip(new_tokens, drafted)) if a != b), min(len(new_tokens), len(drafted)))
+            n_committed = len(tokens)
+            tokens.extend(new_tokens)
+            n_evaluated = min(n_committed + n_accepted, len(tokens) - 1)
+            n_draft_evaluated = min(n_draft_evaluated, n_committed + n_accepted, len(tokens) - 1)
+            llama_cpp.llama_kv_cache_seq_rm(ctx, 0, n_evaluated, -1)
+            llama_cpp.llama_kv_cache_seq_rm(draft_ctx, 0, n_draft_evaluated, -1)
+            remaining_tokens -= len(new_tokens)
+            for token_id in new_tokens:
+                chunk = history.append(prefix_index.vocab[token_id])
+                if chunk:
+                    yield chunk
+                if token_id == eos or (stop_text is not None and stop_text in chunk):
+                    return
+    finally:
+        llama_cpp.llama_batch_free(batch)
@@ -0,0 +1,70 @@
+from typing import Callable, List, Tuple
+import numpy as np
+
+# A distribution of the next token: the ids of the tokens which can be sampled, and their probabilities.
+Distribution = Tuple[np.ndarray, np.ndarray]
+
+
+def token_probability(distribution: Distribution, token_id: int) -> float:
+    """
+    Returns the probability of a token in a distribution (0 if it can not be sampled).
+    """
+    ids, probs = distribution
+    match = np.flatnonzero(ids == token_id)
+    return float(probs[match[0]]) if len(match) else 0.0
+
+
+def sample_token(distribution: Distribution, rng: np.random.Generator) -> int:
+    """
+    Samples a token from a distribution (the probabilities are normalized first).
+    """
+    ids, probs = distribution
+    return int(ids[rng.choice(len(ids), p=probs / probs.sum())])
+
+
+def residual_distribution(p: Distribution, q: Distribution) -> Distribution:
+    """
+    Returns the distribution max(0, p - q) (normalized when sampled), from which the token is sampled when a draft token is rejected.
+    If p is nowhere above q, p itself is returned.
+    """
+    ids = np.union1d(p[0], q[0])
+    probs = np.zeros(len(ids))
+    probs[np.searchsorted(ids, p[0])] += p[1]
+    probs[np.searchsorted(ids, q[0])] -= q[1]
+    probs = np.maximum(probs, 0.0)
+    if probs.sum() <= 0:
+        return p
+    return ids, probs
+
+
+def verify_draft(drafted: List[int], draft_distributions: List[Distribution], target_distribution: Callable[[int], Distribution],
+                 n_positions: int, rng: np.random.Generator) -> List[int]:
+    """
+    This function accepts a prefix of the draft tokens: each one with the probability min(1, p/q) (p and q being the probabilities
+    of the model and of the draft model). The first rejected one is replaced by a token sampled from max(0, p - q).
+    If all of them are accepted, a token is sampled from the model after the last one (when this position can be sampled).
+
+    Parameters:
+    drafted (list): The tokens proposed by the draft model.
+    draft_distributions (list): The distribution q of each draft token.
+    target_distribution (function): It returns the distribution p of the model at the given position of the draft.
+        It is only called for the positions which are reached.
+    n_positions (int): The number of positions which can be sampled (the draft tokens, and one more if the one after them can be).
+    rng (np.random.Generator): The random generator.
+
+    Returns:
+    list: The new tokens: the accepted draft tokens, followed by the sampled one if any.
+    """
+    new_tokens = []
+    for i, token_id in enumerate(drafted):
+        p = target_distribution(i)
+        q = draft_distributions[i]
+        if rng.random() * token_probability(q, token_id) < token_probability(p, token_id):
+            new_tokens.append(token_id)
+            continue
+        new_tokens.append(sample_token(residual_distribution(p, q), rng))
+        break
+    else:
+        if n_positions > len(drafted):
+            new_tokens.append(sample_token(target_distribution(len(drafted)), rng))
+    return new_tokens
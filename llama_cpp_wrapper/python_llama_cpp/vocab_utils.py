@@ -0,0 +1,261 @@
+from typing import List, Dict, Sequence, Tuple
+import hashlib
+import mmap
+import os
+import re
+import threading
+from collections import OrderedDict
+import numpy as np
+
+_VOCAB_MAGIC = b"LJSVOCAB"
+_VOCAB_VERSION = 1
+_VOCAB_HEADER_SIZE = 32
+
+
+class Vocab:
+    """
+    This is a compact vocabulary: the pieces of all the tokens are concatenated in one blob,
+    and `offsets[i]:offsets[i+1]` is the position of the piece of the token i in the blob.
+    A piece (bytes) is only created when it is accessed.
+    Saved vocabularies are memory-mapped when loaded, so they are shared between the processes using them.
+    """
+    def __init__(self, data, offsets: np.ndarray, sorted_token_ids: np.ndarray, blob_start: int = 0):
+        self.data = data
+        self.offsets = offsets
+        self.sorted_token_ids = sorted_token_ids
+        self.blob_start = blob_start
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, token_id: int) -> bytes:
+        start = self.blob_start + int(self.offsets[token_id])
+        end = self.blob_start + int(self.offsets[token_id+1])
+        return self.data[start:end]
+
+    def __iter__(self):
+        data = self.data
+        offsets = (self.offsets + self.blob_start).tolist()
+        for token_id in range(len(offsets) - 1):
+            yield data[offsets[token_id]:offsets[token_id+1]]
+
+    @staticmethod
+    def from_pieces(pieces: Sequence[bytes]) -> "Vocab":
+        offsets = np.zeros(len(pieces)+1, dtype=np.int64)
+        np.cumsum([len(piece) for piece in pieces], out=offsets[1:])
+        sorted_token_ids = np.array(sorted(range(len(pieces)), key=pieces.__getitem__), dtype=np.int32)
+        return Vocab(b"".join(pieces), offsets, sorted_token_ids)
+
+    def save(self, path: str):
+        """
+        Save the vocabulary in one file: a header, the offsets, the sorted token ids and the blob.
+        The file is written atomically.
+        """
+        n_vocab = len(self)
+        blob = self.data[self.blob_start:self.blob_start+int(self.offsets[-1])]
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_VOCAB_MAGIC)
+            f.write(np.array([_VOCAB_VERSION, n_vocab], dtype=np.uint32).tobytes())
+            f.write(np.array([len(blob)], dtype=np.uint64).tobytes())
+            f.write(b"\0" * (_VOCAB_HEADER_SIZE - f.tell()))
+            f.write(self.offsets.astype(np.int64).tobytes())
+            f.write(self.sorted_token_ids.astype(np.int32).tobytes())
+            f.write(blob)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str) -> "Vocab":
+        """
+        Load a vocabulary saved with `save`, by memory-mapping it.
+        """
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if data[:len(_VOCAB_MAGIC)] != _VOCAB_MAGIC:
+            raise Exception(f"Not a vocabulary file: '{path}'")
+        version, n_vocab = np.frombuffer(data, dtype=np.uint32, count=2, offset=len(_VOCAB_MAGIC)).tolist()
+        if version != _VOCAB_VERSION:
+            raise Exception(f"Unsupported vocabulary file version: '{path}'")
+        offsets_start = _VOCAB_HEADER_SIZE
+        sorted_start = offsets_start + 8 * (n_vocab+1)
+        blob_start = sorted_start + 4 * n_vocab
+        offsets = np.frombuffer(data, dtype=np.int64, count=n_vocab+1, offset=offsets_start)
+        sorted_token_ids = np.frombuffer(data, dtype=np.int32, count=n_vocab, offset=sorted_start)
+        return Vocab(data, offsets, sorted_token_ids, blob_start)
+
+
+def vocab_cache_path(model_path: str) -> str:
+    """
+    This function returns the path of the vocabulary cache of a model, next to the model file.
+    It is keyed by a hash of the size and of the beginning of the model file (where gguf stores the vocabulary),
+    so it is cheap to compute and changes when the model file changes.
+    """
+    h = hashlib.sha256()
+    h.update(os.path.getsize(model_path).to_bytes(8, "little"))
+    with open(model_path, "rb") as f:
+        h.update(f.read(16 * 1024 * 1024))
+    return f"{model_path}.{h.hexdigest()[:16]}.vocab"
+
+
+class TokenPrefixIndex:
+    """
+    This is an index of the vocabulary by token piece.
+
+    A token is compatible with a suggestion when its piece is a prefix of the suggestion.
+    The token ids are sorted by piece, so the compatible tokens are found by walking the prefixes of the suggestion
+    with binary searches. The cost is proportional to the length of the suggestion and the number of matches,
+    instead of the size of the vocabulary, and no Python object is kept per token.
+
+    The masks of the allowed tokens are cached by suggestion set (the same suggestions come back again and again:
+    digits, string content, array continuation...), in a LRU cache shared by all the generations of the model,
+    together with the ids of the allowed tokens (for the sparse sampling).
+    """
+    def __init__(self, vocab: Sequence[bytes], mask_cache_size: int = 256, regexp_cache_size: int = 64):
+        self.vocab = vocab
+        sorted_token_ids = getattr(vocab, "sorted_token_ids", None)
+        if sorted_token_ids is None:
+            sorted_token_ids = np.array(sorted(range(len(vocab)), key=vocab.__getitem__), dtype=np.int32)
+        self.sorted_token_ids = sorted_token_ids
+        self.max_piece_length = max((len(piece) for piece in vocab), default=0)
+        self.regexp_cache_size = regexp_cache_size
+        self.regexp_masks: "OrderedDict[re.Pattern, np.ndarray]" = OrderedDict()
+        self.mask_cache_size = mask_cache_size
+        self.mask_cache: "OrderedDict[frozenset, Tuple[np.ndarray, np.ndarray]]" = OrderedDict()
+        self.mask_cache_hits = 0
+        self.mask_cache_misses = 0
+        self.lock = threading.Lock()
+        self._vocab_hash = None
+
+    def vocab_hash(self) -> str:
+        """
+        Returns:
+        str: A hash of the vocabulary (computed once), to identify the caches built for it.
+        """
+        if self._vocab_hash is None:
+            h = hashlib.sha256()
+            for piece in self.vocab:
+                h.update(len(piece).to_bytes(4, "little"))
+                h.update(piece)
+            self._vocab_hash = h.hexdigest()
+        return self._vocab_hash
+
+    def prefix_token_ids(self, suggestion: bytes) -> List[int]:
+        """
+        Parameters:
+        suggestion (bytes): The text that should be generated.
+
+        Returns:
+        list: The ids of the tokens whose piece is a prefix of the suggestion.
+        """
+        token_ids = []
+        vocab = self.vocab
+        sorted_token_ids = self.sorted_token_ids
+        n = len(sorted_token_ids)
+        lo = 0
+        for length in range(1, min(len(suggestion), self.max_piece_length)+1):
+            prefix = suggestion[:length]
+            # The pieces starting with a longer prefix of the suggestion come later in the sorted order.
+            hi = n
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if vocab[sorted_token_ids[mid]] < prefix:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            while lo < n and vocab[sorted_token_ids[lo]] == prefix:
+                token_ids.append(int(sorted_token_ids[lo]))
+                lo += 1
+            if lo == n or not vocab[sorted_token_ids[lo]].startswith(prefix):
+                break
+        return token_ids
+
+    def tokenize_greedy(self, text: bytes) -> List[int]:
+        """
+        This function tokenizes a text by taking the longest matching token at each position.
+        The pieces of the tokens are exactly the text (no BOS, no added space).
+
+        Returns:
+        list: The tokens, or None if a part of the text has no matching token.
+        """
+        tokens = []
+        pos = 0
+        while pos < len(text):
+            token_ids = self.prefix_token_ids(text[pos:])
+            if not token_ids:
+                return None
+            # prefix_token_ids lists the tokens from the shortest piece to the longest.
+            tokens.append(token_ids[-1])
+            pos += len(self.vocab[token_ids[-1]])
+        return tokens
+
+    def regexp_mask(self, pattern: re.Pattern) -> np.ndarray:
+        """
+        Returns:
+        np.ndarray: Boolean mask of the (non empty) tokens matching the regexp.
+            The masks of the last regexp_cache_size regexps are kept (each one costs a scan of the vocabulary).
+        """
+        with self.lock:
+            mask = self.regexp_masks.get(pattern)
+            if mask is not None:
+                self.regexp_masks.move_to_end(pattern)
+                return mask
+        mask = np.fromiter(
+            (len(piece) > 0 and pattern.match(piece.decode("utf-8", errors="replace")) is not None for piece in self.vocab),
+            dtype=bool, count=len(self.vocab))
+        with self.lock:
+            self.regexp_masks[pattern] = mask
+            while len(self.regexp_masks) > self.regexp_cache_size:
+                self.regexp_masks.popitem(last=False)
+        return mask
+
+    def allowed_token_mask(self, suggestions: list) -> np.ndarray:
+        """
+        Parameters:
+        suggestions (list): The suggestions of the constrainer (bytes or compiled regexps).
+
+        Returns:
+        np.ndarray: Boolean mask (read-only) of the tokens compatible with at least one of the suggestions.
+        """
+        return self._allowed_tokens(suggestions)[0]
+
+    def allowed_token_ids(self, suggestions: list) -> np.ndarray:
+        """
+        Same as allowed_token_mask, but returns the sorted ids (read-only) of the allowed tokens.
+        """
+        return self._allowed_tokens(suggestions)[1]
+
+    def _allowed_tokens(self, suggestions: list) -> Tuple[np.ndarray, np.ndarray]:
+        # The order of the suggestions does not change the mask.
+        key = frozenset(suggestions)
+        with self.lock:
+            entry = self.mask_cache.get(key)
+            if entry is not None:
+                self.mask_cache.move_to_end(key)
+                self.mask_cache_hits += 1
+                return entry
+            self.mask_cache_misses += 1
+        mask = self.compute_allowed_token_mask(suggestions)
+        token_ids = np.flatnonzero(mask).astype(np.intc)
+        mask.flags.writeable = False
+        token_ids.flags.writeable = False
+        entry = (mask, token_ids)
+        with self.lock:
+            self.mask_cache[key] = entry
+            while len(self.mask_cache) > self.mask_cache_size:
+                self.mask_cache.popitem(last=False)
+        return entry
+
+    def mask_cache_stats(self) -> Dict[str, int]:
+        return {"hits": self.mask_cache_hits, "misses": self.mask_cache_misses, "size": len(self.mask_cache)}
+
+    def compute_allowed_token_mask(self, suggestions: list) -> np.ndarray:
+        """
+        Same as allowed_token_mask, without the cache.
+        """
+        mask = np.zeros(len(self.vocab), dtype=bool)
+        for suggestion in suggestions:
+            if isinstance(suggestion, re.Pattern):
+                mask |= self.regexp_mask(suggestion)
+            else:
+                mask[self.prefix_token_ids(suggestion)] = True
+        return mask
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Tuple, Union
+
+
+def schema_hash(json_schema) -> str:
+    # The keys are not sorted, because the order of the properties is the order of generation.
+    return hashlib.sha256(json.dumps(json_schema).encode()).hexdigest()
+
+
+class SchemaNode:
+    """
+    This is a node of a normalized JSON schema: the `$ref` are resolved, the literals of the property names
+    ('"name":', escaped) and the shortest text of the value are precomputed, so the parser does no dict lookup.
+    `node_id` numbers the nodes in depth first order, it is stable across processes (see `IncrementalJsonSchemaParser.state_key`).
+    Besides the JSON types, an "enum" node has the texts of its allowed `values` (enum, const and null),
+    and a "union" node has the nodes of its `alternatives` (anyOf, oneOf and lists of types).
+    The nodes are not modified once built.
+    """
+    __slots__ = ("type", "node_id", "properties", "items", "max_length", "max_items", "values", "alternatives", "min_text")
+
+    def __init__(self, type: str, node_id: int, properties: Tuple[Tuple[str, "SchemaNode"], ...] = None, items: "SchemaNode" = None,
+                 max_length: int = None, max_items: int = None, values: Tuple[str, ...] = None, alternatives: Tuple["SchemaNode", ...] = None):
+        self.type = type
+        self.node_id = node_id
+        self.properties = properties
+        self.items = items
+        self.max_length = max_length
+        self.max_items = max_items
+        self.values = values
+        self.alternatives = alternatives
+        self.min_text = self._min_text()
+
+    def _min_text(self) -> str:
+        """
+        Returns the shortest text of a value of the node (arrays have one item, unless maxItems is 0).
+        """
+        if self.type == "string":
+            return '""'
+        elif self.type == "number":
+            return "0"
+        elif self.type == "boolean":
+            return "true"
+        elif self.type == "object":
+            return "{" + ",".join(key + node.min_text for key, node in self.properties) + "}"
+        elif self.type == "enum":
+            return min(self.values, key=len)
+        elif self.type == "union":
+            return min((node.min_text for node in self.alternatives), key=len)
+        elif self.max_items == 0:
+            return "[]"
+        else:
+            return "[" + self.items.min_text + "]"
+
+
+def _resolve_ref(root_schema: dict, ref: str):
+    if not ref.startswith("#"):
+        raise Exception(f"Only local $ref are supported: '{ref}'")
+    value = root_schema
+    for part in ref[1:].split("/")[1:]:
+        part = part.replace("~1", "/").replace("~0", "~")
+        if not isinstance(value, dict) or part not in value:
+            raise Exception(f"Unresolved $ref: '{ref}'")
+        value = value[part]
+    return value
+
+
+def normalize_schema(json_schema: dict) -> SchemaNode:
+    """
+    This function normalizes a JSON schema into a tree of SchemaNode.
+    The `$ref` pointing in the schema (e.g. "#/definitions/name" or "#/$defs/name") are replaced by the node of their target.
+    Recursive `$ref` are not supported, because all the properties of an object are generated.
+    `enum` and `const` give the texts of their values (as written by json.dumps), `anyOf`, `oneOf` and lists of types give alternatives.
+    `oneOf` is handled like `anyOf`: a value matching several alternatives is not rejected.
+    """
+    next_node_id = 0
+
+    def normalize(json_schema, refs: tuple) -> SchemaNode:
+        nonlocal next_node_id
+        while "$ref" in json_schema:
+            ref = json_schema["$ref"]
+            if ref in refs:
+                raise Exception(f"Recursive $ref are not supported: '{ref}'")
+            refs = (*refs, ref)
+            json_schema = _resolve_ref(root_schema, ref)
+        node_id = next_node_id
+        next_node_id += 1
+        if "const" in json_schema or "enum" in json_schema:
+            values = [json_schema["const"]] if "const" in json_schema else json_schema["enum"]
+            if not values:
+                raise Exception("Empty enum are not supported")
+            return SchemaNode("enum", node_id, values=tuple(dict.fromkeys(json.dumps(value, ensure_ascii=False) for value in values)))
+        alternatives = json_schema.get("anyOf", json_schema.get("oneOf"))
+        if alternatives is None and isinstance(json_schema.get("type"), list):
+            alternatives = [{**json_schema, "type": schema_type} for schema_type in json_schema["type"]]
+        if alternatives is not None:
+            return SchemaNode("union", node_id, alternatives=tuple(normalize(alternative, refs) for alternative in alternatives))
+        schema_type = json_schema["type"]
+        if schema_type == "null":
+            return SchemaNode("enum", node_id, values=("null",))
+        if schema_type in ("string", "number", "boolean"):
+            return SchemaNode(schema_type, node_id, max_length=json_schema.get("maxLength") if schema_type == "string" else None)
+        elif schema_type == "object":
+            properties = tuple((json.dumps(property, ensure_ascii=False) + ":", normalize(val_type, refs))
+                               for property, val_type in json_schema["properties"].items())
+            return SchemaNode(schema_type, node_id, properties=properties)
+        elif schema_type == "array":
+            return SchemaNode(schema_type, node_id, items=normalize(json_schema["items"], refs), max_items=json_schema.get("maxItems"))
+        else:
+            raise Exception(f"""Unknown type: '{schema_type}'""")
+
+    root_schema = json_schema
+    return normalize(json_schema, ())
+
+
+class CompiledSchema:
+    """
+    This is the entry of a JSON schema in the registry: its hash, its normalized tree,
+    and the error of its validation (once it is validated).
+    """
+    __slots__ = ("hash", "root", "validated", "error")
+
+    def __init__(self, hash: str, root: SchemaNode):
+        self.hash = hash
+        self.root = root
+        self.validated = False
+        self.error = None
+
+
+class SchemaRegistry:
+    """
+    This is a cache of the normalized JSON schemas, keyed by the hash of their content,
+    so the requests with a schema already seen skip its validation and its normalization.
+    The least recently used schemas are removed when there are more than `max_size`.
+    """
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries: Dict[str, CompiledSchema] = OrderedDict()
+
+    def get(self, json_schema: dict) -> CompiledSchema:
+        """
+        Returns the entry of a JSON schema, normalized the first time it is seen.
+        """
+        key = schema_hash(json_schema)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.root is not None:
+                self.entries.move_to_end(key)
+                return entry
+        entry = CompiledSchema(key, normalize_schema(json_schema))
+        with self.lock:
+            if key in self.entries and self.entries[key].root is not None:
+                entry = self.entries[key]
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return entry
+
+    def validate(self, json_schema: dict, check_schema: Callable[[dict], None]) -> Union[str, None]:
+        """
+        Validates a JSON schema once, with `check_schema` (e.g. Draft7Validator.check_schema), then normalizes it.
+
+        Returns:
+        str: The error message if the schema is invalid or not supported, otherwise None.
+        """
+        key = schema_hash(json_schema)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.validated:
+                self.entries.move_to_end(key)
+                return entry.error
+        try:
+            check_schema(json_schema)
+            entry = self.get(json_schema)
+        except Exception as e:
+            # The invalid schemas are kept as well, so they are not validated again.
+            entry = CompiledSchema(key, None)
+            entry.error = str(e)
+            with self.lock:
+                self.entries[key] = entry
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+        entry.validated = True
+        return entry.error
+
+
+schema_registry = SchemaRegistry()
+
+def get_schema_root(json_schema: Union[dict, SchemaNode]) -> SchemaNode:
+    """
+    Returns the normalized tree of a JSON schema (cached in the registry). A SchemaNode is returned as is.
+    """
+    if isinstance(json_schema, SchemaNode):
+        return json_schema
+    return schema_registry.get(json_schema).root
@@ -0,0 +1,275 @@
+import argparse
+import asyncio
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from schema_registry import schema_registry
+from llama_cpp_wrapper.python_llama_cpp.generation_stats import StatsHistograms
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large",
+            500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class GenerationJob:
+    """
+    This is a request waiting for (or running on) an inference worker.
+    The generated chunks go through a bounded queue: when the client reads slowly,
+    the queue fills up and the worker waits, instead of buffering the whole generation.
+    """
+    def __init__(self, model_path: str, json_schema: dict, prompt: str, chunk_queue_size: int):
+        self.model_path = model_path
+        self.json_schema = json_schema
+        self.prompt = prompt
+        self.chunks = asyncio.Queue(maxsize=chunk_queue_size)
+        self.cancelled = threading.Event()
+
+
+class InferenceServer:
+    """
+    This is a long-lived server of generations constrained by JSON schemas.
+    The models stay loaded between requests, and the chunks are streamed to the client as they are generated.
+
+    The requests are queued and run by a bounded number of inference workers. When the queue is full,
+    new requests are rejected (503) instead of piling up. The llama calls run in worker threads, off the event loop.
+    A request is cancelled when its client disconnects.
+    Each model has a pool of one context per worker, so the generations run in parallel on the same loaded weights.
+
+    API: POST /generate with the JSON body {"prompt": str, "json_schema": dict, "model_path": str (optional)}.
+    The generated text is streamed in the body of the response (chunked transfer encoding).
+    A body larger than max_body_bytes is rejected (413). If the generation fails before its first chunk, the response is a 500,
+    otherwise the stream is cut without its last chunk, so the client sees an incomplete response.
+    GET /stats returns the histograms of the timings of the generations (see GenerationStats),
+    and the hit and miss counts of the cache of the allowed token masks of each model.
+    """
+    def __init__(self, model_paths: List[str], n_workers: int = 1, max_queued_requests: int = 16, chunk_queue_size: int = 64,
+                 compiled_schema_cache_dir: str = None, prompt_cache=None, n_ctx: int = 0, n_threads: int = None,
+                 max_body_bytes: int = 2**20):
+        """
+        Parameters:
+        model_paths (list): The paths of the models which can be used, the first one is the default.
+        n_workers (int): The number of generations run at the same time.
+        max_queued_requests (int): The maximum number of requests waiting for a worker.
+        chunk_queue_size (int): The maximum number of chunks generated in advance for a slow client.
+        compiled_schema_cache_dir (str): See run_inference_constrained_by_json_schema.
+        prompt_cache (PromptCache): See run_inference_constrained_by_json_schema.
+        n_ctx (int): The size of each context in tokens (0: the training context size of the model).
+        n_threads (int): The number of threads of each context.
+        max_body_bytes (int): The maximum size of the body of a request.
+        """
+        self.model_paths = model_paths
+        self.n_workers = n_workers
+        self.chunk_queue_size = chunk_queue_size
+        self.compiled_schema_cache_dir = compiled_schema_cache_dir
+        self.prompt_cache = prompt_cache
+        self.n_ctx = n_ctx
+        self.n_threads = n_threads
+        self.max_body_bytes = max_body_bytes
+        self.context_pools = {}
+        self.prefix_indexes = {}
+        self.stats_histograms = StatsHistograms()
+        self.executor = ThreadPoolExecutor(max_workers=n_workers)
+        self.jobs = None
+        self.max_queued_requests = max_queued_requests
+        self.loop = None
+        self.workers = []
+
+    async def start(self):
+        """
+        Load the models and start the inference workers.
+        """
+        # The llama dependencies are only imported to run the server, so the parsing of the requests works without them.
+        from llama_cpp_wrapper.python_llama_cpp.model_utils import get_model, get_context_pool
+        from llama_cpp_wrapper.python_llama_cpp.inference_with_completion import get_token_prefix_index
+        self.loop = asyncio.get_running_loop()
+        self.jobs = asyncio.Queue(maxsize=self.max_queued_requests)
+        for model_path in self.model_paths:
+            model = await self.loop.run_in_executor(self.executor, get_model, model_path)
+            self.context_pools[model_path] = get_context_pool(model, self.n_workers, self.n_ctx, n_threads=self.n_threads)
+            self.prefix_indexes[model_path] = await self.loop.run_in_executor(self.executor, get_token_prefix_index, model, model_path)
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.n_workers)]
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.executor.shutdown(wait=False)
+
+    async def _worker(self):
+        while True:
+            job = await self.jobs.get()
+            try:
+                if not job.cancelled.is_set():
+                    await self.loop.run_in_executor(self.executor, self._generate, job)
+            finally:
+                self.jobs.task_done()
+
+    def _put(self, job: GenerationJob, item):
+        # Called from a worker thread: it waits while the chunk queue of the job is full.
+        if not job.cancelled.is_set():
+            asyncio.run_coroutine_threadsafe(job.chunks.put(item), self.loop).result()
+
+    def _generate(self, job: GenerationJob):
+        from LLM_json_schema import run_inference_constrained_by_json_schema
+        generator = run_inference_constrained_by_json_schema(
+            job.model_path, job.json_schema, job.prompt, self.compiled_schema_cache_dir, self.prompt_cache,
+            self.context_pools[job.model_path], stats_callback=self.stats_histograms.add)
+        try:
+            for chunk in generator:
+                if job.cancelled.is_set():
+                    break
+                self._put(job, chunk)
+        except Exception as e:
+            self._put(job, e)
+        finally:
+            generator.close()
+            self._put(job, None)
+
+    def parse_request(self, body: bytes) -> GenerationJob:
+        try:
+            request = json.loads(body)
+        except ValueError:
+            raise HttpError(400, "The body is not a valid json.")
+        if not isinstance(request, dict) or not isinstance(request.get("prompt"), str):
+            raise HttpError(400, "The body must be a json object with a 'prompt' string.")
+        json_schema = request.get("json_schema")
+        if json_schema is not None:
+            from jsonschema import Draft7Validator
+            error = schema_registry.validate(json_schema, Draft7Validator.check_schema)
+            if error is not None:
+                raise HttpError(400, f"The JSON schema is not a valid json schema: {error}")
+        model_path = request.get("model_path", self.model_paths[0])
+        if model_path not in self.model_paths:
+            raise HttpError(400, f"Unknown model: '{model_path}'")
+        return GenerationJob(model_path, json_schema, request["prompt"], self.chunk_queue_size)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        job = None
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            if len(request_line) < 2:
+                raise HttpError(400, "Invalid request line.")
+            method, path = request_line[0], request_line[1]
+            if path == "/stats" and method == "GET":
+                stats = self.stats_histograms.to_dict()
+                stats["mask_cache"] = {model_path: prefix_index.mask_cache_stats() for model_path, prefix_index in self.prefix_indexes.items()}
+                body = json.dumps(stats).encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s" % (len(body), body))
+                await writer.drain()
+                return
+            if path != "/generate":
+                raise HttpError(404, f"Unknown path: '{path}'")
+            if method != "POST":
+                raise HttpError(405, "Use POST.")
+            content_length = headers.get("content-length", "0")
+            if not content_length.isdigit():
+                raise HttpError(400, "Invalid Content-Length.")
+            if int(content_length) > self.max_body_bytes:
+                raise HttpError(413, f"The body is larger than {self.max_body_bytes} bytes.")
+            body = await reader.readexactly(int(content_length))
+            job = self.parse_request(body)
+            try:
+                self.jobs.put_nowait(job)
+            except asyncio.QueueFull:
+                raise HttpError(503, "Too many queued requests.")
+            # The headers are sent with the first chunk, so an error before it gets its own response.
+            headers_sent = False
+            while True:
+                chunk = await job.chunks.get()
+                if isinstance(chunk, Exception):
+                    if not headers_sent:
+                        raise HttpError(500, f"The generation failed: {chunk}")
+                    # The status is already sent: the stream is cut without its last chunk.
+                    return
+                if not headers_sent:
+                    writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; charset=utf-8\r\n"
+                                 b"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n")
+                    headers_sent = True
+                if chunk is None:
+                    break
+                data = chunk.encode()
+                if data:
+                    writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+                    await writer.drain()
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        except HttpError as e:
+            message = (str(e) + "\n").encode()
+            writer.write(b"HTTP/1.1 %d %s\r\nContent-Type: text/plain; charset=utf-8\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s"
+                         % (e.status, _REASONS[e.status].encode(), len(message), message))
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if job is not None:
+                # Stop the generation if the client is gone, and unblock the worker waiting on the full chunk queue.
+                job.cancelled.set()
+                while not job.chunks.empty():
+                    job.chunks.get_nowait()
+            writer.close()
+
+    async def serve(self, host: str = None, port: int = None, unix_socket_path: str = None):
+        """
+        Serve forever, over TCP (host and port) and/or a Unix socket.
+        """
+        await self.start()
+        servers = []
+        if port is not None:
+            servers.append(await asyncio.start_server(self.handle_connection, host, port))
+        if unix_socket_path is not None:
+            servers.append(await asyncio.start_unix_server(self.handle_connection, unix_socket_path))
+        try:
+            await asyncio.gather(*(server.serve_forever() for server in servers))
+        finally:
+            await self.stop()
+
+
+def cli():
+    """
+    Command Line Interface to run the inference server.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, action="append", required=True, help="Path to an LLM model in gguf format (can be repeated, the first one is the default)")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host of the HTTP server")
+    parser.add_argument("--port", type=int, help="Port of the HTTP server")
+    parser.add_argument("--unix-socket", type=str, help="Path of the Unix socket of the server")
+    parser.add_argument("--workers", type=int, default=1, help="Number of generations run at the same time")
+    parser.add_argument("--max-queued-requests", type=int, default=16, help="Maximum number of requests waiting for a worker")
+    parser.add_argument("--n-ctx", type=int, default=0, help="Size of each context in tokens (0: training context size of the model)")
+    parser.add_argument("--threads", type=int, help="Number of threads of each context")
+    parser.add_argument("--compiled-schema-cache-dir", type=str, help="Directory where the JSON schemas compiled for the models are cached")
+    parser.add_argument("--max-body-bytes", type=int, default=2**20, help="Maximum size of the body of a request (larger ones get a 413)")
+    args = parser.parse_args()
+
+    for model_path in args.model_path:
+        if not os.path.exists(model_path):
+            print(f"Error: The model path does not exist: '{model_path}'")
+            return
+    if args.port is None and args.unix_socket is None:
+        print("Error: --port or --unix-socket is required.")
+        return
+
+    server = InferenceServer(args.model_path, args.workers, args.max_queued_requests, compiled_schema_cache_dir=args.compiled_schema_cache_dir,
+                             n_ctx=args.n_ctx, n_threads=args.threads, max_body_bytes=args.max_body_bytes)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix_socket))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    cli()
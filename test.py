@@ -2,14 +2,46 @@ import json_schema_constraint
 from json_schema_constraint import auto_complete, end_token, find_string_end, \
     find_number_end, find_boolean_end, find_array_end, find_object_end, ongoing_string_regexp, \
     END_NOT_REACHED, CAN_END_OR_CONTINUE
+from constrainers import JsonSchemaConstrainer, CompiledJsonSchemaConstrainer
+from compiled_json_schema_constraint import CompiledJsonSchemaIndex, get_compiled_json_schema_index
+from llama_cpp_wrapper.python_llama_cpp.vocab_utils import TokenPrefixIndex, Vocab
+from llama_cpp_wrapper.python_llama_cpp.constraint_utils import adjust_logits_based_on_suggestions, allowed_token_ids, forced_prefix, to_byte_completions
+from incremental_json_schema_constraint import IncrementalJsonSchemaParser
+import benchmark
+import fake_llama_cpp
+# The generation loops are tested on the fake llama_cpp module (even if llama_cpp is installed).
+fake_llama_cpp.install()
+from LLM_json_schema import run_inference_constrained_by_json_schema, run_batched_inference_constrained_by_json_schema, \
+    run_n_best_inference_constrained_by_json_schema
+from llama_cpp_wrapper.python_llama_cpp.model_utils import get_context, get_model, new_context, get_context_pool
+from llama_cpp_wrapper.python_llama_cpp.inference_with_completion import do_inference, sample_next_token, SamplingBuffers, tokenize_forced_text
+from json_schema_gbnf import json_schema_to_gbnf
+from schema_registry import SchemaRegistry, normalize_schema
+from json_events import JsonEventParser, format_path
+from llama_cpp_wrapper.python_llama_cpp.generation_stats import GenerationStats, StatsHistograms
+from llama_cpp_wrapper.python_llama_cpp.history_buffer import HistoryBuffer
+from llama_cpp_wrapper.python_llama_cpp.prompt_cache import PromptCache, common_prefix_length
+from batch import read_requests, read_checkpoint, run_requests
+from llama_cpp_wrapper.python_llama_cpp.speculative_sampling import residual_distribution, token_probability, verify_draft
+from server import InferenceServer, HttpError
+from llama_cpp_wrapper.python_llama_cpp.context_resources import get_context_resource, free_context_resources
+from concurrent.futures import ThreadPoolExecutor
 import unittest
+import numpy as np
+import os
+import tempfile
 import re
+import time
+import json
+import asyncio
+import importlib.util
 
 class TestAutoCompleteString(unittest.TestCase):
     def test_regexp(self):
         # good
         self.assertIsNotNone(re.match(ongoing_string_regexp, 'test'))
         self.assertIsNotNone(re.match(ongoing_string_regexp, 'te\\"st'))
+        self.assertIsNotNone(re.match(ongoing_string_regexp, 'test"'))
         # bad
         self.assertIsNone(re.match(ongoing_string_regexp, 'te"st'))
         self.assertIsNone(re.match(ongoing_string_regexp, '"test'))
@@ -159,6 +191,969 @@ class TestAutoCompleteObject(unittest.TestCase):
         self.assertEqual(auto_complete('{"coucou":{"caca":true', {"type":"object", "properties":{"coucou":{"type":"object", "properties":{"caca": {"type":"boolean"}}}}}), ['}'])
         self.assertEqual(auto_complete('{"coucou":1', {"type":"object", "properties":{"coucou":{"type":"number"}}}), ['}'+end_token, '0', '1', '2', '3', '4', '5', '6', '7', '8', '9', '.', 'e'])
 
+def incremental_auto_complete(incomplete_string, json_schema):
+    # Feed the constrainer character by character, like during generation.
+    constrainer = JsonSchemaConstrainer(json_schema)
+    for i in range(len(incomplete_string)+1):
+        completions = constrainer.compute_completion(incomplete_string[:i])
+    return completions
+
+class TestJsonSchemaConstrainer(unittest.TestCase):
+    def test_string(self):
+        self.assertEqual(incremental_auto_complete("", {"type": "string"}), ['"'])
+        self.assertEqual(incremental_auto_complete('  "', {"type": "string"}), [ongoing_string_regexp])
+        self.assertEqual(incremental_auto_complete('"a\\"5', {"type": "string"}), [ongoing_string_regexp])
+        self.assertEqual(incremental_auto_complete('""', {"type": "string"}), [end_token])
+
+    def test_number(self):
+        num_schema = {"type": "number"}
+        self.assertEqual(incremental_auto_complete("", num_schema), ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', '+', '-', '.'])
+        self.assertEqual(incremental_auto_complete("+2", num_schema), ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', '.', 'e', end_token])
+        self.assertEqual(incremental_auto_complete("3e", num_schema), ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', '+', '-'])
+        self.assertEqual(incremental_auto_complete("-8e4", num_schema), ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', end_token])
+        self.assertEqual(incremental_auto_complete("5.", num_schema), ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9'])
+
+    def test_boolean(self):
+        bool_schema = {"type": "boolean"}
+        self.assertEqual(incremental_auto_complete("", bool_schema), ['true'+end_token, 'false'+end_token])
+        self.assertEqual(incremental_auto_complete("fal", bool_schema), ['se'+end_token])
+        self.assertEqual(incremental_auto_complete("true", bool_schema), [end_token])
+        self.assertIsNone(incremental_auto_complete("tx", bool_schema))
+
+    def test_array(self):
+        array_schema = {"type":"array", "items":{"type":"string"}}
+        self.assertEqual(incremental_auto_complete(" ", array_schema), ["["])
+        self.assertEqual(incremental_auto_complete(" [", array_schema), ['"'])
+        self.assertEqual(incremental_auto_complete('["a"', array_schema), [", ", "]"+end_token])
+        self.assertEqual(incremental_auto_complete(' ["a", ', array_schema), ['"'])
+        self.assertEqual(incremental_auto_complete('["a", "a"]', array_schema), [end_token])
+        self.assertEqual(incremental_auto_complete(' [ [', {"type":"array", "items":array_schema}), ['"'])
+        self.assertEqual(incremental_auto_complete(' [1', {"type":"array", "items":{"type":"number"}}), [', ', ']'+end_token, '0', '1', '2', '3', '4', '5', '6', '7', '8', '9', '.', 'e'])
+        self.assertEqual(incremental_auto_complete(' [1, 2', {"type":"array", "items":{"type":"number"}}), [', ', ']'+end_token, '0', '1', '2', '3', '4', '5', '6', '7', '8', '9', '.', 'e'])
+
+    def test_object(self):
+        schema = {"type":"object", "properties":{"coucou":{"type":"string"}, "caca":{"type":"boolean"}}}
+        self.assertEqual(incremental_auto_complete("", schema), ['{'])
+        self.assertEqual(incremental_auto_complete("{", schema), ['"coucou":'])
+        self.assertEqual(incremental_auto_complete('{"cou', schema), ['cou":'])
+        self.assertEqual(incremental_auto_complete('{"coucou":"a"', schema), [', "caca":'])
+        self.assertEqual(incremental_auto_complete('{"coucou":"a",', schema), ['"caca":'])
+        self.assertEqual(incremental_auto_complete('{"coucou":"a", "caca":', schema), ['true', 'false'])
+        self.assertEqual(incremental_auto_complete('{"coucou":"a", "caca":true', schema), ['}'+end_token])
+        self.assertEqual(incremental_auto_complete('{"coucou":"a", "caca":true}', schema), [end_token])
+        self.assertEqual(incremental_auto_complete('{"coucou":{"caca":true', {"type":"object", "properties":{"coucou":{"type":"object", "properties":{"caca": {"type":"boolean"}}}}}), ['}'])
+        self.assertEqual(incremental_auto_complete('{"coucou":1', {"type":"object", "properties":{"coucou":{"type":"number"}}}), ['}'+end_token, '0', '1', '2', '3', '4', '5', '6', '7', '8', '9', '.', 'e'])
+
+    def test_same_as_auto_complete(self):
+        schema = {"type":"array", "items":{"type":"object", "properties":{"name":{"type":"string"}, "age":{"type":"number"}, "ok":{"type":"boolean"}}}}
+        # Generation chunks, the suggestions are compared between them.
+        chunks = ['[', '{', '"name":', '"', 'a', '\\"', 'b', '"', ', "age":', '1', '2', '.5', ', "ok":', 't', 'rue', '}',
+                  ', ', '{', '"name":', '"c"', ', ', '"age":', '3', 'e+2', ', "ok":', 'false', '}']
+        constrainer = JsonSchemaConstrainer(schema)
+        incomplete_string = ""
+        for chunk in chunks:
+            self.assertEqual(constrainer.compute_completion(incomplete_string), auto_complete(incomplete_string, schema), incomplete_string)
+            incomplete_string += chunk
+
+    def test_rewritten_history(self):
+        schema = {"type":"array", "items":{"type":"boolean"}}
+        constrainer = JsonSchemaConstrainer(schema)
+        self.assertEqual(constrainer.compute_completion('[tr'), ['ue'])
+        self.assertEqual(constrainer.compute_completion('[f'), ['alse'])
+
+    def test_copy(self):
+        schema = {"type":"array", "items":{"type":"boolean"}}
+        constrainer = JsonSchemaConstrainer(schema)
+        constrainer.compute_next_completion('[tr')
+        draft = constrainer.copy()
+        self.assertEqual(draft.compute_next_completion('ue, f'), ['alse'])
+        self.assertEqual(constrainer.compute_next_completion('u'), ['e'])
+
+    def test_max_token_length(self):
+        schema = {"type": "array", "items": {"type": "string", "maxLength": 8}}
+        vocab = [b"", b"a", b"ab", b"abc", b'"', b'c"', b"\\", b'\\"', b"]", b", "]
+        index = TokenPrefixIndex(vocab)
+        clamped = IncrementalJsonSchemaParser(schema, index.max_piece_length)
+        parser = IncrementalJsonSchemaParser(schema)
+        # 3 is the length of the longest token: the bounded regexp is only suggested for the last characters.
+        for text, ongoing in [('["', True), ('["abcde', True), ('["abcdef', False), ('["abcdefg\\', False)]:
+            clamped.reset()
+            clamped.feed(text)
+            parser.reset()
+            parser.feed(text)
+            self.assertEqual(clamped.completions() == [ongoing_string_regexp], ongoing, text)
+            self.assertEqual(index.compute_allowed_token_mask(clamped.completions()).tolist(),
+                             index.compute_allowed_token_mask(parser.completions()).tolist(), text)
+
+class TestTokenPrefixIndex(unittest.TestCase):
+    def test_prefix_token_ids(self):
+        index = TokenPrefixIndex([b"", b"]", b", ", b",", b"]\0", b"}", b" ", b", \"", b","])
+        self.assertEqual(index.prefix_token_ids(b", "), [3, 8, 2])
+        self.assertEqual(index.prefix_token_ids(b"]\0"), [1, 4])
+        self.assertEqual(index.prefix_token_ids(b"{"), [])
+        self.assertEqual(index.prefix_token_ids(b""), [])
+
+    def test_mask_cache(self):
+        index = TokenPrefixIndex([b"", b"]", b", ", b",", b"]\0"], mask_cache_size=2)
+        mask = index.allowed_token_mask([b", ", b"]\0"])
+        self.assertIs(index.allowed_token_mask([b"]\0", b", "]), mask)
+        self.assertFalse(mask.flags.writeable)
+        index.allowed_token_mask([b"]"])
+        index.allowed_token_mask([ongoing_string_regexp])
+        self.assertEqual(index.mask_cache_stats(), {"hits": 1, "misses": 3, "size": 2})
+        self.assertIsNot(index.allowed_token_mask([b", ", b"]\0"]), mask)
+        self.assertEqual(index.allowed_token_mask([b", ", b"]\0"]).tolist(), mask.tolist())
+
+    def test_regexp_cache(self):
+        index = TokenPrefixIndex([b"", b"a", b"aa", b'"'], regexp_cache_size=2)
+        patterns = [re.compile(f"^a{{0,{n}}}$") for n in range(4)]
+        for pattern in patterns:
+            index.regexp_mask(pattern)
+        self.assertEqual(list(index.regexp_masks), patterns[2:])
+        self.assertEqual(index.regexp_mask(patterns[0]).tolist(), [False, False, False, False])
+        self.assertEqual(index.regexp_mask(patterns[3]).tolist(), [False, True, True, False])
+        self.assertEqual(list(index.regexp_masks), [patterns[0], patterns[3]])
+
+    def test_tokenize_greedy(self):
+        index = TokenPrefixIndex([b"", b"]", b", ", b",", b" \"", b"}", b" ", b", \"", b"\""])
+        self.assertEqual(index.tokenize_greedy(b', ""}'), [7, 8, 5])
+        self.assertEqual(index.tokenize_greedy(b' , '), [6, 2])
+        self.assertEqual(index.tokenize_greedy(b''), [])
+        self.assertEqual(index.tokenize_greedy(b'{'), None)
+
+    def test_allowed_token_mask(self):
+        index = TokenPrefixIndex([b"", b"]", b", ", b"Paris", b'"', b'is"', b'a"b', b"\\", b"\xe2"])
+        self.assertEqual(index.allowed_token_mask([b", ", b"]\0"]).tolist(), [False, True, True, False, False, False, False, False, False])
+        self.assertEqual(index.allowed_token_mask([ongoing_string_regexp]).tolist(), [False, True, True, True, True, True, False, True, True])
+
+    def test_allowed_token_ids(self):
+        index = TokenPrefixIndex([b"", b"]", b", ", b"Paris", b'"', b'is"'])
+        self.assertEqual(index.allowed_token_ids([b", ", b"]\0"]).tolist(), [1, 2])
+        self.assertEqual(index.allowed_token_ids([b'"']).tolist(), [4])
+        # The sampling candidates are only the allowed tokens.
+        model = fake_llama_cpp.FakeModel(index.vocab, None)
+        ctx = fake_llama_cpp.llama_new_context_with_model(model, fake_llama_cpp.llama_context_default_params())
+        buffers = SamplingBuffers(ctx, model, 8, 8)
+        logits = np.array([0.0, 1.0, 3.0, 9.0, 2.0, 8.0], dtype=np.float32)
+        self.assertEqual(sample_next_token(ctx, logits, buffers, buffers.last_tokens, [b", ", b"]\0"], index), 2)
+
+class TestAdjustLogits(unittest.TestCase):
+    index = TokenPrefixIndex([b"", b"]", b", ", b"Paris", b'"', b'is"'])
+
+    def logits(self):
+        return np.array([0.0, 1.0, 3.0, 9.0, 2.0, 8.0], dtype=np.float32)
+
+    def test_hard_mask(self):
+        logits = self.logits()
+        adjust_logits_based_on_suggestions([b", ", b"]\0"], logits, self.index)
+        self.assertEqual(logits.tolist(), [-np.inf, 1.0, 3.0, -np.inf, -np.inf, -np.inf])
+        logits = self.logits()
+        adjust_logits_based_on_suggestions([ongoing_string_regexp], logits, self.index)
+        self.assertEqual(logits.tolist(), [-np.inf, 1.0, 3.0, 9.0, 2.0, 8.0])
+
+    def test_soft_mask(self):
+        logits = self.logits()
+        adjust_logits_based_on_suggestions([b", ", b"]\0"], logits, self.index, hard_mask=False)
+        self.assertEqual(logits.tolist(), [0.0, 6.0, 8.0, 9.0, 2.0, 8.0])
+
+    def test_precomputed_tokens(self):
+        mask = self.index.allowed_token_mask([b", ", b"]\0"])
+        token_ids = self.index.allowed_token_ids([b", ", b"]\0"])
+        for allowed in [mask, token_ids]:
+            logits = self.logits()
+            adjust_logits_based_on_suggestions(allowed, logits, self.index)
+            self.assertEqual(logits.tolist(), [-np.inf, 1.0, 3.0, -np.inf, -np.inf, -np.inf])
+            logits = self.logits()
+            adjust_logits_based_on_suggestions(allowed, logits, self.index, hard_mask=False)
+            self.assertEqual(logits.tolist(), [0.0, 6.0, 8.0, 9.0, 2.0, 8.0])
+            self.assertEqual(allowed_token_ids(allowed, self.index).tolist(), [1, 2])
+
+    def test_no_allowed_token(self):
+        # The logits are not constrained when no token is allowed.
+        for suggestions in [[b"{"], np.zeros(6, dtype=bool), np.array([], dtype=np.intc)]:
+            logits = self.logits()
+            adjust_logits_based_on_suggestions(suggestions, logits, self.index)
+            self.assertEqual(logits.tolist(), self.logits().tolist())
+
+class TestForcedPrefix(unittest.TestCase):
+    def test_forced_prefix(self):
+        self.assertEqual(forced_prefix([b'"name":']), b'"name":')
+        self.assertEqual(forced_prefix([b'"name":', b'"number":']), b'"n')
+        self.assertEqual(forced_prefix([b", ", b"]\0"]), b"")
+
+    def test_not_forced(self):
+        self.assertEqual(forced_prefix(None), b"")
+        self.assertEqual(forced_prefix([]), b"")
+        self.assertEqual(forced_prefix([b'"a', ongoing_string_regexp]), b"")
+        self.assertEqual(forced_prefix(np.array([1, 2], dtype=np.intc)), b"")
+
+    def test_utf8_boundary(self):
+        # "\xc3\xa9" (é) and "\xc3\xa8" (è) share their first byte, which is not forced alone.
+        self.assertEqual(forced_prefix(["aé".encode(), "aè".encode()]), b"a")
+        self.assertEqual(forced_prefix(["é".encode(), "è".encode()]), b"")
+        self.assertEqual(forced_prefix(["€1".encode(), "€2".encode()]), "€".encode())
+
+class TestVocab(unittest.TestCase):
+    pieces = [b"", b"]", b", ", b",", b"]\0", b"}", b"a" * 100, b", \"", b","]
+
+    def test_pieces(self):
+        vocab = Vocab.from_pieces(self.pieces)
+        self.assertEqual(len(vocab), len(self.pieces))
+        self.assertEqual(list(vocab), self.pieces)
+        self.assertEqual(vocab[6], b"a" * 100)
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(cache_dir, "model.gguf.vocab")
+            Vocab.from_pieces(self.pieces).save(path)
+            vocab = Vocab.load(path)
+            self.assertEqual(list(vocab), self.pieces)
+            self.assertEqual(TokenPrefixIndex(vocab).prefix_token_ids(b", "), [3, 8, 2])
+
+class TestCompiledJsonSchemaIndex(unittest.TestCase):
+    vocab = [b"", b"[", b"]", b",", b", ", b" ", b'"', b'a', b'b"', b"1", b"2", b".", b"e", b"-", b"{", b"}", b'"x":', b'"', b"\0"]
+    schema = {"type":"array", "items":{"type":"object", "properties":{"x":{"type":"number"}, "y":{"type":"string"}}}}
+
+    def test_same_masks_as_suggestions(self):
+        prefix_index = TokenPrefixIndex(self.vocab)
+        compiled_constrainer = CompiledJsonSchemaConstrainer(self.schema, CompiledJsonSchemaIndex.compile(self.schema, prefix_index))
+        constrainer = JsonSchemaConstrainer(self.schema)
+        history = ""
+        for chunk in ['[', '{"x":', '1', '2', ', "y":', '"', 'a', 'b"', '}', ', ', '{"x":', '-', '1', ', "y":', '"b"', '}', ']']:
+            compiled_completions = compiled_constrainer.compute_completion(history)
+            completions = constrainer.compute_completion(history)
+            suggestions = [c.encode() if type(c) is str else c for c in completions]
+            if isinstance(compiled_completions, list):
+                # The forced text, or the prefix shared by the suggestions (jump forward)
+                self.assertEqual(compiled_completions, [forced_prefix(suggestions).decode()], history)
+            else:
+                expected_ids = prefix_index.allowed_token_ids(suggestions)
+                self.assertEqual(compiled_completions.tolist(), expected_ids.tolist(), history)
+            history += chunk
+        self.assertEqual(compiled_constrainer.compute_completion(history), [end_token])
+
+    def test_jump_forward(self):
+        schema = {"type":"array", "items":{"enum":["ab", "a."]}}
+        prefix_index = TokenPrefixIndex(self.vocab)
+        compiled_index = CompiledJsonSchemaIndex.compile(schema, prefix_index)
+        self.assertEqual(JsonSchemaConstrainer(schema).compute_completion('['), ['"ab"', '"a."'])
+        compiled_constrainer = CompiledJsonSchemaConstrainer(schema, compiled_index)
+        self.assertEqual(compiled_constrainer.compute_completion('['), ['"a'])
+        self.assertEqual(compiled_constrainer.compute_completion('["a').tolist(), prefix_index.allowed_token_ids([b'b"', b'."']).tolist())
+        compiled_constrainer = CompiledJsonSchemaConstrainer(schema, compiled_index, jump_forward=False)
+        token_ids = compiled_constrainer.compute_completion('[')
+        self.assertEqual(token_ids.tolist(), prefix_index.allowed_token_ids([b'"ab"', b'"a."']).tolist())
+        # The ids are unpacked once per state.
+        self.assertIs(compiled_constrainer.compute_completion('['), token_ids)
+
+    def test_disk_cache(self):
+        prefix_index = TokenPrefixIndex(self.vocab)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            compiled_index = get_compiled_json_schema_index(self.schema, prefix_index, cache_dir)
+            path = os.path.join(cache_dir, os.listdir(cache_dir)[0].split(".")[0])
+            loaded_index = CompiledJsonSchemaIndex.load(path)
+        self.assertEqual(loaded_index.state_ids, compiled_index.state_ids)
+        self.assertEqual(loaded_index.forced_texts, compiled_index.forced_texts)
+        self.assertEqual(loaded_index.shared_prefixes, compiled_index.shared_prefixes)
+        self.assertEqual(loaded_index.packed_masks.tolist(), compiled_index.packed_masks.tolist())
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_generate_follows_schema(self):
+        model = benchmark.fake_model(benchmark.synthetic_vocab(2000))
+        json_schema = benchmark.nested_schema(3)
+        stats = GenerationStats()
+        text = benchmark.generate(JsonSchemaConstrainer(json_schema), model, 100, stats=stats)
+        # The JSON value is closed before the end of the budget.
+        self.assertTrue(follows_schema(json_schema, text), text)
+        self.assertEqual(len(stats.mask_times), stats.n_sampled_tokens)
+        self.assertEqual(text, benchmark.generate(JsonSchemaConstrainer(json_schema), model, 100))
+        self.assertNotEqual(text, benchmark.generate(JsonSchemaConstrainer(json_schema), model, 100, seed=1))
+
+    def test_benchmark_generation(self):
+        model = benchmark.fake_model(benchmark.synthetic_vocab(2000))
+        json_schema = benchmark.nested_schema(2)
+        compiled_index = CompiledJsonSchemaIndex.compile(json_schema, model.prefix_index)
+        for result in (benchmark.benchmark_generation(json_schema, model, 50, n_runs=1),
+                       benchmark.benchmark_generation(json_schema, model, 50, compiled_index, n_runs=1)):
+            self.assertGreater(result["sampled_tokens"], 0)
+            self.assertGreater(result["forced_tokens"], 0)
+            self.assertGreater(result["constraint"]["mean_us"], 0)
+            self.assertGreater(result["peak_alloc_bytes_per_token"], 0)
+
+
+class TestGenerationStats(unittest.TestCase):
+    def test_histograms(self):
+        stats = GenerationStats()
+        stats.token_eval_times = [0.01, 0.02, 0.5]
+        stats.mask_times = [1e-5]
+        stats.n_sampled_tokens = 3
+        stats.finish()
+        self.assertGreater(stats.tokens_per_second, 0)
+        histograms = StatsHistograms()
+        histograms.add(stats)
+        histograms.add(stats)
+        result = histograms.to_dict()
+        self.assertEqual(result["n_generations"], 2)
+        self.assertEqual(sum(result["counts"]["token_eval_time"]), 6)
+        self.assertEqual(sum(result["counts"]["mask_time"]), 2)
+
+
+class TestHistoryBuffer(unittest.TestCase):
+    def test_split_character(self):
+        history = HistoryBuffer(b" prompt")
+        self.assertEqual(history.new_text(), " prompt")
+        self.assertEqual(history.append(b'"\xc3'), '"')
+        self.assertEqual(history.append(b'\xa9t\xc3\xa9"'), '\u00e9t\u00e9"')
+        self.assertEqual(history.new_text(), '"\u00e9t\u00e9"')
+        self.assertEqual(history.new_text(), '')
+        self.assertEqual(history.text(), ' prompt"\u00e9t\u00e9"')
+
+    def test_incremental_constrainer(self):
+        json_schema = {"type": "array", "items": {"type": "string"}}
+        constrainer = JsonSchemaConstrainer(json_schema)
+        history = HistoryBuffer(keep_text=False)
+        for piece in [b'["', b'caf\xc3', b'\xa9', b'", "']:
+            history.append(piece)
+            completions = constrainer.compute_next_completion(history.new_text())
+        self.assertEqual(completions, JsonSchemaConstrainer(json_schema).compute_completion('["caf\u00e9", "'))
+        self.assertEqual(history.text_parts, [])
+        self.assertRaises(Exception, history.text)
+
+
+class TestJsonSchemaToGbnf(unittest.TestCase):
+    def test_object(self):
+        json_schema = {"type": "object", "properties": {"country": {"type": "string"}, "cities": {"type": "array", "items": {"type": "number"}}}}
+        self.assertEqual(json_schema_to_gbnf(json_schema).splitlines(), [
+            'root ::= node0',
+            'node0 ::= "{" ws "\\"country\\":" ws string ws "," ws "\\"cities\\":" ws node1 ws "}"',
+            'node1 ::= "[" ws number ( ws "," ws number )* ws "]"',
+            'number ::= [-+]? ( [0-9]+ ( "." [0-9]+ )? | "." [0-9]+ ) ( [eE] [-+]? [0-9]+ )?',
+            'string ::= "\\"" ( [^"\\\\\\x00-\\x1F] | "\\\\" [^\\x00-\\x1F] )* "\\""',
+            'ws ::= " "?',
+        ])
+
+    def test_unsupported(self):
+        self.assertIsNone(json_schema_to_gbnf({"type": "integer"}))
+        self.assertIsNone(json_schema_to_gbnf({"type": "array", "items": {"type": "integer"}}))
+        self.assertIsNotNone(JsonSchemaConstrainer({"type": "boolean"}).to_gbnf())
+
+
+class TestClosingText(unittest.TestCase):
+    json_schema = {"type": "object", "properties": {
+        "name": {"type": "string", "maxLength": 3},
+        "scores": {"type": "array", "items": {"type": "number"}, "maxItems": 2},
+        "valid": {"type": "boolean"}}}
+
+    def test_closing_text(self):
+        for text, closing_text in [
+                ('', '{"name":"","scores":[0],"valid":true}'),
+                ('{"na', 'me":"","scores":[0],"valid":true}'),
+                ('{"name":"a\\', 'n","scores":[0],"valid":true}'),
+                ('{"name":"ab", "scores":[1, -', '0],"valid":true}'),
+                ('{"name":"ab", "scores":[1]', ',"valid":true}'),
+                ('{"name":"ab", "scores":[1], "valid":f', 'alse}')]:
+            constrainer = JsonSchemaConstrainer(self.json_schema)
+            constrainer.compute_completion(text)
+            self.assertEqual(constrainer.closing_text(), closing_text)
+            constrainer.compute_completion(text + closing_text)
+            self.assertTrue(constrainer.parser.finished)
+
+    def test_max_length_and_max_items(self):
+        constrainer = JsonSchemaConstrainer(self.json_schema)
+        self.assertEqual(constrainer.compute_completion('{"name":"abc'), ['"'])
+        self.assertNotIn(", ", constrainer.compute_completion('{"name":"abc", "scores":[1, 2'))
+        constrainer.compute_completion('{"name":"abc", "scores":[1, 2,')
+        self.assertIsNone(constrainer.completions())
+        self.assertIsNone(constrainer.closing_text())
+
+    def test_max_items_zero(self):
+        json_schema = {"type": "object", "properties": {"tags": {"type": "array", "items": {"type": "string"}, "maxItems": 0}}}
+        constrainer = JsonSchemaConstrainer(json_schema)
+        self.assertEqual(constrainer.closing_text(), '{"tags":[]}')
+        self.assertEqual(constrainer.compute_completion('{"tags":['), [']'])
+        self.assertEqual(constrainer.closing_text(), ']}')
+        self.assertIsNone(constrainer.compute_completion('{"tags":["'))
+        self.assertEqual(constrainer.compute_completion('{"tags":[]}'), [end_token])
+
+
+class TestSchemaRegistry(unittest.TestCase):
+    def test_normalize_schema(self):
+        json_schema = {"definitions": {"city": {"type": "object", "properties": {"name": {"type": "string"}, 'pop"': {"type": "number"}}}},
+                       "type": "array", "items": {"$ref": "#/definitions/city"}}
+        root = normalize_schema(json_schema)
+        self.assertEqual((root.type, root.node_id, root.items.node_id), ("array", 0, 1))
+        self.assertEqual([key for key, node in root.items.properties], ['"name":', '"pop\\"":'])
+        self.assertEqual(root.min_text, '[{"name":"","pop\\"":0}]')
+        self.assertEqual(incremental_auto_complete('[{"name":"Paris"', json_schema), [', "pop\\"":'])
+        with self.assertRaises(Exception):
+            normalize_schema({"definitions": {"a": {"$ref": "#/definitions/a"}}, "$ref": "#/definitions/a"})
+
+    def test_cache(self):
+        registry = SchemaRegistry(max_size=2)
+        checked = []
+        schemas = [{"type": "string"}, {"type": "number"}, {"type": "boolean"}]
+        self.assertIs(registry.get(schemas[0]), registry.get(dict(schemas[0])))
+        self.assertIsNone(registry.validate(schemas[1], checked.append))
+        self.assertIsNone(registry.validate(schemas[1], checked.append))
+        self.assertEqual(len(checked), 1)
+        self.assertIsNotNone(registry.validate({"type": "integer"}, checked.append))
+        self.assertEqual(len(registry.entries), 2)
+        registry.get(schemas[2])
+        self.assertEqual(len(registry.entries), 2)
+
+
+class TestUnionAndEnum(unittest.TestCase):
+    def test_enum(self):
+        json_schema = {"enum": ["red", "green", "grey"]}
+        self.assertEqual(incremental_auto_complete('', json_schema), ['"red"'+end_token, '"green"'+end_token, '"grey"'+end_token])
+        self.assertEqual(incremental_auto_complete(' "gr', json_schema), ['een"'+end_token, 'ey"'+end_token])
+        self.assertEqual(incremental_auto_complete('"gree', json_schema), ['n"'+end_token])
+        self.assertIsNone(incremental_auto_complete('"b', json_schema))
+        json_schema = {"type": "object", "properties": {"kind": {"const": "point"}, "n": {"enum": [1, 12]}}}
+        self.assertEqual(incremental_auto_complete('{"kind":', json_schema), ['"point"'])
+        self.assertEqual(incremental_auto_complete('{"kind":"point", "n":1', json_schema), ['}'+end_token, '2'])
+
+    def test_any_of(self):
+        json_schema = {"type": "array", "items": {"anyOf": [{"type": "number"}, {"type": "null"}]}}
+        self.assertEqual(incremental_auto_complete('[', json_schema), ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', '+', '-', '.', 'null'])
+        self.assertEqual(incremental_auto_complete('[n', json_schema), ['ull'])
+        self.assertEqual(incremental_auto_complete('[null, 2', json_schema), [', ', ']'+end_token, '0', '1', '2', '3', '4', '5', '6', '7', '8', '9', '.', 'e'])
+        json_schema = {"oneOf": [{"type": "object", "properties": {"a": {"type": "number"}}},
+                                 {"type": "object", "properties": {"b": {"type": ["string", "boolean"]}}}]}
+        self.assertEqual(incremental_auto_complete('', json_schema), ['{'])
+        self.assertEqual(incremental_auto_complete('{', json_schema), ['"a":', '"b":'])
+        self.assertEqual(incremental_auto_complete('{"b', json_schema), ['":'])
+        self.assertEqual(incremental_auto_complete('{"b":t', json_schema), ['rue'])
+        self.assertEqual(incremental_auto_complete('{"b":true}', json_schema), [end_token])
+        constrainer = JsonSchemaConstrainer(json_schema)
+        constrainer.compute_completion('{"')
+        self.assertEqual(constrainer.closing_text(), 'a":0}')
+        self.assertEqual(constrainer.copy().compute_next_completion('b":'), ['"', 'true', 'false'])
+        self.assertEqual(constrainer.compute_next_completion('a":'), ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', '+', '-', '.'])
+
+    def test_gbnf(self):
+        self.assertEqual(json_schema_to_gbnf({"enum": ["a", None]}), 'root ::= node0\nnode0 ::= "\\"a\\"" | "null"\nws ::= " "?\n')
+        self.assertIn('node0 ::= boolean | node1', json_schema_to_gbnf({"anyOf": [{"type": "boolean"}, {"const": 1}]}))
+
+    def test_events(self):
+        parser = JsonEventParser({"type": "array", "items": {"anyOf": [{"type": "array", "items": {"type": "number"}}, {"enum": ["a", None]}]}})
+        self.assertEqual(parser.feed('[[1, +2], null, "a"]'), [
+            ("start_array", ()), ("value", (0,), [1, 2]), ("value", (1,), None), ("value", (2,), "a"), ("end_array", ())])
+
+
+class TestJsonEventParser(unittest.TestCase):
+    def test_events(self):
+        json_schema = {"type": "object", "properties": {
+            "cities": {"type": "array", "items": {"type": "object", "properties": {"name": {"type": "string"}, "pop": {"type": "number"}}}},
+            "ok": {"type": "boolean"}}}
+        parser = JsonEventParser(json_schema)
+        self.assertEqual(parser.feed('{"cities": [{"name": "Pa'), [
+            ("start_object", ()), ("start_array", ("cities",)), ("start_object", ("cities", 0))])
+        self.assertEqual(parser.feed('ris", "pop": +2'), [("value", ("cities", 0, "name"), "Paris")])
+        self.assertEqual(parser.feed('.1e6}, {"name": "Lyon", "pop": 5}], "ok": true}'), [
+            ("value", ("cities", 0, "pop"), 2.1e6), ("end_object", ("cities", 0)),
+            ("start_object", ("cities", 1)), ("value", ("cities", 1, "name"), "Lyon"), ("value", ("cities", 1, "pop"), 5),
+            ("end_object", ("cities", 1)), ("end_array", ("cities",)), ("value", ("ok",), True), ("end_object", ())])
+        self.assertEqual(parser.finish(), [])
+        self.assertEqual(format_path(("cities", 1, "pop")), "$.cities[1].pop")
+
+    def test_scalar_root(self):
+        parser = JsonEventParser({"type": "number"})
+        self.assertEqual(parser.feed(" 12"), [])
+        self.assertEqual(parser.finish(), [("value", (), 12)])
+        with self.assertRaises(ValueError):
+            JsonEventParser({"type": "boolean"}).feed("tx")
+
+    def test_unterminated_value(self):
+        for json_schema, text in [({"type": "string"}, '"ab'), ({"type": "array", "items": {"type": "number"}}, "[1"), ({"type": "boolean"}, "tru")]:
+            parser = JsonEventParser(json_schema)
+            parser.feed(text)
+            with self.assertRaises(ValueError):
+                parser.finish()
+
+class TestPromptCache(unittest.TestCase):
+    def test_common_prefix_length(self):
+        self.assertEqual(common_prefix_length([1, 2, 3], [1, 2, 4]), 2)
+        self.assertEqual(common_prefix_length([1, 2], [1, 2, 3]), 2)
+        self.assertEqual(common_prefix_length([1, 2, 3], [1, 2, 3]), 3)
+        self.assertEqual(common_prefix_length([5], [1, 2]), 0)
+        self.assertEqual(common_prefix_length([], [1]), 0)
+        self.assertEqual(common_prefix_length((1, 2), [1, 2]), 2)
+
+    def test_lru_eviction(self):
+        cache = PromptCache(max_bytes=10)
+        cache._add((1,), b"aaaa", 4)
+        cache._add((2,), b"bbbb", 4)
+        cache.entries.move_to_end((1,))
+        cache._add((3,), b"cccc", 4)
+        # The least recently used state is evicted.
+        self.assertEqual(list(cache.entries), [(1,), (3,)])
+        self.assertEqual(cache.total_bytes, 8)
+        cache._add((4,), b"d" * 11, 11)
+        self.assertEqual(list(cache.entries), [])
+        self.assertEqual(cache.total_bytes, 0)
+
+    def test_context_tokens(self):
+        cache = PromptCache()
+        self.assertEqual(cache.restore("ctx", [1, 2, 3]), 0)
+        cache.set_context_tokens("ctx", [1, 2, 3, 4])
+        # The last token of the prompt is evaluated again, to get its logits.
+        self.assertEqual(cache.restore("ctx", [1, 2, 3]), 2)
+        self.assertEqual(cache.context_tokens["ctx"], [1, 2])
+        self.assertEqual(cache.restore("ctx", [1, 2, 5, 6]), 2)
+        self.assertEqual(cache.restore("other ctx", [1, 2, 5, 6]), 0)
+
+    def test_cache_dir(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for i, tokens in enumerate([[1, 2], [3, 4, 5]]):
+                path = os.path.join(cache_dir, f"{i}.state")
+                with open(path, "wb") as f:
+                    f.write(np.array([len(tokens)], dtype=np.int64).tobytes())
+                    f.write(np.array(tokens, dtype=np.int32).tobytes())
+                    f.write(b"state")
+                os.utime(path, (i, i))
+            cache = PromptCache(cache_dir=cache_dir)
+            self.assertEqual(list(cache.entries), [(1, 2), (3, 4, 5)])
+            # The oldest state file is evicted first, and removed.
+            cache = PromptCache(max_bytes=os.path.getsize(os.path.join(cache_dir, "1.state")), cache_dir=cache_dir)
+            self.assertEqual(list(cache.entries), [(3, 4, 5)])
+            self.assertEqual(os.listdir(cache_dir), ["1.state"])
+
+
+class TestBatch(unittest.TestCase):
+    def test_read_requests(self):
+        lines = ['{"prompt": "a", "id": 7}\n', '\n', '{"prompt": 1}\n', 'not json\n', '{"prompt": "b", "json_schema": {"type": "string"}}']
+        self.assertEqual(list(read_requests(lines)), [
+            (0, {"prompt": "a", "id": 7}),
+            (1, {"error": "The request must be a json object with a 'prompt' string."}),
+            (2, {"error": "The line is not a valid json."}),
+            (3, {"prompt": "b", "json_schema": {"type": "string"}}),
+        ])
+
+    def test_read_checkpoint(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            path = os.path.join(output_dir, "results.jsonl")
+            self.assertEqual(read_checkpoint(path), set())
+            with open(path, "w") as f:
+                f.write('{"index": 0, "output": "1"}\n{"index": 2, "output": "3"}\n{"index": 1, "out')
+            # The last line was not fully written: it is removed.
+            self.assertEqual(read_checkpoint(path), {0, 2})
+            with open(path) as f:
+                self.assertEqual(f.read(), '{"index": 0, "output": "1"}\n{"index": 2, "output": "3"}\n')
+            self.assertEqual(read_checkpoint(path), {0, 2})
+
+    def generate(self, index, request):
+        # The first requests are the slowest, so they finish last.
+        time.sleep(0.01 * (5 - index))
+        return {"index": index, "output": request["prompt"]}
+
+    def test_ordered(self):
+        results = []
+        requests = [(i, {"prompt": str(i)}) for i in range(6)]
+        run_requests(requests, self.generate, results.append, n_workers=3, ordered=True, done_indices={4})
+        self.assertEqual([result["index"] for result in results], [0, 1, 2, 3, 5])
+
+    def test_unordered(self):
+        results = []
+        requests = [(i, {"prompt": str(i)}) for i in range(6)]
+        run_requests(requests, self.generate, results.append, n_workers=3)
+        self.assertEqual(sorted(result["index"] for result in results), list(range(6)))
+        self.assertNotEqual([result["index"] for result in results], list(range(6)))
+
+
+class TestSpeculativeSampling(unittest.TestCase):
+    p = (np.array([1, 2, 3]), np.array([0.5, 0.3, 0.2]))
+    q = (np.array([2, 3, 4]), np.array([0.6, 0.1, 0.3]))
+
+    def test_token_probability(self):
+        self.assertEqual(token_probability(self.p, 2), 0.3)
+        self.assertEqual(token_probability(self.p, 4), 0.0)
+
+    def test_residual_distribution(self):
+        ids, probs = residual_distribution(self.p, self.q)
+        self.assertEqual(ids.tolist(), [1, 2, 3, 4])
+        # max(p - q, 0), normalized: only the tokens 1 and 3 are more likely with the model.
+        np.testing.assert_allclose(probs / probs.sum(), [0.5 / 0.6, 0.0, 0.1 / 0.6, 0.0])
+
+    def test_residual_distribution_all_zero(self):
+        # When p is nowhere above q (here p == q), p is returned.
+        self.assertIs(residual_distribution(self.p, self.p), self.p)
+
+    def test_verify_draft(self):
+        rng = np.random.default_rng(0)
+        certain = (np.array([7]), np.array([1.0]))
+        # Accepted tokens (p >= q), followed by a token sampled after the draft.
+        self.assertEqual(verify_draft([7, 7], [certain, certain], lambda i: certain, 3, rng), [7, 7, 7])
+        self.assertEqual(verify_draft([7, 7], [certain, certain], lambda i: certain, 2, rng), [7, 7])
+        # A token the model can not sample is rejected, and replaced by a token of the residual distribution.
+        other = (np.array([8]), np.array([1.0]))
+        positions = []
+
+        def target(i):
+            positions.append(i)
+            return certain if i == 0 else other
+        self.assertEqual(verify_draft([7, 7, 7], [certain] * 3, target, 4, rng), [7, 8])
+        self.assertEqual(positions, [0, 1])
+
+    def test_verify_draft_distribution(self):
+        # The accepted or resampled first token follows the distribution of the model.
+        rng = np.random.default_rng(0)
+        counts = np.zeros(5)
+        for _ in range(10000):
+            draft_token = int(rng.choice(self.q[0], p=self.q[1]))
+            counts[verify_draft([draft_token], [self.q], lambda i: self.p, 1, rng)[0]] += 1
+        np.testing.assert_allclose(counts[1:4] / counts.sum(), self.p[1], atol=0.02)
+        self.assertEqual(counts[4], 0)
+
+
+def fake_model_path(directory: str, name: str, vocab: Vocab, seed: int = 0, sharpness: float = 1.0, **kwargs) -> str:
+    """
+    Registers a fake model (see fake_llama_cpp) whose logits are given by a FakeBackend, and returns its path.
+    The logits are multiplied by sharpness: with a large one, the sampling always picks the most likely allowed token.
+    """
+    model_path = os.path.join(directory, name)
+    # The vocabulary cache of a model is identified by its file.
+    with open(model_path, "w") as f:
+        f.write(name)
+    backend = benchmark.FakeBackend(vocab, seed)
+    backend.rows *= sharpness
+    fake_llama_cpp.register_model(model_path, fake_llama_cpp.FakeModel(vocab, backend, **kwargs))
+    return model_path
+
+
+def follows_schema(json_schema: dict, text: str) -> bool:
+    parser = IncrementalJsonSchemaParser(json_schema)
+    parser.feed(text + end_token)
+    return parser.finished and not parser.error
+
+
+class FakeModelTestCase(unittest.TestCase):
+    """
+    The tests of the generation loops, with a fake model and a fake draft model of the same vocabulary.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.vocab = benchmark.synthetic_vocab(2000)
+        cls.model_path = fake_model_path(cls.directory.name, "model.gguf", cls.vocab, seed=0)
+        cls.draft_model_path = fake_model_path(cls.directory.name, "draft.gguf", cls.vocab, seed=1)
+        cls.greedy_model_path = fake_model_path(cls.directory.name, "greedy.gguf", cls.vocab, seed=2, sharpness=1000.0)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+
+class TestSpeculativeInference(FakeModelTestCase):
+    def test_follows_schema(self):
+        json_schema = benchmark.nested_schema(2)
+        for max_tokens in (20, 200):
+            text = "".join(run_inference_constrained_by_json_schema(self.model_path, json_schema, "Hi", max_tokens=max_tokens,
+                                                                    draft_model_path=self.draft_model_path))
+            self.assertTrue(follows_schema(json_schema, text), text)
+
+
+class TestTokenBudget(FakeModelTestCase):
+    # The arrays are never closed by the fake model, so the budget ends the generation, at every step of the items.
+    # Some budgets end right after an item separator, whose forced item start can not be followed by the closing text.
+    json_schema = {"type": "array", "items": {"type": "object", "properties": {"name": {"type": "string"}, "value": {"type": "number"}}}}
+    budgets = range(20, 60)
+
+    def test_do_inference(self):
+        for max_tokens in self.budgets:
+            text = "".join(run_inference_constrained_by_json_schema(self.model_path, self.json_schema, "Hi", max_tokens=max_tokens))
+            self.assertTrue(follows_schema(self.json_schema, text), (max_tokens, text))
+
+    def test_native_grammar(self):
+        # With a native grammar, the completion callback only follows the text, the forced closing text is yielded as well.
+        text = "".join(do_inference(b"Hi", model_path=self.model_path, completion_callback=lambda new_text: None, verbose=False,
+                                    incremental_callback=True, grammar_gbnf='root ::= "[]"', n_predict=12, closing_callback=lambda: b'"}]'))
+        self.assertTrue(text.endswith('"}]'), text)
+
+    def test_speculative(self):
+        for max_tokens in self.budgets:
+            text = "".join(run_inference_constrained_by_json_schema(self.model_path, self.json_schema, "Hi", max_tokens=max_tokens,
+                                                                    draft_model_path=self.draft_model_path))
+            self.assertTrue(follows_schema(self.json_schema, text), (max_tokens, text))
+
+    def test_batched(self):
+        for max_tokens in self.budgets:
+            texts = ["", ""]
+            for index, chunk in run_batched_inference_constrained_by_json_schema(
+                    self.model_path, [("Hi", self.json_schema), ("Hello", self.json_schema)], max_tokens=max_tokens):
+                texts[index] += chunk
+            for text in texts:
+                self.assertTrue(follows_schema(self.json_schema, text), (max_tokens, text))
+
+
+class TestJumpForward(FakeModelTestCase):
+    # "é" is b"\xc3\xa9": it has no token of its own, and a token starts in the middle of it.
+    pieces = [b"", b"<s>", b"</s>", b'"', b' "', b" ", b"\xc3", b"\xa9", b"\xa9t", b"t", b"e", b":", b'":']
+
+    def tokenize(self, model, text: bytes, literal_tokens_cache: dict = None) -> list:
+        ctx = fake_llama_cpp.llama_new_context_with_model(model, fake_llama_cpp.llama_context_default_params())
+        buffers = SamplingBuffers(ctx, model, 8, 8)
+        return tokenize_forced_text(model, text, buffers, TokenPrefixIndex(self.pieces), literal_tokens_cache)
+
+    def test_token_boundaries(self):
+        # llama_tokenize adds a space before the text: the forced text is tokenized greedily instead,
+        # so it starts on the boundary of the previous token, without BOS.
+        model = fake_llama_cpp.FakeModel(self.pieces, None, add_space_prefix=True)
+        text = '"été":'.encode()
+        tokens = self.tokenize(model, text)
+        self.assertEqual(tokens, [3, 6, 8, 6, 7, 12])
+        self.assertEqual(b"".join(self.pieces[token_id] for token_id in tokens), text)
+        self.assertEqual(HistoryBuffer(b"".join(self.pieces[token_id] for token_id in tokens)).text(), '"été":')
+        # Without the added space, the tokens of llama_tokenize are kept.
+        model = fake_llama_cpp.FakeModel(self.pieces, None)
+        self.assertEqual(self.tokenize(model, text), [3, 6, 8, 6, 7, 12])
+
+    def test_literal_cache(self):
+        model = fake_llama_cpp.FakeModel(self.pieces, None, add_space_prefix=True)
+        literal_tokens_cache = {}
+        tokens = self.tokenize(model, '"é":'.encode(), literal_tokens_cache)
+        self.assertEqual(literal_tokens_cache, {'"é":'.encode(): [3, 6, 7, 12]})
+        self.assertIs(self.tokenize(model, '"é":'.encode(), literal_tokens_cache), tokens)
+
+    def test_forced_multi_byte_characters(self):
+        # The property name and the start of the enum values are forced, "é" and "à" being split between tokens.
+        model_path = fake_model_path(self.directory.name, "spm.gguf", self.vocab, add_space_prefix=True)
+        json_schema = {"type": "object", "properties": {"prénom": {"enum": ["déjà vu", "déjà fait"]}}}
+        stats = GenerationStats()
+        text = "".join(run_inference_constrained_by_json_schema(model_path, json_schema, "Hi", stats=stats))
+        self.assertTrue(text.startswith('{"prénom":"déjà '), text)
+        self.assertTrue(follows_schema(json_schema, text), text)
+        self.assertGreaterEqual(stats.n_forced_tokens, len('{"prénom":"déjà '.encode()))
+
+
+class TestContextPool(FakeModelTestCase):
+    def test_free(self):
+        model = get_model(self.model_path)
+        pool = get_context_pool(model, 2, 256)
+        self.assertIs(get_context_pool(model, 2, 256), pool)
+        contexts = list(pool.contexts)
+        pool.free()
+        self.assertTrue(all(ctx.freed for ctx in contexts))
+        # A freed pool does not give its contexts anymore, and get_context_pool creates a new one.
+        self.assertRaises(RuntimeError, pool.acquire, 0.1)
+        new_pool = get_context_pool(model, 2, 256)
+        self.assertIsNot(new_pool, pool)
+        json_schema = benchmark.nested_schema(1)
+        text = "".join(run_inference_constrained_by_json_schema(self.model_path, json_schema, "Hi", context_pool=new_pool, max_tokens=40))
+        self.assertTrue(follows_schema(json_schema, text), text)
+        new_pool.free()
+
+
+class SlowBackend:
+    """
+    A backend whose evaluations take some time, like the ones of a real model.
+    """
+    def __init__(self, backend, delay: float):
+        self.backend = backend
+        self.delay = delay
+
+    def eval(self, tokens):
+        time.sleep(self.delay)
+        return self.backend.eval(tokens)
+
+
+class TestPipelinedInference(FakeModelTestCase):
+    json_schema = benchmark.nested_schema(2)
+
+    def generate(self, model, pipelined: bool, completion_callback=None) -> str:
+        # A new context, so the sampling starts from the same seed.
+        ctx = new_context(model, n_ctx=512)
+        try:
+            constrainer = JsonSchemaConstrainer(self.json_schema)
+            if completion_callback is None:
+                completion_callback = lambda new_text: to_byte_completions(constrainer.compute_next_completion(new_text))
+            return "".join(do_inference(b"Hi", model=model, ctx=ctx, completion_callback=completion_callback, verbose=False,
+                                        incremental_callback=True, n_predict=80, pipelined=pipelined))
+        finally:
+            self.assertEqual(ctx.n_evaluating, 0)
+            free_context_resources(ctx)
+            fake_llama_cpp.llama_free(ctx)
+
+    def test_same_as_sequential(self):
+        model = get_model(self.model_path)
+        text = self.generate(model, pipelined=True)
+        self.assertEqual(text, self.generate(model, pipelined=False))
+        self.assertGreater(len(text), 20)
+
+    def test_callback_error(self):
+        # The completion callback fails while the sampled token is evaluated: the evaluation is over when the error is raised.
+        model = fake_llama_cpp.FakeModel(self.vocab, SlowBackend(benchmark.FakeBackend(self.vocab), 0.05))
+        n_calls = []
+        def completion_callback(new_text: str):
+            n_calls.append(new_text)
+            if len(n_calls) == 4:
+                # The evaluation started in the worker thread.
+                time.sleep(0.01)
+                raise ValueError("callback error")
+            return None
+        with self.assertRaises(ValueError):
+            self.generate(model, pipelined=True, completion_callback=completion_callback)
+
+
+class TestBatchedInference(FakeModelTestCase):
+    requests = [
+        ("Hi", {"type": "array", "items": {"type": "object", "properties": {"name": {"type": "string"}, "value": {"type": "number"}}}}),
+        ("Hello there", benchmark.nested_schema(2)),
+        ("Hey", {"type": "object", "properties": {"ok": {"type": "boolean"}, "n": {"type": "number"}}}),
+        ("Good morning", {"type": "array", "items": {"type": "string", "maxLength": 5}}),
+        ("Hi", {"type": "object", "properties": {"ok": {"type": "boolean"}, "n": {"type": "number"}}}),
+    ]
+
+    def run_batched(self, model_path: str, n_parallel: int, max_tokens: int = 60):
+        texts = [""] * len(self.requests)
+        events = []
+        for index, chunk in run_batched_inference_constrained_by_json_schema(model_path, self.requests, n_parallel=n_parallel, max_tokens=max_tokens):
+            texts[index] += chunk
+            events.append(index)
+        return texts, events
+
+    def test_follows_schemas(self):
+        # With 2 sequences at a time, the sequence ids of the finished requests are given to the next ones.
+        texts, events = self.run_batched(self.model_path, n_parallel=2)
+        for (prompt, json_schema), text in zip(self.requests, texts):
+            self.assertTrue(follows_schema(json_schema, text), (prompt, text))
+        # The requests start in order, each one once a sequence has finished.
+        first_chunks = [events.index(index) for index in range(len(self.requests))]
+        last_chunks = [len(events) - 1 - events[::-1].index(index) for index in range(len(self.requests))]
+        self.assertEqual(first_chunks, sorted(first_chunks))
+        for index in range(2, len(self.requests)):
+            self.assertGreater(first_chunks[index], sorted(last_chunks[:index])[index - 2])
+        # The KV cells of the finished sequences are freed.
+        self.assertEqual([cell for cell in get_context(get_model(self.model_path)).cells if cell is not None], [])
+
+    def test_same_as_sequential(self):
+        # Each sequence only sees its own prompt and tokens in the KV cache, and is constrained by its own schema:
+        # without sampling randomness, it generates the same text as a generation of its request alone.
+        texts, events = self.run_batched(self.greedy_model_path, n_parallel=3)
+        for (prompt, json_schema), text in zip(self.requests, texts):
+            self.assertEqual(text, "".join(run_inference_constrained_by_json_schema(self.greedy_model_path, json_schema, prompt, max_tokens=60)))
+        self.assertNotEqual(texts[2], texts[4])
+
+    def test_n_best(self):
+        prompt, json_schema = self.requests[1]
+        texts = [""] * 4
+        for index, chunk in run_n_best_inference_constrained_by_json_schema(self.model_path, json_schema, prompt, n=4, max_tokens=60):
+            texts[index] += chunk
+        for text in texts:
+            self.assertTrue(follows_schema(json_schema, text), text)
+        self.assertGreater(len(set(texts)), 1)
+        self.assertEqual([cell for cell in get_context(get_model(self.model_path)).cells if cell is not None], [])
+
+    def test_n_best_shares_the_prompt(self):
+        # The sequences start from the KV cells of the prompt copied from the sequence 0.
+        prompt, json_schema = self.requests[3]
+        text = "".join(run_inference_constrained_by_json_schema(self.greedy_model_path, json_schema, prompt, max_tokens=60))
+        texts = [""] * 3
+        for index, chunk in run_n_best_inference_constrained_by_json_schema(self.greedy_model_path, json_schema, prompt, n=3, max_tokens=60):
+            texts[index] += chunk
+        self.assertEqual(texts, [text] * 3)
+
+
+class FakeStreamWriter:
+    def __init__(self):
+        self.data = b""
+
+    def write(self, data: bytes):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.server = InferenceServer(["a.gguf", "b.gguf"], max_body_bytes=64)
+
+    def tearDown(self):
+        self.server.executor.shutdown()
+
+    def assertHttpError(self, body: bytes, status: int):
+        with self.assertRaises(HttpError) as context:
+            self.server.parse_request(body)
+        self.assertEqual(context.exception.status, status)
+
+    def test_parse_request(self):
+        job = self.server.parse_request(b'{"prompt": "Hi"}')
+        self.assertEqual((job.model_path, job.prompt, job.json_schema), ("a.gguf", "Hi", None))
+        job = self.server.parse_request(b'{"prompt": "Hi", "model_path": "b.gguf"}')
+        self.assertEqual(job.model_path, "b.gguf")
+
+    def test_parse_invalid_request(self):
+        self.assertHttpError(b'{"prompt": ', 400)
+        self.assertHttpError(b'["Hi"]', 400)
+        self.assertHttpError(b'{"prompt": 1}', 400)
+        self.assertHttpError(b'{"prompt": "Hi", "model_path": "c.gguf"}', 400)
+
+    @unittest.skipUnless(importlib.util.find_spec("jsonschema"), "jsonschema is not installed")
+    def test_parse_json_schema(self):
+        job = self.server.parse_request(b'{"prompt": "Hi", "json_schema": {"type": "string"}}')
+        self.assertEqual(job.json_schema, {"type": "string"})
+        self.assertHttpError(b'{"prompt": "Hi", "json_schema": {"type": 1}}', 400)
+
+    def handle(self, request: bytes, chunks: list = ()) -> bytes:
+        async def worker():
+            # Instead of a generation, the given chunks are sent to the job.
+            job = await self.server.jobs.get()
+            for chunk in chunks:
+                await job.chunks.put(chunk)
+
+        async def run():
+            self.server.jobs = asyncio.Queue()
+            worker_task = asyncio.create_task(worker())
+            reader = asyncio.StreamReader()
+            reader.feed_data(request)
+            reader.feed_eof()
+            writer = FakeStreamWriter()
+            await self.server.handle_connection(reader, writer)
+            worker_task.cancel()
+            return writer.data
+        return asyncio.run(run())
+
+    def test_generate(self):
+        request = b'POST /generate HTTP/1.1\r\nContent-Length: 16\r\n\r\n{"prompt": "Hi"}'
+        response = self.handle(request, ["Hel", "lo", None])
+        self.assertTrue(response.startswith(b"HTTP/1.1 200 OK\r\n"), response)
+        self.assertTrue(response.endswith(b"\r\n\r\n3\r\nHel\r\n2\r\nlo\r\n0\r\n\r\n"), response)
+        # An error before the first chunk gets its own response, an error after it cuts the stream.
+        response = self.handle(request, [RuntimeError("The context is too small")])
+        self.assertTrue(response.startswith(b"HTTP/1.1 500 Internal Server Error\r\n"), response)
+        self.assertTrue(response.endswith(b"The generation failed: The context is too small\n"), response)
+        response = self.handle(request, ["Hel", RuntimeError("The context is too small")])
+        self.assertTrue(response.endswith(b"\r\n\r\n3\r\nHel\r\n"), response)
+
+    def test_max_body_bytes(self):
+        body = json.dumps({"prompt": "a" * 100}).encode()
+        response = self.handle(b"POST /generate HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+        self.assertTrue(response.startswith(b"HTTP/1.1 413 Payload Too Large\r\n"), response)
+
+    def test_unknown_path(self):
+        response = self.handle(b"GET /unknown HTTP/1.1\r\n\r\n")
+        self.assertTrue(response.startswith(b"HTTP/1.1 404 Not Found\r\n"), response)
+
+
+class TestContextResources(unittest.TestCase):
+    def test_free_context_resources(self):
+        ctx, other_ctx = object(), object()
+        buffers = get_context_resource(ctx, "buffers", list)
+        self.assertIs(get_context_resource(ctx, "buffers", list), buffers)
+        self.assertIsNot(get_context_resource(other_ctx, "buffers", list), buffers)
+        executor = get_context_resource(ctx, "executor", lambda: ThreadPoolExecutor(max_workers=1))
+        free_context_resources(ctx)
+        # The resources of the freed context are dropped (a new context at its address gets new ones), the others are kept.
+        self.assertIsNot(get_context_resource(ctx, "buffers", list), buffers)
+        self.assertRaises(RuntimeError, executor.submit, print)
+        self.assertIs(get_context_resource(other_ctx, "buffers", list), get_context_resource(other_ctx, "buffers", list))
+        free_context_resources(ctx)
+        free_context_resources(other_ctx)
+
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()